@@ -1,32 +1,106 @@
+import json
 import logging
-from fastapi import FastAPI, HTTPException
-from service.ChatGPTService import ChatGPTClient, UserInput  # Убедитесь, что путь правильный
+import os
+from contextlib import asynccontextmanager
 
-app = FastAPI()
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from service.ChatGPTService import ChatGPTClient, UserInput  # Убедитесь, что путь правильный
+from service.response_cache import ChatResponseCache
+from utils.metrics import render_metrics
 
 # Инициализация клиента
-chat_gpt_client = ChatGPTClient()
+chat_gpt_client = ChatGPTClient(
+    model=os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo"),
+    max_in_flight=int(os.environ.get("OPENAI_MAX_IN_FLIGHT", "8")),
+    timeout=float(os.environ.get("OPENAI_TIMEOUT", "30"))
+)
+# Кэш ответов включается для маршрута явно: generate_response(..., cache=chat_cache).
+# CHAT_CACHE_TTL=0 отключает кэш /chat.
+CHAT_CACHE_TTL = int(os.environ.get("CHAT_CACHE_TTL", "600"))
+chat_cache = ChatResponseCache(
+    max_items=int(os.environ.get("CHAT_CACHE_ITEMS", "1000")),
+    ttl=CHAT_CACHE_TTL
+) if CHAT_CACHE_TTL > 0 else None
 logger = logging.getLogger()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if chat_cache is not None:
+        logger.info(f"Кэш ответов /chat: {chat_cache.stats()}")
+    # Закрываем общую сессию OpenAI при остановке сервера
+    await chat_gpt_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
 @app.get("/")
 async def root():
     return {"message": "FastAPI работает!"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики API и процесса бота в формате Prometheus."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 # Эндпоинт для общения с ChatGPT
 @app.post("/chat")
 async def chat_endpoint(user_input: UserInput):
     """
     Эндпоинт для отправки промпта и сообщения игрока в ChatGPT.
+    Промпт уходит системным сообщением, сообщение игрока — пользовательским.
+    С stream=true ответ приходит потоком server-sent events (кэш ответов не используется).
     """
+    messages = [
+        {"role": "system", "content": user_input.prompt},
+        {"role": "user", "content": user_input.player_message}
+    ]
+    if user_input.stream:
+        return await stream_chat(messages)
     try:
-        response = await chat_gpt_client.generate_response(
-            player_message=user_input.player_message,
-            prompt=user_input.prompt
-        )
+        response = await chat_gpt_client.generate_response(messages, cache=chat_cache)
         return {"response": response}
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.exception(f"Необработанная ошибка: {e}")
         raise HTTPException(status_code=500, detail="Произошла ошибка на сервере.")
+
+
+def _sse(payload, event=None):
+    data = json.dumps(payload, ensure_ascii=False)
+    return f"event: {event}\ndata: {data}\n\n" if event else f"data: {data}\n\n"
+
+
+async def stream_chat(messages):
+    """
+    Отдаёт куски ответа OpenAI событиями `data: {"delta": ...}`, в конце — `data: [DONE]`.
+    Первый кусок ждём до начала ответа, поэтому ошибка до первого токена приходит обычным
+    HTTP-статусом, а оборвавшийся поток завершается событием `error`.
+    """
+    chunks = chat_gpt_client.stream_response(messages)
+    try:
+        first = await anext(chunks)
+    except StopAsyncIteration:
+        first = ""
+
+    async def events():
+        try:
+            if first:
+                yield _sse({"delta": first})
+            async for delta in chunks:
+                yield _sse({"delta": delta})
+            yield "data: [DONE]\n\n"
+        except HTTPException as e:
+            yield _sse({"status": e.status_code, "detail": e.detail}, event="error")
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
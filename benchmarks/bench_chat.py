@@ -0,0 +1,273 @@
+"""
+Нагрузочный офлайн-бенчмарк /chat.
+
+Поднимает локальную подмену OpenAI Chat Completions и гоняет POST /chat через ASGI-приложение
+FastAPI от --players одновременных игроков. Подмена отвечает с задержкой --latency, отдаёт 429,
+когда одновременных запросов больше --upstream-capacity (как лимит OpenAI), случайные 500 с долей
+--error-rate, а первый запрос каждого нового соединения задерживает на --handshake (TLS-рукопожатие).
+Сравниваются прежний клиент (новая ClientSession на каждый вызов, без повторов),
+ChatGPTClient с общей сессией, лимитом одновременных запросов и повторами, и он же с кэшем
+ответов. Игроки отправляют --distinct разных сообщений по кругу (0 — все сообщения разные).
+
+Отчёт: успешные ответы, успешных ответов/с, p50/p95 задержки /chat, число запросов и
+TCP-соединений к upstream.
+
+С --stream подмена генерирует ответ из --tokens токенов по --token-delay секунд на токен,
+и сравниваются /chat целиком и /chat с stream=true: время до первого видимого текста
+(для обычного ответа — весь ответ) и до конца ответа. Ответ читается напрямую через ASGI,
+без буферизации httpx.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_chat [--players 50] [--requests 500] [--upstream-capacity 16] [--max-in-flight 16]
+                                    [--distinct 20]
+    python -m benchmarks.bench_chat --stream [--players 20] [--tokens 150] [--token-delay 0.02]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import aiohttp
+import httpx
+from aiohttp import web
+from fastapi import HTTPException
+
+from app import main as api
+from service.response_cache import ChatResponseCache
+
+
+class FakeOpenAI:
+    """Локальная подмена OpenAI с лимитом одновременных запросов и стоимостью нового соединения."""
+
+    def __init__(self, latency, error_rate, capacity, handshake, tokens=0, token_delay=0.0):
+        self.latency = latency
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.handshake = handshake
+        self.requests = 0
+        self.in_flight = 0
+        self.connections = set()
+        self._runner = None
+        self.url = None
+
+    async def start(self, host="127.0.0.1"):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/v1/chat/completions"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _completions(self, request):
+        self.requests += 1
+        peer = request.transport.get_extra_info("peername")
+        if peer not in self.connections:
+            self.connections.add(peer)
+            await asyncio.sleep(self.handshake)
+        payload = await request.json()
+        if self.in_flight >= self.capacity:
+            return web.json_response({"error": "rate limited"}, status=429)
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            if random.random() < self.error_rate:
+                return web.json_response({"error": "server error"}, status=500)
+            words = [f"DESCRIPTION: ответ на {payload['messages'][-1]['content']}"]
+            words += ["слово"] * self.tokens + ["ACTIONS: a, b EVENT_PICTURE: *"]
+            if payload.get("stream"):
+                return await self._stream(request, words)
+            await asyncio.sleep(self.token_delay * len(words))
+        finally:
+            self.in_flight -= 1
+        return web.json_response({"choices": [{"message": {"content": " ".join(words)}}]})
+
+    async def _stream(self, request, words):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in words:
+            await asyncio.sleep(self.token_delay)
+            chunk = {"choices": [{"delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+async def legacy_generate_response(client, messages):
+    """Прежний generate_response: новая сессия на каждый вызов, без таймаута и повторов."""
+    data = {"model": client.model, "messages": messages, "max_tokens": 2000, "temperature": 0.7}
+    headers = {"Authorization": f"Bearer {client.api_key}", "Content-Type": "application/json"}
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(client.API_URL, headers=headers, json=data) as resp:
+                if resp.status != 200:
+                    raise HTTPException(status_code=resp.status, detail="Ошибка при запросе к OpenAI API")
+                result = await resp.json()
+                return result['choices'][0]['message']['content'].strip()
+    except Exception:
+        raise HTTPException(status_code=500, detail="Произошла ошибка при генерации ответа.")
+
+
+async def run_load(args, legacy, cached):
+    random.seed(args.seed)
+    upstream = FakeOpenAI(args.latency, args.error_rate, args.upstream_capacity, args.handshake)
+    await upstream.start()
+    client = api.chat_gpt_client
+    client.API_URL = upstream.url
+    client.base_backoff = args.backoff
+    client.max_in_flight = args.max_in_flight
+    client._slots = asyncio.Semaphore(args.max_in_flight)
+    api.chat_cache = ChatResponseCache(ttl=600) if cached else None
+    if legacy:
+        client.generate_response = lambda messages, **kwargs: legacy_generate_response(client, messages)
+
+    latencies = []
+    statuses = {}
+    pending = iter(range(args.requests))
+    transport = httpx.ASGITransport(app=api.app)
+
+    async def player(http):
+        for i in pending:
+            started = time.perf_counter()
+            response = await http.post("/chat", json={"player_message": f"действие {i % args.distinct if args.distinct else i}",
+                                                   "prompt": "exploration"})
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        await asyncio.gather(*(player(http) for _ in range(args.players)))
+    total = time.perf_counter() - started
+
+    if legacy:
+        del client.generate_response
+    await client.close()
+    await upstream.stop()
+
+    latencies.sort()
+    return {
+        "ok": statuses.get(200, 0),
+        "statuses": statuses,
+        "rps": statuses.get(200, 0) / total,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "upstream_requests": upstream.requests,
+        "connections": len(upstream.connections),
+        "cache": api.chat_cache.stats() if cached else "",
+    }
+
+
+async def asgi_post(app, path, payload):
+    """POST через ASGI-приложение; возвращает (статус, время до первого текста, время до конца), с."""
+    body = json.dumps(payload).encode("utf-8")
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+             "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+    started = time.perf_counter()
+    result = {"status": None, "first": None}
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            result["status"] = message["status"]
+        elif message["type"] == "http.response.body" and result["first"] is None \
+                and b"DESCRIPTION" in message.get("body", b""):
+            result["first"] = time.perf_counter() - started
+
+    await app(scope, receive, send)
+    return result["status"], result["first"], time.perf_counter() - started
+
+
+async def run_stream(args, stream):
+    random.seed(args.seed)
+    upstream = FakeOpenAI(args.latency, 0, args.upstream_capacity, args.handshake, args.tokens, args.token_delay)
+    await upstream.start()
+    client = api.chat_gpt_client
+    client.API_URL = upstream.url
+    client.max_in_flight = args.max_in_flight
+    client._slots = asyncio.Semaphore(args.max_in_flight)
+    api.chat_cache = None
+
+    first_times, total_times, statuses = [], [], {}
+    pending = iter(range(args.requests))
+
+    async def player():
+        for i in pending:
+            status, first, total = await asgi_post(api.app, "/chat", {
+                "player_message": f"действие {i}", "prompt": "exploration", "stream": stream})
+            statuses[status] = statuses.get(status, 0) + 1
+            if first is not None:
+                first_times.append(first)
+                total_times.append(total)
+
+    await asyncio.gather(*(player() for _ in range(args.players)))
+    await client.close()
+    await upstream.stop()
+    first_times.sort()
+    total_times.sort()
+    return {
+        "statuses": statuses,
+        "first_p50_ms": first_times[len(first_times) // 2] * 1000,
+        "first_p95_ms": first_times[int(len(first_times) * 0.95)] * 1000,
+        "total_p50_ms": total_times[len(total_times) // 2] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=50, help="одновременных игроков")
+    parser.add_argument("--requests", type=int, default=500, help="всего запросов к /chat")
+    parser.add_argument("--latency", type=float, default=0.05, help="средняя задержка upstream, с")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="доля случайных ответов 500")
+    parser.add_argument("--upstream-capacity", type=int, default=16, help="одновременных запросов до 429")
+    parser.add_argument("--handshake", type=float, default=0.06, help="задержка нового соединения, с")
+    parser.add_argument("--max-in-flight", type=int, default=16, help="лимит одновременных запросов клиента")
+    parser.add_argument("--backoff", type=float, default=0.05, help="базовая пауза перед повтором, с")
+    parser.add_argument("--distinct", type=int, default=20, help="разных сообщений игроков, 0 — все разные")
+    parser.add_argument("--stream", action="store_true", help="сравнить обычный и потоковый /chat")
+    parser.add_argument("--tokens", type=int, default=150, help="токенов в ответе (для --stream)")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="время генерации токена, с")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    if args.stream:
+        print(f"{'режим':<10}{'первый текст p50, мс':>22}{'p95, мс':>10}{'конец p50, мс':>15}  статусы")
+        for name, stream in (("целиком", False), ("поток", True)):
+            result = asyncio.run(run_stream(args, stream))
+            print(f"{name:<10}{result['first_p50_ms']:>22.1f}{result['first_p95_ms']:>10.1f}"
+                  f"{result['total_p50_ms']:>15.1f}  {result['statuses']}")
+        return 0
+    print(f"{'клиент':<10}{'ok':>6}{'ok/s':>9}{'p50, мс':>10}{'p95, мс':>10}{'upstream':>10}{'TCP':>6}  статусы")
+    for name, legacy, cached in (("прежний", True, False), ("пул", False, False), ("пул+кэш", False, True)):
+        result = asyncio.run(run_load(args, legacy, cached))
+        print(f"{name:<10}{result['ok']:>6}{result['rps']:>9.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+              f"{result['upstream_requests']:>10}{result['connections']:>6}  {result['statuses']}")
+        if result["cache"]:
+            print(f"{'':<10}кэш: {result['cache']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
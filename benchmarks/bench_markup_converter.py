@@ -0,0 +1,159 @@
+"""
+Микробенчмарк HarkachMarkupConverter.
+
+Проверяет, что конвертер выдаёт эталонный результат на корпусе реальных комментариев
+2ch и 4chan (benchmarks/fixtures/markup_corpus.json), и сравнивает его скорость с прежней
+реализацией из цепочки regex-замен на обычных постах и на больших ОП-постах.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_markup_converter [--repeat 2000] [--fuzz 300000]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import timeit
+
+from utils.harkach_markup_converter import HarkachMarkupConverter
+
+logger = logging.getLogger(__name__)
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "markup_corpus.json")
+
+
+class LegacyHarkachMarkupConverter:
+    """
+    Прежняя реализация без изменений: три regex компилируются на каждый вызов, затем ~10
+    последовательных проходов и f-строки для debug-лога после каждого этапа.
+    """
+
+    def replace_underline_span(self, input_str: str) -> str:
+        regex = re.compile(r'<span[^>]*class="u"[^>]*>(.*?)</span>', flags=re.DOTALL)
+        return regex.sub(r'<u>\1</u>', input_str)
+
+    def replace_unkfunc_span(self, input_str: str) -> str:
+        regex = re.compile(r'<span[^>]*class="unkfunc"[^>]*>(.*?)</span>', flags=re.DOTALL)
+        return regex.sub(r'<i>\1</i>', input_str)
+
+    def replace_spoiler_span(self, input_str: str) -> str:
+        regex = re.compile(r'<span[^>]*class="spoiler"[^>]*>(.*?)</span>', flags=re.DOTALL)
+        return regex.sub(r'<span class="tg-spoiler">\1</span>', input_str)
+
+    def convert_to_tg_html(self, input_str: str) -> str:
+        result = self.replace_underline_span(input_str)
+        logger.debug(f"After replace_underline_span: {result}")
+        result = self.replace_unkfunc_span(result)
+        logger.debug(f"After replace_unkfunc_span: {result}")
+        result = self.replace_spoiler_span(result)
+        logger.debug(f"After replace_spoiler_span: {result}")
+        result = (result
+                  .replace("<em>", "<i>").replace("</em>", "</i>")
+                  .replace("<strong>", "<b>").replace("</strong>", "</b>"))
+        result = (result
+                  .replace('<a href="/', '<a href="https://2ch.hk/')
+                  .replace('&quot;', '"')
+                  .replace("<br>", "\n"))
+        result = re.sub(r'\s*(target="_blank"|rel="[^"]*")', '', result)
+        result = re.sub(r'<span(?! class="tg-spoiler")[^>]*>.*?</span>', '', result, flags=re.DOTALL)
+        result = re.sub(r'</span>', '', result)
+        result = re.sub(r'class="[^"]*"', '', result)
+        logger.debug(f"Final result: {result}")
+        return result
+
+
+def load_corpus():
+    with open(CORPUS_PATH, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def check_golden(converter, corpus):
+    failures = []
+    for case in corpus:
+        actual = converter.convert_to_tg_html(case["input"])
+        if actual != case["expected"]:
+            failures.append((case["input"], case["expected"], actual))
+    return failures
+
+
+# Куски разметки для случайных последовательностей; кавычки в тексте 2ch экранированы как &quot;
+FUZZ_TOKENS = [
+    '<span class="u">', '<span class="unkfunc">', '<span class="spoiler">', '<span>', '<span class="quote">',
+    '</span>', ' ', '  ', '\n', '<br>', '<em>', '</em>', '<strong>', '&quot;', '<a href="/', '>',
+    'target="_blank"', ' rel="nofollow"', 'class="q"', 'a', 'тред',
+]
+
+
+def fuzz(converter, legacy, count, seed=1):
+    """Сравнивает конвертер с прежней реализацией на count случайных последовательностях."""
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(count):
+        text = "".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 14)))
+        if converter.convert_to_tg_html(text) != legacy.convert_to_tg_html(text):
+            failures.append(text)
+    return failures
+
+
+def large_op_post(corpus, target_length=15000):
+    """Склеивает корпус в пост размером с максимальный ОП-пост 2ch."""
+    parts = []
+    length = 0
+    while length < target_length:
+        for case in corpus:
+            parts.append(case["input"])
+            length += len(case["input"]) + 4
+    return "<br>".join(parts)[:target_length].rsplit("<", 1)[0]
+
+
+def bench(converter, inputs, repeat):
+    convert = converter.convert_to_tg_html
+    timer = timeit.Timer(lambda: [convert(text) for text in inputs])
+    return min(timer.repeat(repeat=5, number=repeat)) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="повторов на замер для корпуса")
+    parser.add_argument("--fuzz", type=int, default=0, help="сравнить с прежней реализацией на N случайных входах")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    converter = HarkachMarkupConverter()
+    legacy = LegacyHarkachMarkupConverter()
+
+    failures = check_golden(converter, corpus)
+    for text, expected, actual in failures:
+        print(f"РАСХОЖДЕНИЕ\n  вход:     {text!r}\n  эталон:   {expected!r}\n  получено: {actual!r}")
+    print(f"Эталонный корпус: {len(corpus) - len(failures)}/{len(corpus)} совпадений")
+
+    big = large_op_post(corpus)
+    if converter.convert_to_tg_html(big) != legacy.convert_to_tg_html(big):
+        failures.append((big, None, None))
+        print("РАСХОЖДЕНИЕ на большом ОП-посте")
+
+    if args.fuzz:
+        mismatches = fuzz(converter, legacy, args.fuzz)
+        for text in mismatches[:5]:
+            print(f"РАСХОЖДЕНИЕ на случайном входе: {text!r}")
+        print(f"Случайные входы: {args.fuzz - len(mismatches)}/{args.fuzz} совпадений")
+        failures.extend((text, None, None) for text in mismatches)
+
+    inputs = [case["input"] for case in corpus]
+    rows = [
+        ("корпус", inputs, args.repeat),
+        (f"ОП-пост {len(big)} символов", [big], max(1, args.repeat // 10)),
+    ]
+    print(f"{'набор':<28}{'прежний, мкс':>14}{'новый, мкс':>14}{'ускорение':>12}")
+    for name, texts, repeat in rows:
+        old_time = bench(legacy, texts, repeat) * 1e6
+        new_time = bench(converter, texts, repeat) * 1e6
+        print(f"{name:<28}{old_time:>14.1f}{new_time:>14.1f}{old_time / new_time:>11.2f}x")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+"""
+Сквозной офлайн-бенчмарк конвейера сбора и отправки медиа.
+
+Поднимает локальный HTTP-сервер, который отдаёт записанные фикстуры каталога и тредов 2ch
+и 4chan (benchmarks/fixtures/pipeline_threads.json, размноженные до --threads тредов) и
+сами медиафайлы, и прогоняет настоящий путь fetch_threads -> batch_threads -> process_thread ->
+group_split -> media_queue -> post_media_from_queue с фейковым Telegram-ботом; в каждом обходе
+вслед за 2ch доску обходит ForchanService.collect_media (условные запросы, 304 без тела).
+Сеть не нужна. Между обходами часть тредов получает новые посты, чтобы второй обход
+измерял инкрементальный путь.
+
+Отчёт: треды/с, медиагруппы/с, задержки по этапам (p50/p95/max), пиковый RSS,
+число HTTP-запросов к серверу. --json сохраняет результат для сравнения прогонов.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_pipeline [--threads 200] [--sweeps 2] [--json out.json]
+"""
+import argparse
+import asyncio
+import copy
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+
+from aiohttp import web
+from PIL import Image
+
+from service import media_poster, thread_service
+from service.dedup_store import MediaDedupStore
+from service.dvach_service import DvachService
+from service.forchan_service import ForchanService
+from service.media_hash_index import MediaHashIndex
+from service.media_poster import post_media_from_queue
+from service.media_queue import MediaPriorityQueue
+from service.tasks import job_collect_media
+from service.thread_ranker import ThreadRanker
+from utils.media_validator import MediaValidator
+from utils.rate_limiter import HostRateLimiter
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "pipeline_threads.json")
+FIRST_THREAD_NUM = 300000000
+THREAD_STRIDE = 1000
+
+
+def _fill(value, **placeholders):
+    """Подставляет {t}, {p}, {tim} во все строки фикстуры."""
+    if isinstance(value, str):
+        for key, replacement in placeholders.items():
+            value = value.replace("{" + key + "}", str(replacement))
+        return value
+    if isinstance(value, list):
+        return [_fill(v, **placeholders) for v in value]
+    if isinstance(value, dict):
+        return {k: _fill(v, **placeholders) for k, v in value.items()}
+    return value
+
+
+class FixtureBoard:
+    """Состояние доски на локальном сервере: треды из шаблона фикстуры и растущие посты."""
+
+    def __init__(self, fixtures, thread_count):
+        self.template_2ch = fixtures["2ch_thread"]["threads"][0]["posts"]
+        self.template_4chan = fixtures["4chan_thread"]["posts"]
+        self.threads = {}
+        for idx in range(thread_count):
+            num = FIRST_THREAD_NUM + idx * THREAD_STRIDE
+            self.threads[num] = [self._make_2ch_post(num, i) for i in range(len(self.template_2ch))]
+        self.lasthit = {num: 1700000000 for num in self.threads}
+
+    def _make_2ch_post(self, thread_num, i):
+        template = self.template_2ch[i % len(self.template_2ch)]
+        post_num = thread_num + i
+        post = _fill(copy.deepcopy(template), t=thread_num, p=post_num)
+        post["num"] = post_num
+        return post
+
+    def bump(self, share, new_posts=2):
+        """Добавляет новые посты в долю тредов, как это происходит между обходами."""
+        for num in random.sample(list(self.threads), int(len(self.threads) * share)):
+            posts = self.threads[num]
+            for _ in range(new_posts):
+                posts.append(self._make_2ch_post(num, len(posts)))
+            self.lasthit[num] += 60
+
+    def threads_json(self):
+        return {"board": "b", "threads": [
+            {"num": num, "comment": posts[0]["comment"], "posts_count": len(posts),
+             "lasthit": self.lasthit[num], "timestamp": posts[0]["timestamp"], "views": 100}
+            for num, posts in self.threads.items()
+        ]}
+
+    def thread_4chan(self, thread_id):
+        """Тот же тред в формате 4chan: столько же постов, сколько в его 2ch-версии."""
+        posts = []
+        for i in range(len(self.threads[thread_id])):
+            template = self.template_4chan[i % len(self.template_4chan)]
+            post = _fill(copy.deepcopy(template), p=thread_id + i, tim=thread_id * 1000 + i)
+            post["no"] = thread_id + i
+            posts.append(post)
+        return {"posts": posts}
+
+
+class FixtureServer:
+    """Локальная подмена 2ch, 4chan (под префиксом /4chan) и хранилищ медиа."""
+
+    def __init__(self, board, latency):
+        self.board = board
+        self.latency = latency
+        self.requests = 0
+        self.api_requests = 0
+        self.api_requests_4chan = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._media_cache = {}
+        self._runner = None
+        self.base_url = None
+
+    async def start(self, host="127.0.0.1"):
+        app = web.Application(middlewares=[self._count])
+        app.router.add_get("/b/threads.json", self._threads)
+        app.router.add_get("/b/res/{num}.json", self._thread)
+        app.router.add_get("/api/mobile/v2/after/b/{num}/{after}", self._after)
+        app.router.add_get("/4chan/b/threads.json", self._threads_4chan)
+        app.router.add_get("/4chan/b/thread/{num}.json", self._thread_4chan)
+        app.router.add_route("*", "/{path:.*\\.(?:jpg|png|mp4)}", self._media)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    @web.middleware
+    async def _count(self, request, handler):
+        self.requests += 1
+        if request.path.startswith("/4chan/"):
+            self.api_requests_4chan += 1
+        elif not request.path.endswith((".jpg", ".png", ".mp4")):
+            self.api_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        response = await handler(request)
+        if response.body is not None and request.method != "HEAD":
+            self.bytes_sent += len(response.body)
+        return response
+
+    async def _threads(self, request):
+        return web.json_response(self.board.threads_json())
+
+    async def _thread(self, request):
+        posts = self.board.threads.get(int(request.match_info["num"]))
+        if posts is None:
+            raise web.HTTPNotFound()
+        return web.json_response({"threads": [{"posts": posts}]})
+
+    async def _after(self, request):
+        posts = self.board.threads.get(int(request.match_info["num"]))
+        if posts is None:
+            raise web.HTTPNotFound()
+        after = int(request.match_info["after"])
+        return web.json_response({"result": 1, "posts": [p for p in posts if p["num"] >= after]})
+
+    def _conditional(self, request, last_modified, make_body):
+        """Отвечает 304, если ресурс не менялся с If-Modified-Since, иначе — JSON с Last-Modified."""
+        since = request.headers.get("If-Modified-Since")
+        if since and parsedate_to_datetime(since).timestamp() >= last_modified:
+            self.not_modified += 1
+            return web.Response(status=304)
+        response = web.json_response(make_body())
+        response.headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        return response
+
+    async def _threads_4chan(self, request):
+        return self._conditional(request, max(self.board.lasthit.values()), lambda: [{"page": 1, "threads": [
+            {"no": num, "last_modified": self.board.lasthit[num], "replies": len(posts) - 1}
+            for num, posts in self.board.threads.items()
+        ]}])
+
+    async def _thread_4chan(self, request):
+        num = int(request.match_info["num"])
+        if num not in self.board.threads:
+            raise web.HTTPNotFound()
+        return self._conditional(request, self.board.lasthit[num], lambda: self.board.thread_4chan(num))
+
+    async def _media(self, request):
+        path = request.match_info["path"]
+        if path.endswith(".mp4"):
+            return web.Response(body=b"\x00" * 2048, content_type="video/mp4")
+        body = self._media_cache.get(path)
+        if body is None:
+            # Каждому файлу — своя картинка, чтобы перцептивный дедуп не склеивал разные медиа
+            rnd = random.Random(path)
+            img = Image.new("L", (8, 8))
+            img.putdata([rnd.randrange(256) for _ in range(64)])
+            buffer = io.BytesIO()
+            img.resize((64, 64)).convert("RGB").save(buffer, "JPEG")
+            body = self._media_cache[path] = buffer.getvalue()
+        return web.Response(body=body, content_type="image/jpeg")
+
+
+class FakeBot:
+    """Подмена telegram.Bot: запоминает отправленные группы и имитирует задержку Bot API."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.groups_sent = 0
+        self.media_sent = 0
+
+    async def _sent(self, count):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.groups_sent += 1
+        self.media_sent += count
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._sent(len(media))
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._sent(1)
+
+    async def send_video(self, chat_id, video, **kwargs):
+        await self._sent(1)
+
+
+class StageTimer:
+    """Собирает длительности этапов и считает перцентили."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, name, func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.samples[name].append(time.perf_counter() - started)
+        return wrapper
+
+    def add(self, name, value):
+        self.samples[name].append(value)
+
+    def report(self):
+        result = {}
+        for name, values in self.samples.items():
+            values = sorted(values)
+            result[name] = {
+                "count": len(values),
+                "p50_ms": values[len(values) // 2] * 1000,
+                "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return result
+
+
+class TimedQueue(MediaPriorityQueue):
+    """Очередь, которая замеряет время ожидания групп и считает поставленные группы."""
+
+    def __init__(self, timer, maxsize):
+        super().__init__(maxsize)
+        self.timer = timer
+        self.total_put = 0
+        self._put_times = {}
+
+    def _put(self, item):
+        self.total_put += 1
+        self._put_times[id(item[2])] = time.perf_counter()
+        super()._put(item)
+
+    def _get(self):
+        item = super()._get()
+        self.timer.add("queue_wait", time.perf_counter() - self._put_times.pop(id(item)))
+        return item
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args):
+    random.seed(args.seed)
+    with open(FIXTURES_PATH, "r", encoding="utf-8") as file:
+        fixtures = json.load(file)
+    board = FixtureBoard(fixtures, args.threads)
+    server = FixtureServer(board, args.server_latency)
+    await server.start()
+
+    timer = StageTimer()
+    dvach = DvachService(limit_per_host=args.max_in_flight,
+                         rate_limiter=HostRateLimiter(args.rps, capacity=args.burst))
+    dvach.BASE_URL = server.base_url
+    dvach.fetch_threads = timer.wrap("fetch_threads", dvach.fetch_threads)
+    dvach.fetch_thread_updates = timer.wrap("fetch_thread", dvach.fetch_thread_updates)
+    forchan = ForchanService(limit_per_host=args.max_in_flight,
+                             rate_limiter=HostRateLimiter(args.rps, capacity=args.burst),
+                             media_base_url=f"{server.base_url}/4chan-media")
+    forchan.BASE_URL = f"{server.base_url}/4chan"
+    forchan.fetch_thread_data = timer.wrap("fetch_4chan", forchan.fetch_thread_data)
+
+    # Этапы, которые модули вызывают по глобальному имени, оборачиваются на уровне модуля
+    thread_service.process_thread = timer.wrap("process_thread", thread_service.process_thread)
+    thread_service.group_split = timer.wrap("group_split", thread_service.group_split)
+    media_poster.filter_accessible_media = timer.wrap("validate", media_poster.filter_accessible_media)
+
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    posted_media = MediaDedupStore(os.path.join(workdir, "posted_media.sqlite3"))
+    hash_index = MediaHashIndex() if args.phash else None
+    media_queue = TimedQueue(timer, args.queue_size)
+    ranker = ThreadRanker(args.top_k) if args.top_k is not None else None
+    bot = FakeBot(args.bot_latency)
+    bot.send_media_group = timer.wrap("send", bot.send_media_group)
+    validator = MediaValidator()
+    poster = asyncio.create_task(
+        post_media_from_queue(bot, "bench", 0, media_queue, 0, validator=validator)
+    )
+
+    sweeps = []
+    started = time.perf_counter()
+    for sweep in range(args.sweeps):
+        if sweep:
+            board.bump(args.bump_share)
+        requests_before = server.api_requests
+        sweep_started = time.perf_counter()
+        await job_collect_media(dvach, posted_media, media_queue.for_source("2ch/b"), args.max_in_flight,
+                                hash_index, ranker=ranker)
+        sweep_seconds = time.perf_counter() - sweep_started
+
+        requests_before_4chan, not_modified_before = server.api_requests_4chan, server.not_modified
+        sweep_started = time.perf_counter()
+        await forchan.collect_media(posted_media, media_queue.for_source("4chan/b"), "b",
+                                    max_in_flight=args.max_in_flight)
+        sweep_seconds_4chan = time.perf_counter() - sweep_started
+        sweeps.append({
+            "seconds": sweep_seconds,
+            "threads_per_s": len(board.threads) / sweep_seconds,
+            "api_requests": server.api_requests - requests_before,
+            "seconds_4chan": sweep_seconds_4chan,
+            "threads_per_s_4chan": len(board.threads) / sweep_seconds_4chan,
+            "api_requests_4chan": server.api_requests_4chan - requests_before_4chan,
+            "not_modified_4chan": server.not_modified - not_modified_before,
+        })
+
+    # Ждём, пока отправитель разберёт очередь
+    while bot.groups_sent < media_queue.total_put and time.perf_counter() - started < args.timeout:
+        await asyncio.sleep(0.01)
+    total = time.perf_counter() - started
+
+    poster.cancel()
+    await validator.close()
+    await dvach.close()
+    await forchan.close()
+    posted_media.close()
+    await server.stop()
+
+    return {
+        "threads": len(board.threads),
+        "sweeps": sweeps,
+        "groups_sent": bot.groups_sent,
+        "media_sent": bot.media_sent,
+        "groups_per_s": bot.groups_sent / total,
+        "total_seconds": total,
+        "http_requests": server.requests,
+        "api_requests": server.api_requests,
+        "api_requests_4chan": server.api_requests_4chan,
+        "http_bytes": server.bytes_sent,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": timer.report(),
+    }
+
+
+def print_report(result):
+    print(f"Тредов: {result['threads']}, обходов: {len(result['sweeps'])}, "
+          f"всего {result['total_seconds']:.2f} с")
+    for idx, sweep in enumerate(result["sweeps"], 1):
+        print(f"  обход {idx}: {sweep['seconds']:.2f} с, {sweep['threads_per_s']:.1f} тредов/с, "
+              f"запросов к API: {sweep['api_requests']}; "
+              f"4chan: {sweep['seconds_4chan']:.2f} с, {sweep['threads_per_s_4chan']:.1f} тредов/с, "
+              f"запросов: {sweep['api_requests_4chan']} (304: {sweep['not_modified_4chan']})")
+    print(f"Отправлено групп: {result['groups_sent']} ({result['groups_per_s']:.1f} групп/с), "
+          f"медиа: {result['media_sent']}")
+    print(f"HTTP: {result['http_requests']} запросов (к API 2ch {result['api_requests']}, "
+          f"4chan {result['api_requests_4chan']}), "
+          f"{result['http_bytes'] / 1024:.0f} КБ; "
+          f"пиковый RSS: {result['peak_rss_mb']:.1f} МБ")
+    print(f"{'этап':<16}{'n':>7}{'p50, мс':>10}{'p95, мс':>10}{'max, мс':>10}")
+    for name, stage in result["stages"].items():
+        print(f"{name:<16}{stage['count']:>7}{stage['p50_ms']:>10.2f}{stage['p95_ms']:>10.2f}{stage['max_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=200, help="тредов на доске")
+    parser.add_argument("--sweeps", type=int, default=2, help="полных обходов доски")
+    parser.add_argument("--bump-share", type=float, default=0.2, help="доля тредов с новыми постами между обходами")
+    parser.add_argument("--rps", type=float, default=200.0, help="лимит запросов в секунду на хост")
+    parser.add_argument("--burst", type=float, default=20.0, help="запас токенов rate limiter")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="одновременных загрузок тредов")
+    parser.add_argument("--queue-size", type=int, default=1000, help="ёмкость очереди медиагрупп")
+    parser.add_argument("--server-latency", type=float, default=0.005, help="задержка ответа сервера, с")
+    parser.add_argument("--bot-latency", type=float, default=0.002, help="задержка Bot API, с")
+    parser.add_argument("--top-k", type=int, help="ранжировать треды 2ch и обходить только K лучших (0 — все)")
+    parser.add_argument("--phash", action="store_true", help="включить перцептивный дедуп")
+    parser.add_argument("--timeout", type=float, default=300.0, help="предельное время прогона, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+    logging.disable(logging.INFO)
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
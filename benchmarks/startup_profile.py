@@ -0,0 +1,93 @@
+"""
+Профиль времени запуска процессов бота и API.
+
+Импортирует точку входа в чистом интерпретаторе с `python -X importtime`, раскладывает время
+по модулям (собственное и кумулятивное) и сравнивает общее время импорта с бюджетом.
+Код возврата 1 — бюджет превышен, поэтому скрипт можно запускать как проверку в CI.
+
+Запуск из корня репозитория:
+    python -m benchmarks.startup_profile [--target bot --target app.main] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Бюджет на импорт точки входа, мс
+DEFAULT_BUDGETS = {
+    "bot": 1500,
+    "app.main": 1200,
+}
+
+# Фиктивное окружение: модули проверяют переменные при импорте
+DUMMY_ENV = {
+    "BOT_TOKEN": "123456:startup-profile",
+    "OPENAI_API_KEY": "startup-profile",
+}
+
+
+def profile_import(module):
+    """Возвращает список (модуль, собственное мкс, кумулятивное мкс, глубина) для импорта module."""
+    env = dict(os.environ)
+    env.update(DUMMY_ENV)
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    with tempfile.TemporaryDirectory() as workdir:
+        # Хранилища создают файлы в текущем каталоге — запускаем во временном
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Импорт {module} завершился ошибкой:\n{completed.stderr[-2000:]}")
+
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def report(module, rows, top, budget_ms):
+    total_ms = sum(cumulative for _, _, cumulative, depth in rows if depth == 0) / 1000
+    print(f"== {module}: {total_ms:.0f} мс (бюджет {budget_ms} мс)")
+
+    print(f"  {'модуль верхнего уровня':<40}{'кумулятивно, мс':>17}")
+    top_level = sorted((r for r in rows if r[3] <= 1), key=lambda r: r[2], reverse=True)
+    for name, _, cumulative, depth in top_level[:top]:
+        print(f"  {'  ' * depth + name:<40}{cumulative / 1000:>17.1f}")
+
+    print(f"  {'самые дорогие модули':<40}{'собственное, мс':>17}")
+    for name, self_us, _, _ in sorted(rows, key=lambda r: r[1], reverse=True)[:top]:
+        print(f"  {name:<40}{self_us / 1000:>17.1f}")
+    return total_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", help="модуль точки входа (можно несколько)")
+    parser.add_argument("--budget-ms", type=float, help="бюджет для всех целей вместо значений по умолчанию")
+    parser.add_argument("--top", type=int, default=15, help="сколько модулей показывать")
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.target or list(DEFAULT_BUDGETS):
+        budget_ms = args.budget_ms or DEFAULT_BUDGETS.get(module, 1500)
+        total_ms = report(module, profile_import(module), args.top, budget_ms)
+        if total_ms > budget_ms:
+            failed.append(f"{module}: {total_ms:.0f} мс > {budget_ms:.0f} мс")
+
+    if failed:
+        print("Бюджет запуска превышен: " + "; ".join(failed))
+        return 1
+    print("Бюджет запуска соблюдён.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
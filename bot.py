@@ -2,15 +2,26 @@
 import asyncio
 import logging
 import os
+from collections import defaultdict
 
 from telegram import Bot
 from telegram.error import TelegramError
 from telegram.ext import ApplicationBuilder
 
+from service.dedup_store import MediaDedupStore
 from service.dvach_service import DvachService
 from service.forchan_service import ForchanService
+from service.media_hash_index import MediaHashIndex
 from service.media_poster import post_media_from_queue
+from service.durable_media_queue import DurableMediaQueue
+from service.media_queue import MediaPriorityQueue
+from service.source_registry import SourceRegistry
 from service.tasks import job_collect_media
+from service.thread_ranker import ThreadRanker
+from utils.nsfw_pool import NsfwWorkerPool
+from utils.nsfw_verdict_cache import NsfwVerdictCache
+from utils.media_validator import MediaValidator
+from utils.rate_limiter import HostRateLimiter
 
 # Настройка логирования
 logging.basicConfig(
@@ -24,8 +35,32 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 TELEGRAM_CHANNEL_ID = os.environ.get("TELEGRAM_CHANNEL_ID", "-1002162401416")
 POST_INTERVAL = int(os.environ.get("TELEGRAM_POST_INTERVAL", "30"))
-FETCH_BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "1"))
+MIN_POST_INTERVAL = int(os.environ.get("TELEGRAM_MIN_POST_INTERVAL", "10"))
+FETCH_RPS = float(os.environ.get("FETCH_RPS", "1.0"))
+FETCH_BURST = float(os.environ.get("FETCH_BURST", "2"))
+FETCH_MAX_IN_FLIGHT = int(os.environ.get("FETCH_MAX_IN_FLIGHT", "4"))
 FETCH_DELAY = int(os.environ.get("FETCH_DELAY", "40"))
+FETCH_MIN_DELAY = int(os.environ.get("FETCH_MIN_DELAY", "20"))
+FETCH_MAX_DELAY = int(os.environ.get("FETCH_MAX_DELAY", "600"))
+FETCH_TARGET_MEDIA = int(os.environ.get("FETCH_TARGET_MEDIA", "20"))
+RANK_TOP_K = int(os.environ.get("RANK_TOP_K", "50"))  # 0 — обходить все треды, только упорядочив их
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", "50"))
+MEDIA_MAX_AGE = int(os.environ.get("MEDIA_MAX_AGE", "3600"))
+MEDIA_QUEUE_PATH = os.environ.get("MEDIA_QUEUE_PATH", "media_queue.wal")  # Пусто — очередь только в памяти
+MEDIA_REQUEUE_DELAY = int(os.environ.get("MEDIA_REQUEUE_DELAY", "300"))  # Пауза перед повтором неотправленной группы
+# Опрашиваемые доски: источник:доска через запятую, источники — 2ch и 4chan
+COLLECT_SOURCES = os.environ.get("COLLECT_SOURCES", "2ch:b")
+DEDUP_DB_PATH = os.environ.get("DEDUP_DB_PATH", "posted_media.sqlite3")
+DEDUP_TTL_DAYS = int(os.environ.get("DEDUP_TTL_DAYS", "14"))
+DEDUP_MEMORY_ITEMS = int(os.environ.get("DEDUP_MEMORY_ITEMS", "50000"))
+PHASH_ENABLED = os.environ.get("PHASH_ENABLED", "1") == "1"
+PHASH_THRESHOLD = int(os.environ.get("PHASH_THRESHOLD", "6"))
+FORCHAN_MEDIA_URL = os.environ.get("FORCHAN_MEDIA_URL", "https://i.4cdn.org")
+NSFW_CHECK_ENABLED = os.environ.get("NSFW_CHECK_ENABLED", "0") == "1"
+NSFW_WORKERS = int(os.environ.get("NSFW_WORKERS", "2"))
+NSFW_THRESHOLD = float(os.environ.get("NSFW_THRESHOLD", "0.30"))
+NSFW_CACHE_ITEMS = int(os.environ.get("NSFW_CACHE_ITEMS", "20000"))
+NSFW_CACHE_PATH = os.environ.get("NSFW_CACHE_PATH", "nsfw_verdicts.sqlite3")
 
 # Проверка и логирование переменных окружения
 required_vars = ["BOT_TOKEN", "TELEGRAM_CHANNEL_ID"]
@@ -33,17 +68,37 @@ missing = [var for var in required_vars if not globals().get(var)]
 if missing:
     raise ValueError(f"Не заданы переменные окружения: {', '.join(missing)}")
 logger.info(", ".join(
-    f"{var}: {globals().get(var)}" for var in required_vars + ["POST_INTERVAL", "FETCH_BATCH_SIZE", "FETCH_DELAY"]))
+    f"{var}: {globals().get(var)}" for var in required_vars + ["POST_INTERVAL", "FETCH_RPS", "FETCH_MAX_IN_FLIGHT", "FETCH_DELAY", "COLLECT_SOURCES"]))
 
 # Создаем приложение
 application = ApplicationBuilder().token(BOT_TOKEN).build()
 bot: Bot = application.bot
 
 # Инициализация сервисов и ресурсов
-dvach = DvachService()
-forchan = ForchanService()
-posted_media = set()
-media_queue = asyncio.Queue()
+# Бакеты лимитера — по хостам, поэтому один лимитер на сборщиков, проверку и загрузку медиа
+# держит общий бюджет запросов к каждому хосту
+fetch_rate_limiter = HostRateLimiter(FETCH_RPS, capacity=FETCH_BURST)
+dvach = DvachService(limit_per_host=FETCH_MAX_IN_FLIGHT, rate_limiter=fetch_rate_limiter)
+forchan = ForchanService(limit_per_host=FETCH_MAX_IN_FLIGHT, rate_limiter=fetch_rate_limiter,
+                         media_base_url=FORCHAN_MEDIA_URL)
+posted_media = MediaDedupStore(DEDUP_DB_PATH, ttl_seconds=DEDUP_TTL_DAYS * 24 * 3600,
+                               memory_items=DEDUP_MEMORY_ITEMS)
+hash_index = MediaHashIndex(threshold=PHASH_THRESHOLD) if PHASH_ENABLED else None
+
+
+def media_headers(url):
+    """User-Agent и Referer источника, которому принадлежит медиа."""
+    return (forchan if url.startswith(forchan.MEDIA_BASE_URL) else dvach).media_headers()
+
+
+media_validator = MediaValidator(rate_limiter=fetch_rate_limiter, headers_for=media_headers)
+nsfw_pool = NsfwWorkerPool(workers=NSFW_WORKERS, rate_limiter=fetch_rate_limiter,
+                           headers_for=media_headers) if NSFW_CHECK_ENABLED else None
+verdict_cache = NsfwVerdictCache(NSFW_CACHE_ITEMS, path=NSFW_CACHE_PATH or None) if NSFW_CHECK_ENABLED else None
+if MEDIA_QUEUE_PATH:
+    media_queue = DurableMediaQueue(MEDIA_QUEUE_PATH, maxsize=MEDIA_QUEUE_SIZE, max_age=MEDIA_MAX_AGE)
+else:
+    media_queue = MediaPriorityQueue(maxsize=MEDIA_QUEUE_SIZE, max_age=MEDIA_MAX_AGE)
 
 
 async def send_anecdotes_task(bot, chat_gpt_client, channel_id):
@@ -63,29 +118,66 @@ async def send_anecdotes_task(bot, chat_gpt_client, channel_id):
         await asyncio.sleep(345)  # Ждём 345 секунд перед следующим анекдотом
 
 
-async def media_collector_task(dvach, posted_media, media_queue, fetch_batch_size, fetch_delay):
-    """Фоновая задача по сбору медиа с 2ch."""
-    while True:
-        logger.info("Запуск плановой задачи по сбору медиа...")
-        # job_collect_media должен быть асинхронным, убедитесь в этом или адаптируйте код
-        await job_collect_media(dvach, posted_media, media_queue, fetch_batch_size, fetch_delay)
-        logger.info(f"Количество элементов в очереди: {media_queue.qsize()}")
-        await asyncio.sleep(fetch_delay)
+def build_source_registry(sources_spec):
+    """
+    Собирает планировщик сбора из строки вида "2ch:b,4chan:b".
+    fetch_delay задаёт стартовый интервал, дальше он подстраивается под активность доски.
+    """
+    rankers = defaultdict(lambda: ThreadRanker(RANK_TOP_K))  # Своё состояние ранжирования у каждой доски 2ch
+    pollers = {
+        "2ch": lambda board, queue: job_collect_media(dvach, posted_media, queue, FETCH_MAX_IN_FLIGHT, hash_index,
+                                                      board=board,
+                                                      ranker=rankers[board]),
+        "4chan": lambda board, queue: forchan.collect_media(posted_media, queue, board,
+                                                            max_in_flight=FETCH_MAX_IN_FLIGHT,
+                                                            hash_index=hash_index),
+    }
+    registry = SourceRegistry(media_queue, min_interval=FETCH_MIN_DELAY, max_interval=FETCH_MAX_DELAY,
+                              initial_interval=FETCH_DELAY, target_media=FETCH_TARGET_MEDIA)
+    for item in filter(None, (part.strip() for part in sources_spec.split(","))):
+        name, _, board = item.partition(":")
+        if name not in pollers or not board:
+            raise ValueError(f"Неизвестный источник в COLLECT_SOURCES: {item!r}")
+        registry.register(name, board, pollers[name])
+    return registry
 
 
 async def post_init(application):
     """Функция, вызываемая после инициализации приложения, перед запуском поллинга."""
     # await check_chat_access(bot, TELEGRAM_CHANNEL_ID)
     # Запускаем фоновые задачи
+    if nsfw_pool is not None:
+        # Модель NudeNet загружается в воркерах в фоне, не задерживая старт поллинга
+        application.create_task(nsfw_pool.warm_up())
     # application.create_task(send_anecdotes_task(bot, chat_gpt_client, TELEGRAM_CHANNEL_ID))
-    application.create_task(post_media_from_queue(bot, TELEGRAM_CHANNEL_ID, POST_INTERVAL, media_queue))
-    application.create_task(media_collector_task(dvach, posted_media, media_queue, FETCH_BATCH_SIZE, FETCH_DELAY))
+    application.create_task(post_media_from_queue(bot, TELEGRAM_CHANNEL_ID, POST_INTERVAL, media_queue,
+                                                  MIN_POST_INTERVAL, nsfw_pool, NSFW_THRESHOLD, verdict_cache,
+                                                  media_validator, MEDIA_REQUEUE_DELAY))
+    application.create_task(source_registry.run())
     # application.create_task(dvach.review_thread_task(bot, chat_gpt_client, TELEGRAM_CHANNEL_ID))
     logger.info("Бот инициализирован и фоновые задачи запущены.")
 
 
-# Назначаем post_init коллбек
+async def post_shutdown(application):
+    """Функция, вызываемая при остановке приложения: закрывает HTTP-сессии и хранилища."""
+    await dvach.close()
+    await forchan.close()
+    await media_validator.close()
+    if nsfw_pool is not None:
+        await nsfw_pool.close()
+    if verdict_cache is not None:
+        verdict_cache.close()
+    posted_media.close()
+    if isinstance(media_queue, DurableMediaQueue):
+        media_queue.close()
+    logger.info("HTTP-сессии сервисов, хранилища и журнал очереди закрыты.")
+
+
+source_registry = build_source_registry(COLLECT_SOURCES)
+
+# Назначаем post_init и post_shutdown коллбеки
 application.post_init = post_init
+application.post_shutdown = post_shutdown
 
 if __name__ == "__main__":
     # Запускаем бота с помощью run_polling()
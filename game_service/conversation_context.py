@@ -0,0 +1,115 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Без tiktoken считаем ~3 символа на токен: для русского текста cl100k даёт 2.5–3.5
+CHARS_PER_TOKEN = 3
+BACKGROUND_PREFIX = "Ранее в игре: "
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста: точно через tiktoken, если он установлен, иначе оценка по длине."""
+    global _encoding
+    if not text:
+        return 0
+    if _encoding is None:
+        try:
+            import tiktoken  # Необязательная зависимость
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_tokens(text: str, max_tokens: int, keep_end=False) -> str:
+    """Обрезает текст до max_tokens токенов с начала или (keep_end) с конца."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    # Длина пропорциональна бюджету, затем добираем до точного попадания
+    length = len(text) * max_tokens // count_tokens(text)
+    while length > 0:
+        part = text[-length:] if keep_end else text[:length]
+        if count_tokens(part) <= max_tokens:
+            return part
+        length -= max(1, length // 20)
+    return ""
+
+
+class ConversationContext:
+    """
+    Контекст игры для промпта в пределах бюджета токенов.
+
+    Последние ходы идут в промпт дословно, им отводится всё, что осталось от бюджета за
+    вычетом summary_budget. Не поместившиеся ходы вырезаются из истории и копятся в folded;
+    когда их набирается на fold_tokens токенов, фоновая задача сворачивает их в сводку:
+    summarize(старая сводка, новые ходы) дополняет сводку, а не пересказывает всю игру
+    заново. Пока сводка не обновлена, вместо неё в промпт идут свёрнутые ходы, обрезанные
+    до того же summary_budget, поэтому размер промпта ограничен при любой длине партии.
+    """
+
+    def __init__(self, summary_budget=300, fold_tokens=None):
+        self.summary_budget = summary_budget
+        self.fold_tokens = summary_budget if fold_tokens is None else fold_tokens
+        self.summary = ""
+        self.folded = []
+        self._task = None
+
+    def build(self, history: list, budget: int) -> str:
+        """
+        Возвращает текст истории для промпта не длиннее budget токенов.
+        history обрезается на месте: в ней остаются только ходы, вошедшие в промпт дословно.
+        """
+        recent_budget = max(budget - self.summary_budget, 0)
+        kept, used = 0, 0
+        for turn in reversed(history):
+            cost = count_tokens(turn) + 1
+            if used + cost > recent_budget:
+                break
+            kept += 1
+            used += cost
+        if kept < len(history):
+            self.folded.extend(history[:len(history) - kept])
+            del history[:len(history) - kept]
+
+        lines = []
+        # Префикс и перенос строки после сводки тоже входят в бюджет
+        overhead = count_tokens(BACKGROUND_PREFIX) + 1
+        background = self._background(min(budget - used, self.summary_budget) - overhead)
+        if background:
+            lines.append(f"{BACKGROUND_PREFIX}{background}")
+        lines.extend(history)
+        return "\n".join(lines)
+
+    def _background(self, max_tokens):
+        if max_tokens <= 0:
+            return ""
+        if not self.folded:
+            return truncate_tokens(self.summary, max_tokens)
+        # Сводка ещё не догнала свёрнутые ходы: самое свежее важнее, обрезаем с начала
+        text = " ".join(filter(None, [self.summary, *self.folded]))
+        return truncate_tokens(text, max_tokens, keep_end=True)
+
+    def schedule_summary(self, summarize):
+        """Запускает фоновое обновление сводки, если свёрнутых ходов набралось на fold_tokens."""
+        if not self.folded or (self._task is not None and not self._task.done()):
+            return
+        if sum(count_tokens(turn) for turn in self.folded) < self.fold_tokens:
+            return
+        self._task = asyncio.ensure_future(self._update_summary(summarize, list(self.folded)))
+
+    async def _update_summary(self, summarize, turns):
+        try:
+            summary = await summarize(self.summary, turns)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сводку игры: {e!r}")
+            return
+        if not summary:
+            return
+        self.summary = truncate_tokens(summary.strip(), self.summary_budget)
+        del self.folded[:len(turns)]
@@ -1,42 +1,64 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 from game_service.rpg_command_handler import RPGGameCommandHandler
+from service.send_scheduler import retry_after_seconds
+
+GAME_STREAMING = os.environ.get("GAME_STREAMING", "1") == "1"
+# Telegram ограничивает частоту правок сообщений, чаще раза в секунду править не стоит
+GAME_EDIT_INTERVAL = float(os.environ.get("GAME_EDIT_INTERVAL", "1.0"))
+
+ERROR_TEXT = "Произошла ошибка при получении ответа от игрового мастера."
+
 
 class RPGGameBot:
-    """Класс для интеграции Telegram-бота с игрой."""
-    def __init__(self):
+    """
+    Класс для интеграции Telegram-бота с игрой.
+    Хэндлеры регистрируются с block=False: ожидание ответа ChatGPT одного игрока
+    не задерживает обработку обновлений остальных.
+
+    В потоковом режиме (streaming) ответ игрового мастера показывается по мере генерации:
+    сообщение правится не чаще раза в edit_interval секунд, кнопки прикрепляются, как только
+    блок ACTIONS дописан.
+    """
+    def __init__(self, streaming=GAME_STREAMING, edit_interval=GAME_EDIT_INTERVAL):
         self.command_handler = RPGGameCommandHandler()
+        self.streaming = streaming
+        self.edit_interval = edit_interval
 
     def register_handlers(self, application: Application):
         """Регистрируем хэндлеры."""
-        application.add_handler(CommandHandler("start", self.start))
-        application.add_handler(CallbackQueryHandler(self.handle_callback_query))
+        application.add_handler(CommandHandler("start", self.start, block=False))
+        application.add_handler(CallbackQueryHandler(self.handle_callback_query, block=False))
+
+    async def close(self):
+        """Закрывает HTTP-сессию игры; вызывается из post_shutdown приложения."""
+        await self.command_handler.close()
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает команду /start."""
         # Инициализируем состояние игры
         context.user_data['history'] = ["Игра началась."]
+        context.user_data.pop('context', None)  # Сводка прошлой партии больше не нужна
         context.user_data['action_mapping'] = {}
         context.user_data['current_action'] = 'default'  # Устанавливаем первое действие
 
-        characteristics = self.command_handler.get_characteristics()
         # Загрузка промпта для начального состояния
         prompt = self.command_handler.load_prompt("exploration")
         user_id = str(update.effective_user.id)  # Получаем ID пользователя
-        chat_response = self.command_handler.fetch_chat_response("start", prompt, context.user_data, user_id)
-
-        if not chat_response:
-            await update.message.reply_text(
-                "Произошла ошибка при получении ответа от игрового мастера.",
-            )
-            return
-
-        description, buttons, event_picture = self.command_handler.parse_response(chat_response, context.user_data)
+        if self.streaming:
+            # Сообщение, которое будет дописываться по мере генерации ответа
+            placeholder = await update.message.reply_text("Игровой мастер думает…")
+            show = placeholder.edit_text
+        else:
+            show = update.message.reply_text
         # Отправляем сообщение с характеристиками, описанием и ASCII-артом
-        await update.message.reply_text(
-            f"{characteristics}\n\n{description}\n\n{event_picture}",
-            reply_markup=buttons
-        )
+        await self.play_turn(show, "start", prompt, context, user_id)
 
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает нажатия на кнопки (CallbackQuery)."""
@@ -60,11 +82,9 @@ class RPGGameBot:
 
         # Обработка специальных действий
         if action_text == "Инвентарь":
-            inventory = self.command_handler.character["inventory"]
+            inventory = self.command_handler.get_inventory(user_id)
             if inventory:
-                inventory_items = "\n".join(
-                    [f"- {self.command_handler.item_pool[item_id]['name']}" for item_id in inventory]
-                )
+                inventory_items = "\n".join([f"- {name}" for name in inventory])
             else:
                 inventory_items = "Ваш инвентарь пуст."
             await query.edit_message_text(f"Ваш инвентарь:\n{inventory_items}")
@@ -73,7 +93,7 @@ class RPGGameBot:
             return
 
         if action_text == "Характеристики":
-            characteristics = self.command_handler.get_characteristics()
+            characteristics = self.command_handler.get_characteristics(user_id)
             await query.edit_message_text(f"{characteristics}")
             # Логирование события
             self.command_handler.log_event(user_id=user_id, action=action_text, response="Просмотр характеристик")
@@ -84,48 +104,20 @@ class RPGGameBot:
             next_action = self.command_handler.get_next_action(context.user_data)
             context.user_data['current_action'] = next_action
             prompt = self.command_handler.load_prompt(next_action)
-            chat_response = self.command_handler.fetch_chat_response("Продолжить", prompt, context.user_data, user_id)
-
-            if not chat_response:
-                await query.edit_message_text(
-                    "Произошла ошибка при получении ответа от игрового мастера.",
-                )
-                # Логирование ошибки
-                self.command_handler.log_event(user_id=user_id, action="Продолжить", response="",
-                                               error="Empty chat response")
-                return
-
-            description, buttons, event_picture = self.command_handler.parse_response(chat_response, context.user_data)
-            await query.edit_message_text(
-                f"{self.command_handler.get_characteristics()}\n\n{description}\n\n{event_picture}",
-                reply_markup=buttons
-            )
-            # Логирование события
-            self.command_handler.log_event(user_id=user_id, action="Продолжить", response=description)
+            description = await self.play_turn(query.edit_message_text, "Продолжить", prompt, context, user_id)
+            if description is not None:
+                # Логирование события
+                self.command_handler.log_event(user_id=user_id, action="Продолжить", response=description)
             return
 
         # Для остальных действий отправляем действие как пользовательский ввод в ChatGPT
         prompt_key = context.user_data.get('current_action', 'default')
         prompt = self.command_handler.load_prompt(prompt_key)
 
-        chat_response = self.command_handler.fetch_chat_response(action_text, prompt, context.user_data, user_id)
-
-        if not chat_response:
-            await query.edit_message_text(
-                "Произошла ошибка при получении ответа от игрового мастера.",
-            )
-            # Логирование ошибки
-            self.command_handler.log_event(user_id=user_id, action=action_text, response="",
-                                           error="Empty chat response")
-            return
-
-        description, buttons, event_picture = self.command_handler.parse_response(chat_response, context.user_data)
-
         # Отправляем ответ игроку с характеристиками, описанием и ASCII-артом
-        await query.edit_message_text(
-            f"{self.command_handler.get_characteristics()}\n\n{description}\n\n{event_picture}",
-            reply_markup=buttons
-        )
+        description = await self.play_turn(query.edit_message_text, action_text, prompt, context, user_id)
+        if description is None:
+            return
         # Логирование события
         self.command_handler.log_event(user_id=user_id, action=action_text, response=description)
 
@@ -133,3 +125,99 @@ class RPGGameBot:
         next_action = self.command_handler.get_next_action(context.user_data)
         context.user_data['current_action'] = next_action
 
+    async def play_turn(self, show, player_message: str, prompt: str, context: ContextTypes.DEFAULT_TYPE,
+                        user_id: str):
+        """
+        Запрашивает ход у игрового мастера и показывает его через show(text, reply_markup=...).
+        Возвращает описание хода или None, если ход не удался (игрок видит сообщение об ошибке)
+        либо отменён более новым нажатием того же игрока.
+        """
+        if self.streaming:
+            return await self._stream_turn(show, player_message, prompt, context, user_id)
+
+        chat_response = await self.command_handler.fetch_chat_response(player_message, prompt, context.user_data,
+                                                                        user_id)
+        if chat_response is None:
+            return None
+        if not chat_response:
+            await show(ERROR_TEXT)
+            # Логирование ошибки
+            self.command_handler.log_event(user_id=user_id, action=player_message, response="",
+                                           error="Empty chat response")
+            return None
+
+        description, buttons, event_picture = self.command_handler.parse_response(chat_response, context.user_data)
+        await show(
+            f"{self.command_handler.get_characteristics(user_id)}\n\n{description}\n\n{event_picture}",
+            reply_markup=buttons
+        )
+        return description
+
+    async def _stream_turn(self, show, player_message, prompt, context, user_id):
+        handler = self.command_handler
+        characteristics = handler.get_characteristics(user_id)
+        loop = asyncio.get_running_loop()
+        next_edit_at = 0.0
+        shown = None
+        buttons = None
+        text = ""
+        try:
+            async for text in handler.stream_chat_response(player_message, prompt, context.user_data, user_id):
+                description, actions, event_picture = handler.split_response(text)
+                if buttons is None and actions:
+                    buttons = handler.build_buttons(actions, context.user_data)
+                if not description or loop.time() < next_edit_at:
+                    continue
+                rendered = f"{characteristics}\n\n{description}\n\n{event_picture or ''}".rstrip()
+                if rendered == shown:
+                    continue
+                delay = await self._edit(show, rendered, buttons)
+                shown = rendered
+                next_edit_at = loop.time() + max(self.edit_interval, delay)
+        except asyncio.CancelledError:
+            if handler.superseded(user_id):
+                logging.info(f"User: {user_id}, Action: {player_message}: ход отменён более новым нажатием.")
+                return None
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            handler.log_event(user_id=user_id, action=player_message, response=text, error=repr(e))
+            await self._edit_final(show, ERROR_TEXT, None)
+            return None
+
+        description, actions, event_picture = handler.split_response(text)
+        if not description or not actions or not event_picture:
+            logging.error("Отсутствуют необходимые части в ответе.")
+            await self._edit_final(show, ERROR_TEXT, None)
+            return None
+        if buttons is None:
+            buttons = handler.build_buttons(actions, context.user_data)
+        context.user_data.setdefault('history', []).append(f"Система: {description}")
+
+        rendered = f"{characteristics}\n\n{description}\n\n{event_picture}"
+        await self._edit_final(show, rendered, buttons)
+        return description
+
+    async def _edit_final(self, show, text, buttons, max_attempts=5):
+        """
+        Итоговую правку (с кнопками или текстом ошибки) нельзя пропустить, иначе игрок
+        останется без кнопок: выжидаем flood-паузы Telegram, но не больше max_attempts раз.
+        """
+        for _ in range(max_attempts):
+            delay = await self._edit(show, text, buttons)
+            if not delay:
+                return True
+            await asyncio.sleep(delay)
+        logging.error(f"Итоговая правка сообщения не прошла за {max_attempts} попыток из-за flood control.")
+        return False
+
+    @staticmethod
+    async def _edit(show, text, buttons):
+        """Правит сообщение; возвращает паузу из RetryAfter (0 — правка прошла)."""
+        try:
+            await show(text, reply_markup=buttons)
+        except RetryAfter as e:
+            return retry_after_seconds(e)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        return 0.0
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class Item:
+    id: str
+    name: str
+    effect: str = "Предмет не оказывает эффекта."
+
+
+@dataclass(slots=True)
+class PlayerState:
+    """Персонаж одного игрока; inventory — предметы по id в порядке получения."""
+    user_id: str
+    name: str = "Игрок"
+    char_class: str = "Воин"
+    health: int = 100
+    stamina: int = 100
+    magic: int = 50
+    experience: int = 0
+    level: int = 1
+    inventory: dict = field(default_factory=dict)
+    skills: list = field(default_factory=list)
+
+    def to_record(self) -> str:
+        # asdict() рекурсивно копирует всё состояние и в разы медленнее явной сборки
+        record = {
+            "name": self.name, "char_class": self.char_class, "health": self.health, "stamina": self.stamina,
+            "magic": self.magic, "experience": self.experience, "level": self.level,
+            "inventory": [[item.id, item.name, item.effect] for item in self.inventory.values()],
+            "skills": self.skills,
+        }
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_record(cls, user_id: str, payload: str) -> "PlayerState":
+        record = json.loads(payload)
+        record["inventory"] = {item[0]: Item(*item) for item in record.get("inventory", [])}
+        return cls(user_id=user_id, **record)
+
+
+class PlayerStateStore:
+    """
+    Состояние персонажей по игрокам: LRU-кэш в памяти перед SQLite.
+
+    get() отдаёт персонажа из памяти (не больше memory_items записей), с диска или нового.
+    После изменения персонажа вызывается mark_dirty(): запись на диск откладывается на
+    flush_interval секунд и выполняется одной транзакцией для всех изменённых за это время
+    игроков. Изменённые, но ещё не записанные персонажи держатся до flush() и при вытеснении
+    из LRU, поэтому память ограничена memory_items плюс игроками, активными за flush_interval.
+    """
+
+    def __init__(self, path="game_players.sqlite3", memory_items=5000, flush_interval=2.0):
+        self.path = path
+        self.memory_items = memory_items
+        self.flush_interval = flush_interval
+        self._memory = OrderedDict()
+        self._dirty = {}
+        self._flush_handle = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS players (user_id TEXT PRIMARY KEY, state TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+        self._db.commit()
+        logger.info(f"Хранилище игроков открыто: {path}")
+
+    def get(self, user_id: str) -> PlayerState:
+        state = self._memory.get(user_id) or self._dirty.get(user_id)
+        if state is None:
+            row = self._db.execute("SELECT state FROM players WHERE user_id = ?", (user_id,)).fetchone()
+            state = PlayerState.from_record(user_id, row[0]) if row is not None else PlayerState(user_id)
+        self._remember(state)
+        return state
+
+    def mark_dirty(self, state: PlayerState):
+        self._dirty[state.user_id] = state
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()  # Вне event loop пишем сразу
+            return
+        self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Записывает всех изменённых персонажей одной транзакцией."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        now = time.time()
+        rows = [(user_id, state.to_record(), now) for user_id, state in self._dirty.items()]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO players (user_id, state, ts) VALUES (?, ?, ?)", rows)
+        self._dirty.clear()
+
+    def _remember(self, state):
+        self._memory[state.user_id] = state
+        self._memory.move_to_end(state.user_id)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        self.flush()
+        self._db.close()
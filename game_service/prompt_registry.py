@@ -0,0 +1,80 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_PROMPT = "Добро пожаловать в игру! Ваше приключение начинается здесь."
+
+
+class PromptRegistry:
+    """
+    Промпты игры в памяти: все файлы *.txt каталога читаются один раз при создании,
+    ключ — имя файла без расширения, текст хранится уже обрезанным.
+
+    get() отдаёт текст из памяти и не чаще раза в check_interval секунд сверяет
+    каталог (mtime и размер файлов): изменённые и новые файлы перечитываются, удалённые
+    забываются — правка промпта подхватывается без перезапуска. Для неизвестного ключа
+    отдаётся промпт default_key, а предупреждение пишется один раз на ключ.
+    """
+
+    def __init__(self, path, default_key="default", check_interval=2.0):
+        self.path = path
+        self.default_key = default_key
+        self.check_interval = check_interval
+        self._prompts = {}  # ключ -> (mtime_ns, размер, текст)
+        self._unknown = set()
+        self._checked_at = 0.0
+        self.reload()
+        logger.info(f"Загружено промптов из {path}: {len(self._prompts)}")
+
+    def keys(self):
+        return self._prompts.keys()
+
+    def get(self, key: str) -> str:
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self.reload()
+        entry = self._prompts.get(key)
+        if entry is not None:
+            return entry[2]
+        if key not in self._unknown:
+            self._unknown.add(key)
+            logger.warning(f"Промпт {key!r} не найден в {self.path}, используется {self.default_key!r}.")
+        entry = self._prompts.get(self.default_key)
+        return entry[2] if entry is not None else FALLBACK_PROMPT
+
+    def reload(self) -> int:
+        """Перечитывает изменившиеся файлы; возвращает число добавленных, изменённых и удалённых промптов."""
+        self._checked_at = time.monotonic()
+        try:
+            entries = [entry for entry in os.scandir(self.path) if entry.name.endswith(".txt") and entry.is_file()]
+        except FileNotFoundError:
+            logger.error(f"Каталог промптов {self.path} не найден.")
+            entries = []
+
+        seen = set()
+        changed = 0
+        for entry in entries:
+            key = entry.name[:-len(".txt")]
+            seen.add(key)
+            cached = self._prompts.get(key)
+            try:
+                stat = entry.stat()
+                if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                with open(entry.path, "r", encoding="utf-8") as file:
+                    text = file.read().strip()
+            except OSError as e:
+                logger.error(f"Не удалось прочитать промпт {entry.path}: {e}")
+                continue
+            self._prompts[key] = (stat.st_mtime_ns, stat.st_size, text)
+            self._unknown.discard(key)
+            changed += 1
+            if cached is not None:
+                logger.info(f"Промпт {key!r} перечитан.")
+
+        for key in self._prompts.keys() - seen:
+            del self._prompts[key]
+            changed += 1
+            logger.info(f"Промпт {key!r} удалён.")
+        return changed
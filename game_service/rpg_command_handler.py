@@ -1,16 +1,42 @@
+import asyncio
+import json
 import logging
 import os
-import requests
+import aiohttp
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 import re
 from datetime import datetime
 
+from game_service.conversation_context import ConversationContext, count_tokens
+from game_service.player_store import Item, PlayerStateStore
+from game_service.prompt_registry import PromptRegistry
+
+GAME_CHAT_TIMEOUT = float(os.environ.get("GAME_CHAT_TIMEOUT", "30"))
+GAME_CHAT_MAX_IN_FLIGHT = int(os.environ.get("GAME_CHAT_MAX_IN_FLIGHT", "16"))
+GAME_PROMPT_TOKENS = int(os.environ.get("GAME_PROMPT_TOKENS", "1500"))  # Бюджет промпта одного хода
+GAME_SUMMARY_TOKENS = int(os.environ.get("GAME_SUMMARY_TOKENS", "300"))  # Из него — на сводку прошлых ходов
+GAME_STATE_DB_PATH = os.environ.get("GAME_STATE_DB_PATH", "game_players.sqlite3")
+GAME_STATE_MEMORY_ITEMS = int(os.environ.get("GAME_STATE_MEMORY_ITEMS", "5000"))
+
 
 class RPGGameCommandHandler:
-    """Класс для обработки команд и взаимодействия с ChatGPT."""
-    BASE_CHATGPT_URL = "https://autochanpython-production.up.railway.app/chat"
+    """
+    Класс для обработки команд и взаимодействия с ChatGPT.
+
+    Ход игрока — один асинхронный POST в /chat через общую keep-alive сессию с ограничением
+    max_in_flight одновременных запросов и сроком timeout секунд на ход. Если игрок нажал
+    следующую кнопку, пока прежний ход ещё ждёт ответа, прежний запрос отменяется.
+    stream_chat_response() получает тот же ответ потоком (stream=true в /chat).
 
-    def __init__(self):
+    Промпт хода укладывается в prompt_tokens токенов: история игры собирается
+    ConversationContext из user_data['context'] — свежие ходы дословно, старые в сводке.
+    Персонажи хранятся по игрокам в PlayerStateStore (players) и переживают перезапуск.
+    """
+    BASE_CHATGPT_URL = os.environ.get("GAME_CHAT_URL", "https://autochanpython-production.up.railway.app/chat")
+
+    def __init__(self, timeout=GAME_CHAT_TIMEOUT, max_in_flight=GAME_CHAT_MAX_IN_FLIGHT,
+                 prompt_tokens=GAME_PROMPT_TOKENS, summary_tokens=GAME_SUMMARY_TOKENS,
+                 state_path=GAME_STATE_DB_PATH, state_memory_items=GAME_STATE_MEMORY_ITEMS):
         # Настройка логирования
         logging.basicConfig(
             level=logging.INFO,  # Уровень логирования: DEBUG, INFO, WARNING, ERROR, CRITICAL
@@ -21,18 +47,35 @@ class RPGGameCommandHandler:
 
         # Устанавливаем абсолютный путь к папке с промптами
         self.prompts_path = os.path.join(os.path.dirname(__file__), "prompts")
-        self.character = {
-            "name": "Игрок",
-            "class": "Воин",
-            "health": 100,
-            "stamina": 100,
-            "magic": 50,
-            "inventory": [],
-            "experience": 0,
-            "level": 1,
-            "skills": []
-        }
-        self.item_pool = {}  # Словарь для хранения предметов
+        # Промпты читаются с диска один раз и перечитываются при изменении файлов
+        self.prompts = PromptRegistry(self.prompts_path)
+        # Персонаж и инвентарь у каждого игрока свои
+        self.players = PlayerStateStore(state_path, memory_items=state_memory_items)
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.prompt_tokens = prompt_tokens
+        self.summary_tokens = summary_tokens
+        self._session = None
+        self._turns = {}  # user_id -> задача текущего запроса к ChatGPT
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию с пулом соединений; создаётся лениво внутри event loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self):
+        """Отменяет незавершённые ходы, закрывает HTTP-сессию и дописывает состояние игроков."""
+        for turn in self._turns.values():
+            turn.cancel()
+        self._turns.clear()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self.players.close()
 
     def get_next_action(self, user_data: dict) -> str:
         """Возвращает следующее действие в цикле на основе текущего состояния."""
@@ -58,82 +101,132 @@ class RPGGameCommandHandler:
 
     def load_prompt(self, action: str) -> str:
         """
-        Загружает промпт из файла на основе действия.
+        Возвращает промпт для действия из реестра промптов.
         :param action: Действие игрока (ключ).
         :return: Текст промпта или основной промпт по умолчанию.
         """
-        filename = f"{action}.txt"  # Только имя файла без пути
-        filepath = os.path.join(self.prompts_path, filename)
-        logging.info(f"Loading prompt from: {filepath}")  # Отладка
-        try:
-            with open(filepath, "r", encoding="utf-8") as file:
-                content = file.read().strip()
-                logging.debug(f"Prompt content:\n{content}")  # Отладка
-                return content
-        except FileNotFoundError:
-            logging.warning(f"Prompt file {filename} not found. Falling back to default prompt.")
-            return self.load_default_prompt()
+        return self.prompts.get(action)
 
     def load_default_prompt(self) -> str:
         """
-        Загружает основной промпт по умолчанию.
+        Возвращает основной промпт по умолчанию.
         """
-        default_filename = "default.txt"
-        default_filepath = os.path.join(self.prompts_path, default_filename)
-        logging.info(f"Loading default prompt from: {default_filepath}")  # Отладка
-        try:
-            with open(default_filepath, "r", encoding="utf-8") as file:
-                content = file.read().strip()
-                logging.debug(f"Default prompt content:\n{content}")  # Отладка
-                return content
-        except FileNotFoundError:
-            logging.error(f"Default prompt file {default_filename} not found.")
-            return "Добро пожаловать в игру! Ваше приключение начинается здесь."
-
-    def fetch_chat_response(self, player_message: str, prompt: str, user_data: dict, user_id: str) -> str:
-        """Отправляет запрос в ChatGPT и возвращает строковый ответ с учетом контекста."""
-        # Формируем полный промпт, включая историю
-        history = user_data.get('history', [])
-        limited_history = history[-10:]  # Ограничиваем историю последними 10 действиями
-        history_text = "\n".join(limited_history)
-        full_prompt = f"{prompt}\n\nИстория игры:\n{history_text}\n\nДействие игрока: {player_message}"
+        return self.prompts.get(self.prompts.default_key)
 
-        payload = {"player_message": player_message, "prompt": full_prompt}
+    async def fetch_chat_response(self, player_message: str, prompt: str, user_data: dict, user_id: str):
+        """
+        Отправляет запрос в ChatGPT и возвращает строковый ответ с учетом контекста.
+        Возвращает "" при ошибке или истечении срока и None, если ход отменён более новым
+        нажатием того же игрока (тогда отвечать игроку не нужно).
+        """
+        payload = {"player_message": player_message, "prompt": self.build_prompt(player_message, prompt, user_data)}
+
+        previous = self._turns.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()  # Игрок уже нажал следующую кнопку — прежний ответ не нужен
+        turn = self._turns[user_id] = asyncio.ensure_future(self._post_chat(payload))
         try:
-            response = requests.post(self.BASE_CHATGPT_URL, json=payload, timeout=10)
-            response.raise_for_status()
-            raw_response = response.text  # Используйте .text, если ответ не в формате JSON
+            raw_response = await turn
+        except asyncio.CancelledError:
+            if self._turns.get(user_id) is turn:
+                raise  # Отменён сам обработчик, а не более новым ходом
+            logging.info(f"User: {user_id}, Action: {player_message}: ход отменён более новым нажатием.")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Error during request: {e!r}")
+            self.log_event(user_id=user_id, action=player_message, response="", error=repr(e))
+            return ""
+        finally:
+            if self._turns.get(user_id) is turn:
+                del self._turns[user_id]
 
-            # Логирование полного ответа для отладки
-            logging.info(f"Raw ChatGPT Response: {raw_response}")
-            self.log_event(user_id=user_id, action=player_message, response=raw_response)
+        # Логирование полного ответа для отладки
+        self.log_event(user_id=user_id, action=player_message, response=raw_response)
+        return raw_response.get("response") or ""
 
-            # Проверка наличия необходимых тегов
-            response = requests.post(self.BASE_CHATGPT_URL, json=payload, timeout=10)
-            response.raise_for_status()
-            raw_response = response.json()
+    async def stream_chat_response(self, player_message: str, prompt: str, user_data: dict, user_id: str):
+        """
+        Потоковый вариант fetch_chat_response: асинхронный генератор накопленного текста ответа.
+        Ошибки соединения, срока и потока пробрасываются (aiohttp.ClientError, asyncio.TimeoutError,
+        ValueError). Более новый ход того же игрока отменяет задачу, читающую поток; после
+        CancelledError это проверяется через superseded(user_id).
+        """
+        payload = {"player_message": player_message, "prompt": self.build_prompt(player_message, prompt, user_data),
+                   "stream": True}
 
-            # Логирование полного ответа для отладки
-            logging.info(f"Raw ChatGPT Response: {raw_response}")
-            self.log_event(user_id="unknown", action=player_message, response=raw_response)
+        previous = self._turns.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = self._turns[user_id] = asyncio.current_task()
+        text = ""
+        try:
+            session = await self.get_session()
+            async with session.post(self.BASE_CHATGPT_URL, json=payload) as response:
+                response.raise_for_status()
+                event = None
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        if event == "error":
+                            raise ValueError(f"Поток ответа прерван: {data}")
+                        text += json.loads(data)["delta"]
+                        yield text
+                    else:
+                        event = None
+        finally:
+            if self._turns.get(user_id) is task:
+                del self._turns[user_id]
+        self.log_event(user_id=user_id, action=player_message, response=text)
 
-            # Проверка наличия необходимых тегов
-            game_event = raw_response.get("response")
+    def build_prompt(self, player_message: str, prompt: str, user_data: dict) -> str:
+        """
+        Формирует полный промпт хода, включая историю, в пределах prompt_tokens токенов
+        и запускает фоновое обновление сводки, если старые ходы вытеснены из истории.
+        """
+        context = user_data.get('context')
+        if context is None:
+            context = user_data['context'] = ConversationContext(self.summary_tokens)
+        template = f"{prompt}\n\nИстория игры:\n{{}}\n\nДействие игрока: {player_message}"
+        budget = self.prompt_tokens - count_tokens(template)
+        history_text = context.build(user_data.setdefault('history', []), budget)
+        context.schedule_summary(self.summarize)
+        return template.format(history_text)
 
-            return game_event
+    async def summarize(self, summary: str, turns: list) -> str:
+        """Дополняет сводку игры новыми ходами одним запросом к ChatGPT."""
+        events = "\n".join(turns)
+        payload = {
+            "player_message": f"Текущая сводка:\n{summary or 'пока пусто'}\n\nНовые события:\n{events}",
+            "prompt": self.prompts.get("summary")
+        }
+        response = await self._post_chat(payload)
+        return response.get("response") or ""
 
-        except (requests.RequestException, ValueError) as e:
-            logging.error(f"Error during request: {e}")
-            self.log_event(user_id=user_id, action=player_message, response="", error=str(e))
-            return ""
+    def superseded(self, user_id: str) -> bool:
+        """True, если текущую задачу игрока вытеснил более новый ход."""
+        task = self._turns.get(user_id)
+        return task is not None and task is not asyncio.current_task()
 
-    def parse_response(self, chat_response: str, user_data: dict) -> (str, InlineKeyboardMarkup, str):
+    async def _post_chat(self, payload):
+        session = await self.get_session()
+        async with session.post(self.BASE_CHATGPT_URL, json=payload) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    @staticmethod
+    def split_response(chat_response: str) -> (str, list, str):
         """
-        Парсит ответ ChatGPT и возвращает описание, кнопки и ASCII-арт.
         Извлекает содержимое между тегами DESCRIPTION, ACTIONS и EVENT_PICTURE.
+        Годится и для недописанного потокового ответа: описание берётся до ACTIONS или до конца
+        текста, действия — только когда блок закрыт тегом EVENT_PICTURE; отсутствующая часть — None.
         """
         # Регулярные выражения для поиска содержимого между тегами
-        description_pattern = r'DESCRIPTION:\s*(.*?)\s*ACTIONS:'
+        description_pattern = r'DESCRIPTION:\s*(.*?)\s*(?:ACTIONS:|$)'
         actions_pattern = r'ACTIONS:\s*(.*?)\s*EVENT_PICTURE:'
         event_picture_pattern = r'EVENT_PICTURE:\s*(.*)'
 
@@ -141,9 +234,16 @@ class RPGGameCommandHandler:
         actions_match = re.search(actions_pattern, chat_response, re.DOTALL | re.IGNORECASE)
         event_picture_match = re.search(event_picture_pattern, chat_response, re.DOTALL | re.IGNORECASE)
 
-        description = description_match.group(1).strip()
-        actions = [action.strip() for action in actions_match.group(1).split(',')]
-        event_picture = event_picture_match.group(1).strip()
+        description = description_match.group(1).strip() if description_match else None
+        actions = [action.strip() for action in actions_match.group(1).split(',')] if actions_match else None
+        event_picture = event_picture_match.group(1).strip() if event_picture_match else None
+        return description, actions, event_picture
+
+    def parse_response(self, chat_response: str, user_data: dict) -> (str, InlineKeyboardMarkup, str):
+        """
+        Парсит ответ ChatGPT и возвращает описание, кнопки и ASCII-арт.
+        """
+        description, actions, event_picture = self.split_response(chat_response)
 
         # Дополнительная проверка на наличие всех необходимых частей
         if not description or not actions or not event_picture:
@@ -154,6 +254,15 @@ class RPGGameCommandHandler:
                 ""
             )
 
+        buttons = self.build_buttons(actions, user_data)
+
+        # Обновляем историю
+        user_data.setdefault('history', []).append(f"Система: {description}")
+
+        return description, buttons, event_picture
+
+    def build_buttons(self, actions: list, user_data: dict) -> InlineKeyboardMarkup:
+        """Создаёт кнопки действий и сохраняет сопоставление их идентификаторов в user_data."""
         # Генерируем уникальные идентификаторы для действий
         action_mapping = {}
         buttons = []
@@ -166,51 +275,54 @@ class RPGGameCommandHandler:
         if 'action_mapping' not in user_data:
             user_data['action_mapping'] = {}
         user_data['action_mapping'].update(action_mapping)
+        return InlineKeyboardMarkup(buttons)
 
-        # Обновляем историю
-        user_data.setdefault('history', []).append(f"Система: {description}")
-
-        return description, InlineKeyboardMarkup(buttons), event_picture
-
-    def add_experience(self, amount: int):
+    def add_experience(self, user_id: str, amount: int):
         """Добавляет опыт и проверяет повышение уровня."""
-        self.character["experience"] += amount
-        max_experience = self.character["level"] * 100
-        if self.character["experience"] >= max_experience:
-            self.character["experience"] -= max_experience
-            self.character["level"] += 1
-            self.character["skills"].append(f"Новый навык {len(self.character['skills']) + 1}")
-
-    def add_to_inventory(self, item: dict):
+        character = self.players.get(user_id)
+        character.experience += amount
+        max_experience = character.level * 100
+        if character.experience >= max_experience:
+            character.experience -= max_experience
+            character.level += 1
+            character.skills.append(f"Новый навык {len(character.skills) + 1}")
+        self.players.mark_dirty(character)
+
+    def add_to_inventory(self, user_id: str, item: dict):
         """Добавляет предмет в инвентарь."""
         item_id = item.get("id")
         if item_id:
-            self.item_pool[item_id] = item  # Сохраняем предмет в пуле
-            self.character["inventory"].append(item_id)
+            character = self.players.get(user_id)
+            character.inventory[item_id] = Item(item_id, item.get("name", item_id),
+                                                item.get("effect", "Предмет не оказывает эффекта."))
+            self.players.mark_dirty(character)
 
-    def use_item(self, item_id: str) -> str:
+    def use_item(self, user_id: str, item_id: str) -> str:
         """Использует предмет из инвентаря."""
-        if item_id in self.item_pool:
-            item = self.item_pool[item_id]
-            effect = item.get("effect", "Предмет не оказывает эффекта.")
-            # Удаляем предмет из инвентаря
-            self.character["inventory"].remove(item_id)
-            del self.item_pool[item_id]
-            return f"Вы использовали предмет: {item['name']}. {effect}"
-        return "Такого предмета нет в вашем инвентаре."
-
-    def get_characteristics(self) -> str:
+        character = self.players.get(user_id)
+        # Удаляем предмет из инвентаря
+        item = character.inventory.pop(item_id, None)
+        if item is None:
+            return "Такого предмета нет в вашем инвентаре."
+        self.players.mark_dirty(character)
+        return f"Вы использовали предмет: {item.name}. {item.effect}"
+
+    def get_inventory(self, user_id: str) -> list:
+        """Возвращает названия предметов в инвентаре игрока."""
+        return [item.name for item in self.players.get(user_id).inventory.values()]
+
+    def get_characteristics(self, user_id: str) -> str:
         """Возвращает строку с текущими характеристиками персонажа."""
-        inventory = ", ".join([self.item_pool[item_id]["name"] for item_id in self.character["inventory"]]) if \
-        self.character["inventory"] else "пусто"
+        character = self.players.get(user_id)
+        inventory = ", ".join(self.get_inventory(user_id)) or "пусто"
         return (
-            f"Имя: {self.character['name']}\n"
-            f"Класс: {self.character['class']}\n"
-            f"Уровень: {self.character['level']}\n"
-            f"Опыт: {self.character['experience']} / {self.character['level'] * 100}\n"
-            f"Здоровье: {self.character['health']}\n"
-            f"Стамина: {self.character['stamina']}\n"
-            f"Магия: {self.character['magic']}\n"
+            f"Имя: {character.name}\n"
+            f"Класс: {character.char_class}\n"
+            f"Уровень: {character.level}\n"
+            f"Опыт: {character.experience} / {character.level * 100}\n"
+            f"Здоровье: {character.health}\n"
+            f"Стамина: {character.stamina}\n"
+            f"Магия: {character.magic}\n"
             f"Инвентарь: {inventory}\n"
-            f"Навыки: {', '.join(self.character['skills']) if self.character['skills'] else 'нет навыков'}"
+            f"Навыки: {', '.join(character.skills) if character.skills else 'нет навыков'}"
         )
@@ -1,17 +1,30 @@
 import os  # Добавьте этот импорт
+import shutil
+import tempfile
+
+# Каталог для метрик обоих процессов; задаётся до первого импорта prometheus_client
+METRICS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                                    os.path.join(tempfile.gettempdir(), "autochan_metrics"))
+shutil.rmtree(METRICS_DIR, ignore_errors=True)  # Значения прошлого запуска не должны суммироваться
+os.makedirs(METRICS_DIR, exist_ok=True)
+
 from multiprocessing import Process
-import asyncio
-from app.main import app  # Ваше FastAPI приложение
-from bot import application  # Ваш Telegram бот
-import uvicorn
 
+
+# Приложения импортируются внутри процессов: родителю не нужны ни FastAPI, ни telegram,
+# а каждый дочерний процесс загружает только свою часть
 def start_fastapi():
     """Запуск FastAPI сервера."""
+    import uvicorn
+    from app.main import app  # Ваше FastAPI приложение
+
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
 
 def start_bot():
     """Запуск Telegram-бота."""
-    asyncio.run(application.run_polling())
+    from bot import application  # Ваш Telegram бот
+
+    application.run_polling()  # Сам создаёт и закрывает event loop
 
 if __name__ == "__main__":
     # Создаём два процесса для запуска FastAPI и бота
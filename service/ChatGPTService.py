@@ -1,57 +1,190 @@
+import asyncio
+import json
 import logging
 import os
+import random
 import aiohttp
-from fastapi import FastAPI, HTTPException
+from fastapi import HTTPException
 from pydantic import BaseModel
 from typing import List
 
+from utils.metrics import FETCH_LATENCY
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# FastAPI приложение
-app = FastAPI()
+# Статусы OpenAI, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
 
 # Модель для входящих данных
 class UserInput(BaseModel):
     player_message: str  # Сообщение от игрока
     prompt: str          # Контекст (промпт) для ChatGPT
+    stream: bool = False  # Отдавать ответ потоком server-sent events по мере генерации
+
 
 # Класс для взаимодействия с OpenAI API
 class ChatGPTClient:
-    def __init__(self):
+    """
+    Клиент OpenAI Chat Completions с общей keep-alive сессией.
+
+    Одновременно выполняется не больше max_in_flight запросов, остальные ждут своей очереди.
+    На 429 и 5xx запрос повторяется с экспоненциальной задержкой со случайным разбросом
+    (или через Retry-After, если OpenAI его прислал). Каждый вызов ограничен сроком timeout
+    секунд на всё: ожидание слота, попытки и паузы между ними.
+    stream_response() отдаёт ответ по кускам по мере генерации; повторы в нём возможны
+    только до первого куска.
+    """
+    API_URL = "https://api.openai.com/v1/chat/completions"
+
+    def __init__(self, model="gpt-3.5-turbo", max_in_flight=8, timeout=30.0, max_attempts=3,
+                 base_backoff=0.5, max_backoff=8.0, max_tokens=2000, temperature=0.7):
         self.api_key = os.environ.get("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("Переменная окружения OPENAI_API_KEY не задана!")
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self._session = None
+        self._slots = asyncio.Semaphore(max_in_flight)
 
-    async def generate_response(self, messages: List[dict]):
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию с пулом соединений; создаётся лениво внутри event loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60, ttl_dns_cache=300),
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                }
+            )
+        return self._session
+
+    async def close(self):
+        """Закрывает общую HTTP-сессию."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def generate_response(self, messages: List[dict], timeout: float = None, temperature: float = None,
+                                cache=None):
         """
         Генерация ответа на основе списка сообщений.
         :param messages: Список сообщений для ChatGPT.
+        :param timeout: Срок на весь вызов в секундах, по умолчанию self.timeout.
+        :param cache: ChatResponseCache; если передан, одинаковые запросы обслуживаются из кэша.
         :return: Ответ от OpenAI.
         """
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature if temperature is None else temperature
         }
+        if cache is not None:
+            key = cache.make_key(self.model, messages, data["temperature"])
+            return await cache.get_or_generate(key, lambda: self._generate(data, timeout))
+        return await self._generate(data, timeout)
 
+    async def _generate(self, data, timeout):
+        try:
+            return await asyncio.wait_for(self._request_with_retries(data), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Запрос к OpenAI API не уложился в {timeout or self.timeout} с.")
+            raise HTTPException(status_code=504, detail="OpenAI API не ответил вовремя.")
+
+    async def stream_response(self, messages: List[dict], timeout: float = None, temperature: float = None):
+        """
+        Потоковая генерация: асинхронный генератор кусков текста ответа по мере их прихода.
+        :param timeout: Срок на весь поток в секундах, по умолчанию self.timeout.
+        """
         data = {
-            "model": "gpt-3.5-turbo",
+            "model": self.model,
             "messages": messages,
-            "max_tokens": 2000,
-            "temperature": 0.7
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature if temperature is None else temperature,
+            "stream": True
         }
+        deadline = asyncio.get_running_loop().time() + (timeout or self.timeout)
+        await self._within(deadline, self._slots.acquire())
+        try:
+            resp = await self._within(deadline, self._send_with_retries(data))
+            try:
+                while True:
+                    line = await self._within(deadline, resp.content.readline())
+                    if not line:
+                        break
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    chunk = line[5:].strip()
+                    if chunk == b"[DONE]":
+                        break
+                    delta = json.loads(chunk)['choices'][0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+            except (aiohttp.ClientError, ValueError, KeyError, IndexError) as e:
+                logger.error(f"Поток ответа OpenAI API оборвался: {e!r}")
+                raise HTTPException(status_code=502, detail="Поток ответа OpenAI API оборвался.")
+            finally:
+                resp.release()
+        finally:
+            self._slots.release()
 
+    async def _within(self, deadline, awaitable):
+        """Ждёт awaitable не дольше, чем до deadline (по часам event loop)."""
+        remaining = deadline - asyncio.get_running_loop().time()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data) as resp:
-                    if resp.status != 200:
-                        error = await resp.text()
-                        logger.error(f"API запрос не удался: {resp.status} {error}")
-                        raise HTTPException(status_code=resp.status, detail="Ошибка при запросе к OpenAI API")
-                    result = await resp.json()
-                    return result['choices'][0]['message']['content'].strip()
-        except Exception as e:
-            logger.exception(f"Ошибка при запросе к OpenAI API: {e}")
-            raise HTTPException(status_code=500, detail="Произошла ошибка при генерации ответа.")
+            return await asyncio.wait_for(awaitable, max(remaining, 0))
+        except asyncio.TimeoutError:
+            logger.error("Запрос к OpenAI API не уложился в срок.")
+            raise HTTPException(status_code=504, detail="OpenAI API не ответил вовремя.")
+
+    async def _request_with_retries(self, data):
+        async with self._slots:
+            resp = await self._send_with_retries(data)
+            async with resp:
+                result = await resp.json()
+            return result['choices'][0]['message']['content'].strip()
+
+    async def _send_with_retries(self, data):
+        """Отправляет запрос с повторами и возвращает открытый ответ со статусом 200."""
+        session = await self.get_session()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with FETCH_LATENCY.labels(source="openai").time():
+                    resp = await session.post(self.API_URL, json=data)
+                if resp.status == 200:
+                    return resp
+                async with resp:
+                    error = await resp.text()
+                    retry_after = resp.headers.get("Retry-After")
+                logger.error(f"API запрос не удался (попытка {attempt}): {resp.status} {error[:500]}")
+                if resp.status not in RETRYABLE_STATUSES:
+                    raise HTTPException(status_code=502, detail="OpenAI API отклонил запрос.")
+                if attempt == self.max_attempts:
+                    if resp.status == 429:
+                        raise HTTPException(status_code=429, detail="Превышен лимит запросов к OpenAI API.")
+                    raise HTTPException(status_code=502, detail="OpenAI API недоступен.")
+            except aiohttp.ClientError as e:
+                logger.error(f"Ошибка соединения с OpenAI API (попытка {attempt}): {e!r}")
+                if attempt == self.max_attempts:
+                    raise HTTPException(status_code=502, detail="Не удалось связаться с OpenAI API.")
+                retry_after = None
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+
+    def _backoff(self, attempt, retry_after=None):
+        """Retry-After от OpenAI или экспоненциальная задержка с полным случайным разбросом."""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1)))
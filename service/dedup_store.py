@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from utils.metrics import DEDUP_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+class MediaDedupStore:
+    """
+    Хранилище уже отправленных медиа с фиксированным бюджетом памяти.
+
+    Горячие ключи держатся в LRU-кэше в памяти (не больше memory_items записей),
+    все ключи пишутся в SQLite и переживают перезапуск. Записи старше ttl_seconds
+    считаются забытыми и периодически удаляются с диска.
+    Интерфейс повторяет set: `url in store`, `store.add(url)`, `store.update(urls)`.
+    """
+
+    def __init__(self, path="posted_media.sqlite3", ttl_seconds=14 * 24 * 3600, memory_items=50000,
+                 purge_interval=3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.memory_items = memory_items
+        self.purge_interval = purge_interval
+        self._memory = OrderedDict()
+        self._last_purge = 0.0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS posted_media (key BLOB PRIMARY KEY, ts REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS posted_media_ts ON posted_media (ts)")
+        self._db.commit()
+        self.purge_expired()
+        logger.info(f"Хранилище отправленных медиа открыто: {path}, записей: {len(self)}")
+
+    @staticmethod
+    def _key(url: str) -> bytes:
+        return hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+
+    def __contains__(self, url) -> bool:
+        found = self._contains(url)
+        DEDUP_LOOKUPS.labels(store="url", result="hit" if found else "miss").inc()
+        return found
+
+    def _contains(self, url) -> bool:
+        key = self._key(url)
+        now = time.time()
+        ts = self._memory.get(key)
+        if ts is None:
+            row = self._db.execute("SELECT ts FROM posted_media WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            ts = row[0]
+        if now - ts > self.ttl_seconds:
+            self._memory.pop(key, None)
+            return False
+        self._remember(key, ts)
+        return True
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM posted_media").fetchone()[0]
+
+    def add(self, url: str):
+        self.update([url])
+
+    def update(self, urls):
+        """Отмечает медиа как отправленные одной транзакцией."""
+        now = time.time()
+        keys = [self._key(url) for url in urls]
+        if not keys:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO posted_media (key, ts) VALUES (?, ?)",
+                [(key, now) for key in keys]
+            )
+        for key in keys:
+            self._remember(key, now)
+        if now - self._last_purge > self.purge_interval:
+            self.purge_expired()
+
+    def _remember(self, key, ts):
+        self._memory[key] = ts
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def purge_expired(self):
+        """Удаляет с диска записи старше TTL."""
+        self._last_purge = time.time()
+        with self._db:
+            deleted = self._db.execute(
+                "DELETE FROM posted_media WHERE ts < ?", (self._last_purge - self.ttl_seconds,)
+            ).rowcount
+        if deleted:
+            logger.info(f"Удалено устаревших записей об отправленных медиа: {deleted}")
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+from service.media_queue import MediaPriorityQueue
+from utils.media_utils import create_input_media
+
+logger = logging.getLogger(__name__)
+
+# Запись журнала: тип, длина данных, id группы, данные, crc32 заголовка и данных.
+# P — группа поставлена в очередь (данные — компактный JSON), A — группа обработана (без данных).
+_HEADER = struct.Struct("<cIQ")
+_CRC = struct.Struct("<I")
+_PUT = b"P"
+_ACK = b"A"
+
+
+class MediaJournal:
+    """
+    Append-only журнал очереди медиагрупп.
+
+    Постановка пишется в файл сразу, а fsync выполняется не чаще раза в fsync_interval
+    секунд, поэтому пачка групп одного обхода стоит одного fsync. Подтверждение синхронизируется
+    сразу: оно приходит раз в интервал отправки, и после рестарта отправленная группа не должна
+    уйти повторно. Подтверждённые записи вычищаются перезаписью файла при запуске и после
+    каждых compact_every подтверждений.
+    """
+
+    def __init__(self, path, fsync_interval=1.0, compact_every=1000):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.pending = {}  # id -> данные неподтверждённой группы, в порядке постановки
+        self.next_id = 1
+        self._file = None
+        self._dirty = False
+        self._last_fsync = 0.0
+        self._acked_since_compact = 0
+
+    def replay(self):
+        """
+        Читает журнал одним проходом и возвращает неподтверждённые группы {id: данные}.
+        Обрезанный или повреждённый хвост (запись, не дописанная до падения) отбрасывается.
+        """
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = b""
+
+        view = memoryview(data)
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            kind, length, record_id = _HEADER.unpack_from(data, offset)
+            body_end = offset + _HEADER.size + length
+            if body_end + _CRC.size > len(data) or \
+                    zlib.crc32(view[offset:body_end]) != _CRC.unpack_from(data, body_end)[0]:
+                break
+            if kind == _PUT:
+                self.pending[record_id] = bytes(view[offset + _HEADER.size:body_end])
+            else:
+                self.pending.pop(record_id, None)
+            self.next_id = max(self.next_id, record_id + 1)
+            offset = body_end + _CRC.size
+
+        if offset < len(data):
+            logger.warning(f"Журнал {self.path}: отброшен повреждённый хвост ({len(data) - offset} байт).")
+        self._rewrite()
+        return self.pending
+
+    def put(self, payload: bytes) -> int:
+        record_id = self.next_id
+        self.next_id += 1
+        self._append(_PUT, record_id, payload)
+        self.pending[record_id] = payload
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self.sync()
+        return record_id
+
+    def ack(self, record_id):
+        if self.pending.pop(record_id, None) is None:
+            return
+        self._append(_ACK, record_id)
+        self.sync()
+        self._acked_since_compact += 1
+        if self._acked_since_compact >= self.compact_every:
+            self._rewrite()
+
+    def sync(self):
+        if self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _append(self, kind, record_id, payload=b""):
+        record = _HEADER.pack(kind, len(payload), record_id) + payload
+        self._file.write(record + _CRC.pack(zlib.crc32(record)))
+        self._file.flush()
+        self._dirty = True
+
+    def _rewrite(self):
+        """Атомарно заменяет журнал файлом только с неподтверждёнными группами."""
+        if self._file is not None:
+            self._file.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as file:
+            for record_id, payload in self.pending.items():
+                record = _HEADER.pack(_PUT, len(payload), record_id) + payload
+                file.write(record + _CRC.pack(zlib.crc32(record)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "ab")
+        self._dirty = False
+        self._acked_since_compact = 0
+
+
+class _StoredGroup:
+    """Группа, восстановленная из журнала: InputMedia собираются только при выдаче отправителю."""
+    __slots__ = ("record_id", "urls", "caption")
+
+    def __init__(self, record_id, urls, caption):
+        self.record_id = record_id
+        self.urls = urls
+        self.caption = caption
+
+
+class DurableMediaQueue(MediaPriorityQueue):
+    """
+    MediaPriorityQueue, переживающая рестарт: каждая группа до выдачи отправителю
+    записана в MediaJournal, а удаляется из него только через ack() — после отправки
+    в Telegram или окончательного отказа. При запуске неподтверждённые группы
+    восстанавливаются с прежними источником, приоритетом и возрастом.
+
+    В журнал группа пишется как ссылки и подпись. При восстановлении объекты InputMedia
+    не создаются (это самая дорогая часть), а собираются по одной группе в get().
+    """
+
+    def __init__(self, path, maxsize=0, max_age=None, fsync_interval=1.0):
+        super().__init__(maxsize, max_age)
+        self.journal = MediaJournal(path, fsync_interval)
+        self._record_ids = {}  # id(группы) -> (id записи, группа)
+
+        started = time.perf_counter()
+        pending = self.journal.replay()
+        wall_now, monotonic_now = time.time(), time.monotonic()
+        for record_id, payload in pending.items():
+            record = json.loads(payload)
+            stored = _StoredGroup(record_id, record["m"], record["c"])
+            self._push(record["s"], record["p"], stored, monotonic_now - (wall_now - record["t"]))
+        if pending:
+            logger.info(f"Из журнала {path} восстановлено медиагрупп: {len(pending)} "
+                        f"за {(time.perf_counter() - started) * 1000:.1f} мс.")
+
+    def _put(self, item):
+        source, score, media_group = item
+        payload = json.dumps({
+            "s": source,
+            "p": score,
+            "t": time.time(),
+            "m": [media.media for media in media_group],
+            "c": media_group[0].caption if media_group else None,
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        record_id = self.journal.put(payload)
+        self._record_ids[id(media_group)] = (record_id, media_group)
+        super()._put(item)
+
+    def _get(self):
+        media_group = super()._get()
+        if isinstance(media_group, _StoredGroup):
+            stored = media_group
+            media_group = [create_input_media(url, stored.caption if idx == 0 else None)
+                           for idx, url in enumerate(stored.urls)]
+            self._record_ids[id(media_group)] = (stored.record_id, media_group)
+            self._taken[id(media_group)] = self._taken.pop(id(stored))
+        return media_group
+
+    def ack(self, media_group):
+        super().ack(media_group)
+        if isinstance(media_group, _StoredGroup):  # Устаревшая группа из журнала
+            self.journal.ack(media_group.record_id)
+            return
+        entry = self._record_ids.pop(id(media_group), None)
+        if entry is not None:
+            self.journal.ack(entry[0])
+
+    def close(self):
+        self.journal.close()
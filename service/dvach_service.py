@@ -1,9 +1,12 @@
 import asyncio
 import hashlib
 import logging
+from collections import defaultdict
 
 import aiohttp
-import requests
+
+from service.thread_watermarks import ThreadWatermarkStore
+from utils.metrics import FETCH_LATENCY
 
 # Настройка логирования
 logging.basicConfig(
@@ -12,14 +15,77 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 logger = logging.getLogger(__name__)
-import time
+
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+              "Chrome/122.0.0.0 Safari/537.36")
+
+# Ошибки, при которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
 
 
 class DvachService:
     BASE_URL = "https://2ch.su"
 
-    def __init__(self):
+    def __init__(self, limit_per_host=4, request_timeout=30, rate_limiter=None):
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.limit_per_host = limit_per_host
+        self.rate_limiter = rate_limiter
+        self.request_timeout = request_timeout
+        self._session = None
+        # Номера тредов уникальны только в пределах доски, поэтому водяные знаки — по доскам
+        self.watermarks = defaultdict(ThreadWatermarkStore)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Возвращает общую keep-alive сессию с пулом соединений на хост.
+        Сессия создаётся лениво, внутри работающего event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self._get_default_headers(),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        return self._session
+
+    async def close(self):
+        """Закрывает общую HTTP-сессию."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_json(self, url, max_retries=3, delay=6):
+        """
+        Выполняет GET-запрос и возвращает JSON. Между попытками ждёт
+        с экспоненциальной задержкой, не блокируя event loop. Повторяются только
+        сетевые ошибки, таймауты, 429 и 5xx; остальные ответы 4xx сразу пробрасываются.
+        """
+        session = await self.get_session()
+        for attempt in range(max_retries):
+            self.logger.debug(f"Попытка {attempt + 1} из {max_retries} получить {url}.")
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(url)
+            try:
+                with FETCH_LATENCY.labels(source="2ch").time():
+                    async with session.get(url) as response:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status != 429 and e.status < 500:
+                    raise  # 404 у удалённого треда и прочие 4xx повтор не исправит
+                self.logger.error(f"Ошибка при запросе {url}: {e!r}")
+                if attempt < max_retries - 1:
+                    backoff = delay * (2 ** attempt)
+                    self.logger.info(f"Повторная попытка через {backoff} секунд.")
+                    await asyncio.sleep(backoff)
+                else:
+                    self.logger.error(f"Исчерпаны попытки запроса {url}.")
+                    raise
 
     import logging
 
@@ -82,7 +148,7 @@ class DvachService:
                 # Генерация рецензии
                 logger.info(f"Генерация рецензии для треда {thread_num_}...")
                 response = await chat_gpt_client.generate_response(messages)
-                thread_url = f"{BASE_URL}/b/res/{thread_num_}.html"
+                thread_url = f"{dvach.BASE_URL}/b/res/{thread_num_}.html"
                 final_response = f"Ссылка на тред: {thread_url}\n==================================\n{response}"
                 # Отправка рецензии в Telegram
                 logger.info(f"Отправляем рецензию на тред {thread_num_} в канал...")
@@ -97,14 +163,14 @@ class DvachService:
 
     async def get_new_threads(self, board: str) -> list:
         """Получает список тредов для указанной доски."""
-        url = f"{BASE_URL}/{board}/catalog.json"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка при загрузке каталога: {response.status}")
-                    return []
-                data = await response.json()
-                return data.get("threads", [])
+        url = f"{self.BASE_URL}/{board}/catalog.json"
+        session = await self.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                logger.error(f"Ошибка при загрузке каталога: {response.status}")
+                return []
+            data = await response.json(content_type=None)
+            return data.get("threads", [])
 
     def read_file_line_by_line(self,filename):
         with open(filename, "r", encoding="utf-8") as file:
@@ -117,106 +183,171 @@ class DvachService:
 
     async def get_thread_content(self, thread_id: str) -> dict:
         """Получает содержимое треда по ID."""
-        url = f"{BASE_URL}/b/res/{thread_id}.json"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка при загрузке треда {thread_id}: {response.status}")
-                    return {}
-                return await response.json()
+        url = f"{self.BASE_URL}/b/res/{thread_id}.json"
+        session = await self.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                logger.error(f"Ошибка при загрузке треда {thread_id}: {response.status}")
+                return {}
+            return await response.json(content_type=None)
 
     async def fetch_threads(self, board="b", max_retries=3, delay=6):
         url = f"{self.BASE_URL}/{board}/threads.json"
         self.logger.info(f"Попытка получить список тредов с {url}")
 
-        for attempt in range(max_retries):
-            self.logger.debug(f"Попытка {attempt + 1} из {max_retries} получить треды.")
-            try:
-                response = requests.get(url, headers=self._get_default_headers())
-                response.raise_for_status()
-                data_json = response.json()
-                self.logger.debug(
-                    f"Ответ получен. Ключи: {list(data_json.keys()) if isinstance(data_json, dict) else 'не dict'}")
-                threads = data_json.get("threads", [])
-                self.logger.info(f"Получено тредов: {len(threads)}")
-                return threads
-            except requests.exceptions.HTTPError as e:
-                self.logger.error(f"HTTP Error при получении тредов с {url}: {e}")
-                if attempt < max_retries - 1:
-                    self.logger.info(f"Повторная попытка через {delay} секунд.")
-                    time.sleep(delay)
-                else:
-                    self.logger.exception("Исчерпаны попытки получения тредов.")
-                    raise
-            except Exception as e:
-                self.logger.exception(f"Неожиданная ошибка при получении тредов: {e}")
-                raise
+        try:
+            data_json = await self._get_json(url, max_retries=max_retries, delay=delay)
+        except RETRYABLE_ERRORS:
+            self.logger.exception("Исчерпаны попытки получения тредов.")
+            raise
+        except Exception as e:
+            self.logger.exception(f"Неожиданная ошибка при получении тредов: {e}")
+            raise
+
+        self.logger.debug(
+            f"Ответ получен. Ключи: {list(data_json.keys()) if isinstance(data_json, dict) else 'не dict'}")
+        threads = data_json.get("threads", [])
+        self.logger.info(f"Получено тредов: {len(threads)}")
+        return threads
+
+    async def fetch_thread_data(self, num, board="b", max_retries=3, delay=10):
+        posts = await self._fetch_thread_posts(num, board, max_retries, delay)
+        if not posts:
+            return None
 
-    def fetch_thread_data(self, num, board="b", max_retries=3, delay=10):
+        op_post = posts[0]
+        op_comment = op_post.get("comment", "Без текста")
+
+        media_urls = self._extract_media_urls(posts)
+
+        self.logger.info(
+            f"Тред {num} получен: ОП-комментарий длиной {len(op_comment)} символов, медиафайлов: {len(media_urls)}")
+
+        return {
+            "caption": op_comment,
+            "media": media_urls,
+            "thumbnails": self._extract_thumbnails(posts),
+            "last_num": self._last_post_num(posts)
+        }
+
+    async def fetch_thread_updates(self, thread: dict, board="b", max_retries=3, delay=10):
+        """
+        Инкрементально получает новые медиа треда по водяному знаку.
+        Возвращает None, если тред не изменился с прошлого цикла. Для нового треда
+        загружается res/{num}.json целиком, для известного — только посты после
+        последнего увиденного.
+        """
+        num = thread.get("num")
+        watermarks = self.watermarks[board]
+        if watermarks.is_unchanged(thread):
+            self.logger.debug(f"Тред {num} не изменился, пропускаем.")
+            return None
+
+        mark = watermarks.get(num)
+        if mark is None or mark["last_num"] is None:
+            t_data = await self.fetch_thread_data(num, board, max_retries, delay)
+            if not t_data:
+                return None
+            last_num = t_data["last_num"]
+        else:
+            posts = await self.fetch_posts_after(num, mark["last_num"], board, max_retries, delay)
+            media_urls = self._extract_media_urls(posts)
+            last_num = self._last_post_num(posts) or mark["last_num"]
+            self.logger.info(f"Тред {num}: новых постов {len(posts)}, медиафайлов: {len(media_urls)}")
+            t_data = {
+                "caption": thread.get("comment", "Без текста"),
+                "media": media_urls,
+                "thumbnails": self._extract_thumbnails(posts),
+                "last_num": last_num
+            }
+
+        watermarks.update(num, last_num, thread.get("posts_count"), thread.get("lasthit"))
+        return t_data
+
+    async def fetch_posts_after(self, num, after_num, board="b", max_retries=3, delay=10):
+        """Возвращает посты треда с номерами строго больше after_num."""
+        url = f"{self.BASE_URL}/api/mobile/v2/after/{board}/{num}/{int(after_num) + 1}"
+        self.logger.info(f"Попытка получить новые посты треда {num} после {after_num} с {url}")
+        data = await self._get_json(url, max_retries=max_retries, delay=delay)
+        posts = data.get("posts") if isinstance(data, dict) else None
+        if not isinstance(posts, list):
+            self.logger.warning(f"Некорректный ответ для новых постов треда {num}: {data}")
+            return []
+        return [p for p in posts if self._post_num(p) > int(after_num)]
+
+    async def _fetch_thread_posts(self, num, board="b", max_retries=3, delay=10):
+        """Загружает res/{num}.json и возвращает список постов треда."""
         url = f"{self.BASE_URL}/{board}/res/{num}.json"
         self.logger.info(f"Попытка получить данные треда {num} с {url}")
 
-        for attempt in range(max_retries):
-            self.logger.debug(f"Попытка {attempt + 1} из {max_retries} получить данные треда {num}.")
-            try:
-                response = requests.get(url, headers=self._get_default_headers())
-                response.raise_for_status()
-                data = response.json()
-                self.logger.debug(
-                    f"Ответ для треда {num} получен. Ключи: {list(data.keys()) if isinstance(data, dict) else 'не dict'}")
-
-                threads_data = data.get("threads", [])
-                if not threads_data:
-                    self.logger.warning(f"threads_data отсутствуют или пусты для треда {num}, данные: {data}")
-                    return None
-
-                if not isinstance(threads_data, list) or len(threads_data) == 0:
-                    self.logger.warning(f"threads_data не список или пуст для треда {num}. data: {data}")
-                    return None
-
-                thread_info = threads_data[0]
-                posts = thread_info.get("posts", [])
-                if not posts:
-                    self.logger.warning(
-                        f"Посты отсутствуют в треде {num}, thread_info ключи: {list(thread_info.keys())}, data: {data}")
-                    return None
-
-                op_post = posts[0]
-                op_comment = op_post.get("comment", "Без текста")
-
-                media_urls = []
-                files_found = 0
-                for post in posts:
-                    p_num = post.get("num", "Unknown")
-                    files = post.get("files", [])
-                    if not isinstance(files, list):
-                        self.logger.debug(f"Поле 'files' в посте {p_num} не является списком: {files}")
-                        continue
-                    for f in files:
-                        file_path = f.get("path")
-                        if file_path:
-                            full_url = f"{self.BASE_URL}{file_path}"
-                            media_urls.append(full_url)
-                            files_found += 1
-
-                self.logger.info(
-                    f"Тред {num} получен: ОП-комментарий длиной {len(op_comment)} символов, медиафайлов: {files_found}")
-
-                return {
-                    "caption": op_comment,
-                    "media": media_urls
-                }
-            except requests.exceptions.HTTPError as e:
-                self.logger.error(f"HTTP Error при получении треда {num}: {e}")
-                if attempt < max_retries - 1:
-                    self.logger.info(f"Повторная попытка через {delay} секунд.")
-                    time.sleep(delay)
-                else:  #
-                    self.logger.exception("Исчерпаны попытки получения данных треда {thread_num}.")
-                    raise
-            except Exception as e:
-                self.logger.exception(f"Неожиданная ошибка при обработке данных треда {num}: {e}")
-                raise
+        try:
+            data = await self._get_json(url, max_retries=max_retries, delay=delay)
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status == 404:
+                self.logger.info(f"Тред {num} не найден (404), вероятно удалён.")
+            else:
+                self.logger.exception(f"Исчерпаны попытки получения данных треда {num}.")
+            raise
+        except Exception as e:
+            self.logger.exception(f"Неожиданная ошибка при обработке данных треда {num}: {e}")
+            raise
+
+        self.logger.debug(
+            f"Ответ для треда {num} получен. Ключи: {list(data.keys()) if isinstance(data, dict) else 'не dict'}")
+
+        threads_data = data.get("threads", [])
+        if not threads_data:
+            self.logger.warning(f"threads_data отсутствуют или пусты для треда {num}, данные: {data}")
+            return None
+
+        if not isinstance(threads_data, list) or len(threads_data) == 0:
+            self.logger.warning(f"threads_data не список или пуст для треда {num}. data: {data}")
+            return None
+
+        thread_info = threads_data[0]
+        posts = thread_info.get("posts", [])
+        if not posts:
+            self.logger.warning(
+                f"Посты отсутствуют в треде {num}, thread_info ключи: {list(thread_info.keys())}, data: {data}")
+            return None
+        return posts
+
+    def _extract_thumbnails(self, posts):
+        """Возвращает соответствие полной ссылки на файл ссылке на его превью."""
+        thumbnails = {}
+        for post in posts:
+            files = post.get("files", [])
+            if not isinstance(files, list):
+                continue
+            for f in files:
+                if f.get("path") and f.get("thumbnail"):
+                    thumbnails[f"{self.BASE_URL}{f['path']}"] = f"{self.BASE_URL}{f['thumbnail']}"
+        return thumbnails
+
+    @staticmethod
+    def _post_num(post):
+        try:
+            return int(post.get("num", 0))
+        except (TypeError, ValueError):
+            return 0
+
+    def _last_post_num(self, posts):
+        return max((self._post_num(p) for p in posts), default=None)
+
+    def _extract_media_urls(self, posts):
+        """Собирает полные ссылки на файлы из списка постов."""
+        media_urls = []
+        for post in posts:
+            p_num = post.get("num", "Unknown")
+            files = post.get("files", [])
+            if not isinstance(files, list):
+                self.logger.debug(f"Поле 'files' в посте {p_num} не является списком: {files}")
+                continue
+            for f in files:
+                file_path = f.get("path")
+                if file_path:
+                    media_urls.append(f"{self.BASE_URL}{file_path}")
+        return media_urls
 
     #
 
@@ -240,9 +371,9 @@ class DvachService:
         return 100 * (1 - len(compressed_text) / len(original_text))
 
     def _get_default_headers(self):
-        return {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-            "Referer": f"{self.BASE_URL}/b/",
-            "Accept": "application/json"
-        }
+        return {**self.media_headers(), "Accept": "application/json"}
+
+    def media_headers(self):
+        """Заголовки для запросов к медиа 2ch вне сессии сервиса: проверка и загрузка файлов."""
+        return {"User-Agent": USER_AGENT, "Referer": f"{self.BASE_URL}/b/"}
 
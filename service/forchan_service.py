@@ -1,130 +1,277 @@
-from utils.harkach_markup_converter import HarkachMarkupConverter
 import asyncio
 import logging
-import requests
+from collections import defaultdict
+
+import aiohttp
+
+from service.dvach_service import USER_AGENT
+from service.media_queue import MediaPriorityQueue
+from service.thread_watermarks import ThreadWatermarkStore
+from utils.harkach_markup_converter import HarkachMarkupConverter
 from utils.media_utils import create_input_media
+from utils.metrics import FETCH_LATENCY
+
+# Ошибки, при которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
 
 converter = HarkachMarkupConverter()
 
 
 class ForchanService:
+    """
+    Асинхронный клиент 4chan API.
+
+    Лишних загрузок избегает на двух уровнях: threads.json и треды запрашиваются с
+    If-Modified-Since (сервер отвечает 304 без тела), а по полю last_modified из threads.json
+    загружаются только изменившиеся треды. Из загруженного треда берутся медиа только
+    из постов после водяного знака.
+    """
     BASE_URL = "https://a.4cdn.org"
+    MEDIA_BASE_URL = "https://i.4cdn.org"
+    THREAD_BASE_URL = "https://boards.4chan.org"
 
-    def __init__(self):
+    def __init__(self, limit_per_host=4, request_timeout=30, rate_limiter=None, media_base_url=None):
         self.logger = logging.getLogger(self.__class__.__name__)
-
-    def fetch_threads(self, board_name="b"):
-        """Fetch a list of threads from the specified board."""
+        self.limit_per_host = limit_per_host
+        self.rate_limiter = rate_limiter
+        self.request_timeout = request_timeout
+        if media_base_url:
+            self.MEDIA_BASE_URL = media_base_url.rstrip("/")
+        self._session = None
+        # Номера тредов уникальны только в пределах доски, поэтому водяные знаки — по доскам
+        self.watermarks = defaultdict(ThreadWatermarkStore)
+        # Last-Modified последнего ответа по URL — для If-Modified-Since
+        self._last_modified = {}
+        # Последний полученный список тредов по доске: отдаётся при 304
+        self._threads = {}
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Возвращает общую keep-alive сессию с пулом соединений на хост.
+        Сессия создаётся лениво, внутри работающего event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        return self._session
+
+    def media_headers(self):
+        """Заголовки для запросов к медиа 4chan вне сессии сервиса: i.4cdn.org проверяет Referer."""
+        return {"User-Agent": USER_AGENT, "Referer": f"{self.THREAD_BASE_URL}/"}
+
+    async def close(self):
+        """Закрывает общую HTTP-сессию."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_json_if_modified(self, url, max_retries=3, delay=6):
+        """
+        Условный GET: отправляет If-Modified-Since из прошлого ответа.
+        Возвращает JSON или None, если ресурс не изменился (304). Повторяются только
+        сетевые ошибки, таймауты, 429 и 5xx; остальные ответы 4xx сразу пробрасываются.
+        """
+        session = await self.get_session()
+        headers = {}
+        if url in self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified[url]
+        for attempt in range(max_retries):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(url)
+            try:
+                with FETCH_LATENCY.labels(source="4chan").time():
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 304:
+                            return None
+                        response.raise_for_status()
+                        data = await response.json(content_type=None)
+                        if "Last-Modified" in response.headers:
+                            self._last_modified[url] = response.headers["Last-Modified"]
+                        return data
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status != 429 and e.status < 500:
+                    raise  # 404 у утонувшего треда и прочие 4xx повтор не исправит
+                self.logger.error(f"Ошибка при запросе {url}: {e!r}")
+                if attempt < max_retries - 1:
+                    backoff = delay * (2 ** attempt)
+                    self.logger.info(f"Повторная попытка через {backoff} секунд.")
+                    await asyncio.sleep(backoff)
+                else:
+                    self.logger.error(f"Исчерпаны попытки запроса {url}.")
+                    raise
+
+    async def fetch_threads(self, board_name="b"):
+        """
+        Возвращает список тредов доски: словари с no, last_modified и replies.
+        Если threads.json не изменился, отдаёт список из прошлого запроса.
+        """
         url = f"{self.BASE_URL}/{board_name}/threads.json"
-        try:
-            self.logger.info(f"Получение списка тредов с {url}")
-            response = requests.get(url)
-            response.raise_for_status()
-            threads_data = response.json()
-            threads = [t['no'] for page in threads_data for t in page['threads']]
-            self.logger.info(f"Получено тредов: {len(threads)} с доски /{board_name}/")
-            return threads
-        except Exception as e:
-            self.logger.exception(f"Ошибка при получении списка тредов с /{board_name}/: {e}")
-            return []
-
-    def fetch_thread_data(self, thread_id, board_name="b"):
-        """Fetch data from a specific thread, including media links."""
+        self.logger.info(f"Получение списка тредов с {url}")
+        threads_data = await self._get_json_if_modified(url)
+        if threads_data is None:
+            self.logger.info(f"Список тредов /{board_name}/ не изменился.")
+            return self._threads.get(board_name, [])
+
+        threads = [t for page in threads_data for t in page.get("threads", [])]
+        self._threads[board_name] = threads
+        self.logger.info(f"Получено тредов: {len(threads)} с доски /{board_name}/")
+        return threads
+
+    async def fetch_thread_data(self, thread_id, board_name="b"):
+        """
+        Загружает тред и извлекает медиа. Возвращает None, если тред не изменился
+        с прошлой загрузки (304).
+        """
         url = f"{self.BASE_URL}/{board_name}/thread/{thread_id}.json"
-        try:
-            self.logger.info(f"Получение данных треда {thread_id} с {url}")
-            response = requests.get(url)
-            response.raise_for_status()
-            thread_data = response.json()
-
-            op_post = thread_data['posts'][0]
-            op_comment = op_post.get('com', "Без текста")
-
-            media_urls = []
-            for post in thread_data['posts']:
-                if 'tim' in post and 'ext' in post:
-                    media_url = f"https://i.4cdn.org/{board_name}/{post['tim']}{post['ext']}"
-                    media_urls.append(media_url)
-
-            self.logger.info(f"Тред {thread_id} получен: ОП-комментарий длиной {len(op_comment)} символов, медиафайлов: {len(media_urls)}")
-
-            return {
-                "caption": op_comment,
-                "media": media_urls
-            }
-
-        except Exception as e:
-            self.logger.exception(f"Ошибка при обработке треда {thread_id} с /{board_name}/: {e}")
+        thread_data = await self._get_json_if_modified(url)
+        if thread_data is None:
+            self.logger.debug(f"Тред {thread_id} не изменился (304).")
+            return None
+
+        posts = thread_data.get("posts", [])
+        if not posts:
+            return None
+        op_comment = posts[0].get("com", "Без текста")
+        media_urls = self._extract_media_urls(posts, board_name)
+        self.logger.info(f"Тред {thread_id} получен: ОП-комментарий длиной {len(op_comment)} символов, "
+                         f"медиафайлов: {len(media_urls)}")
+        return {
+            "caption": op_comment,
+            "media": media_urls,
+            "thumbnails": self._extract_thumbnails(posts, board_name),
+            "posts": posts,
+            "last_num": posts[-1].get("no")
+        }
+
+    async def fetch_thread_updates(self, thread: dict, board_name="b"):
+        """
+        Возвращает медиа треда из постов после водяного знака или None, если
+        по last_modified из threads.json тред не менялся с прошлого обхода.
+        """
+        thread_id = thread.get("no")
+        watermarks = self.watermarks[board_name]
+        mark = watermarks.get(thread_id)
+        if mark is not None and mark["lasthit"] == thread.get("last_modified"):
+            return None
+
+        t_data = await self.fetch_thread_data(thread_id, board_name)
+        if t_data is None:
+            # 304: содержимое то же, запоминаем новый last_modified, чтобы не спрашивать снова
+            if mark is not None:
+                watermarks.update(thread_id, mark["last_num"], thread.get("replies"),
+                                       thread.get("last_modified"))
             return None
 
-    async def collect_media_periodically(self, posted_media, media_queue, board_name="b", max_group_size=6, delay=10):
+        if mark is not None and mark["last_num"] is not None:
+            new_posts = [p for p in t_data["posts"] if p.get("no", 0) > mark["last_num"]]
+            t_data["media"] = self._extract_media_urls(new_posts, board_name)
+        watermarks.update(thread_id, t_data["last_num"], thread.get("replies"), thread.get("last_modified"))
+        return t_data
+
+    def _forget_dead_threads(self, board_name, threads):
+        """Удаляет сохранённые Last-Modified утонувших тредов доски."""
+        prefix = f"{self.BASE_URL}/{board_name}/thread/"
+        alive = {f"{prefix}{t.get('no')}.json" for t in threads}
+        for url in [u for u in self._last_modified if u.startswith(prefix) and u not in alive]:
+            del self._last_modified[url]
+
+    def _extract_media_urls(self, posts, board_name):
+        return [f"{self.MEDIA_BASE_URL}/{board_name}/{post['tim']}{post['ext']}"
+                for post in posts if "tim" in post and "ext" in post]
+
+    def _extract_thumbnails(self, posts, board_name):
+        """Ссылки на превью ({tim}s.jpg) по ссылке на медиа — для перцептивного хэша."""
+        return {f"{self.MEDIA_BASE_URL}/{board_name}/{post['tim']}{post['ext']}":
+                f"{self.MEDIA_BASE_URL}/{board_name}/{post['tim']}s.jpg"
+                for post in posts if "tim" in post and "ext" in post}
+
+    async def collect_media(self, posted_media, media_queue, board_name="b", max_group_size=6, max_in_flight=4,
+                            hash_index=None):
+        """
+        Один обход доски: загружает только изменившиеся треды (не больше max_in_flight
+        одновременно) и ставит их новые медиа в очередь группами по max_group_size.
+        hash_index (MediaHashIndex) отсеивает визуальные дубликаты, в том числе уже
+        поставленные в очередь с 2ch.
+        Только первый элемент группы содержит caption со ссылкой на тред. Приоритет групп —
+        время последнего изменения треда, при заполненной очереди обход ждёт в put().
+        Возвращает количество медиа, поставленных в очередь.
+        """
+        threads = await self.fetch_threads(board_name)
+        self.watermarks[board_name].prune(t.get("no") for t in threads)
+        self._forget_dead_threads(board_name, threads)
+        pending = iter(threads)
+        media_found = 0
+
+        async def worker():
+            nonlocal media_found
+            for thread in pending:
+                try:
+                    media_found += await self._process_thread(thread, posted_media, media_queue, board_name,
+                                                              max_group_size, hash_index)
+                except Exception as e:
+                    self.logger.error(f"Ошибка при обработке треда {thread.get('no')}: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, max_in_flight))))
+        self.logger.info(f"Обход /{board_name}/ завершён: тредов {len(threads)}, новых медиа {media_found}.")
+        return media_found
+
+    async def _process_thread(self, thread, posted_media, media_queue, board_name, max_group_size, hash_index=None):
+        thread_id = thread.get("no")
+        thread_data = await self.fetch_thread_updates(thread, board_name)
+        if not thread_data or not thread_data.get("media"):
+            return 0
+
+        # Фильтруем уже отправленные медиа
+        all_media = [url for url in thread_data["media"] if url not in posted_media and not url.endswith(".webm")]
+        if not all_media:
+            self.logger.debug(f"Новых медиа в треде {thread_id} нет.")
+            return 0
+        posted_media.update(all_media)
+
+        # Отбрасываем перезаливы уже известных картинок, хэш считается по превью
+        if hash_index is not None:
+            session = await self.get_session()
+            all_media = await hash_index.filter_duplicates(session, all_media, thread_data.get("thumbnails"),
+                                                           self.rate_limiter)
+            if not all_media:
+                self.logger.debug(f"Все новые медиа треда {thread_id} оказались визуальными дубликатами.")
+                return 0
+
+        # Формируем ссылку на тред
+        thread_url = f"{self.THREAD_BASE_URL}/{board_name}/thread/{thread_id}"
+        formatted_link = f'\n===========\n<a href="{thread_url}">Ссылка на тред</a>'
+        caption = f"{converter.convert_to_tg_html(thread_data['caption'])}{formatted_link}"
+
+        score = thread.get("last_modified") or 0
+        for i in range(0, len(all_media), max_group_size):
+            media_group_urls = all_media[i:i + max_group_size]
+            media_group = [create_input_media(url, caption if idx == 0 else None)
+                           for idx, url in enumerate(media_group_urls)]
+            await media_queue.put(media_group, score)
+
+        self.logger.info(f"Тред {thread_id}: поставлено в очередь новых медиа: {len(all_media)}")
+        return len(all_media)
+
+    async def collect_media_periodically(self, posted_media, media_queue, board_name="b", max_group_size=6, delay=10,
+                                         max_in_flight=4):
         """
-        Периодически собирает медиа-ссылки и добавляет их в очередь группами по max_group_size.
-        Только первый элемент группы содержит caption с красивой ссылкой на тред.
+        Периодически собирает медиа с доски. Пауза delay выдерживается только между
+        обходами, темп запросов внутри обхода задаёт rate limiter.
         """
         while True:
             try:
                 self.logger.info(f"Начало сбора медиа с доски /{board_name}/...")
-                threads = self.fetch_threads(board_name)
-
-                for thread_id in threads:
-                    thread_data = self.fetch_thread_data(thread_id, board_name)
-
-                    if not thread_data or not thread_data.get("media"):
-                        self.logger.info(f"Нет медиа для треда {thread_id}")
-                        continue
-
-                    # Получаем все медиа из треда и фильтруем уже отправленные
-                    all_media = [url for url in thread_data["media"] if url not in posted_media and not url.endswith(".webm")]
-
-
-                    if not all_media:
-                        self.logger.info(f"Новых медиа в треде {thread_id} нет.")
-                        continue
-
-                    self.logger.info(f"Тред {thread_id}: найдено новых медиа: {len(all_media)}")
-
-                    # Формируем ссылку на тред
-                    thread_url = f"https://boards.4chan.org/{board_name}/thread/{thread_id}"
-                    formatted_link = f'\n===========\n<a href="{thread_url}">Ссылка на тред</a>'
-
-                    # Разбиваем медиа на группы по max_group_size
-                    for i in range(0, len(all_media), max_group_size):
-                        # Ожидаем, если очередь переполнена
-                        while media_queue.qsize() >= 21:
-                            self.logger.info("Очередь переполнена. Ожидание освобождения...")
-                            await asyncio.sleep(10)  # Проверяем каждые 10 секунд
-
-                        media_group_urls = all_media[i:i + max_group_size]
-
-                        # Конвертируем в InputMedia и добавляем caption только первому элементу
-                        media_group = []
-                        for idx, url in enumerate(media_group_urls):
-                            caption = None
-                            if idx == 0:  # Caption только для первого элемента группы
-                                thread_caption = converter.convert_to_tg_html(thread_data["caption"])
-                                caption = f"{thread_caption}{formatted_link}"
-
-                            media_group.append(create_input_media(url, caption))
-
-                        # Добавляем группу в очередь
-                        await media_queue.put(media_group)
-
-
-                    # Помечаем медиа как отправленные
-                    posted_media.update(all_media)
-
-                    self.logger.info(f"Тред {thread_id} полностью обработан.")
-
-                    # Задержка перед обработкой следующего треда
-                    await asyncio.sleep(25)
-
-                self.logger.info("Обработка всех тредов завершена. Ожидание перед новым циклом.")
-                await asyncio.sleep(delay)
-
+                await self.collect_media(posted_media, media_queue, board_name, max_group_size, max_in_flight)
             except Exception as e:
                 self.logger.exception(f"Ошибка при сборе медиа: {e}")
-                await asyncio.sleep(delay)
+            await asyncio.sleep(delay)
 
 
 # Пример использования:
@@ -133,7 +280,7 @@ if __name__ == "__main__":
     forchan_service = ForchanService()
 
     posted_media = set()
-    media_queue = asyncio.Queue()
+    media_queue = MediaPriorityQueue(maxsize=21).for_source("4chan/b")
 
     # Параметры
     board_name = "b"
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from collections import deque
+
+from utils.metrics import DEDUP_LOOKUPS
+from utils.perceptual_hash import BKTree, dhash
+
+logger = logging.getLogger(__name__)
+
+
+class MediaHashIndex:
+    """
+    Индекс перцептивных хэшей уже поставленных в очередь медиа.
+    Ловит одну и ту же картинку, перезалитую под другим путём, в другом треде или на другой борде.
+    Хэш считается по превью (если оно известно), чтобы не качать оригиналы.
+    Хранит не больше max_items последних хэшей.
+    """
+
+    def __init__(self, threshold=6, max_items=100000, max_concurrency=8):
+        self.threshold = threshold
+        self.max_items = max_items
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tree = BKTree()
+        self._recent = deque()
+        self.duplicates_dropped = 0
+
+    async def filter_duplicates(self, session, media_urls, thumbnails=None, rate_limiter=None):
+        """
+        Возвращает media_urls без визуальных дубликатов уже известных медиа.
+        Медиа, которые не удалось скачать или декодировать, пропускаются как есть.
+        rate_limiter (HostRateLimiter источника) — каждая загрузка превью берёт токен
+        хоста, как и запросы к API, чтобы хэширование не выходило за бюджет запросов.
+        """
+        thumbnails = thumbnails or {}
+        hashes = await asyncio.gather(
+            *(self._hash_url(session, thumbnails.get(url, url), rate_limiter) for url in media_urls)
+        )
+
+        unique = []
+        for url, value in zip(media_urls, hashes):
+            if value is None:
+                unique.append(url)
+                continue
+            match = self._tree.find_within(value, self.threshold)
+            DEDUP_LOOKUPS.labels(store="phash", result="miss" if match is None else "hit").inc()
+            if match is not None:
+                self.duplicates_dropped += 1
+                logger.info(f"Визуальный дубликат отброшен: {url} (hash {value:016x} ~ {match:016x})")
+                continue
+            self._add(value)
+            unique.append(url)
+        return unique
+
+    async def _hash_url(self, session, url, rate_limiter=None):
+        async with self._semaphore:
+            try:
+                if rate_limiter is not None:
+                    await rate_limiter.acquire(url)
+                async with session.get(url) as response:
+                    if response.status != 200:
+                        logger.debug(f"Не удалось скачать {url} для хэширования: {response.status}")
+                        return None
+                    data = await response.read()
+                return await asyncio.get_running_loop().run_in_executor(None, dhash, data)
+            except Exception as e:
+                logger.debug(f"Не удалось посчитать хэш {url}: {e}")
+                return None
+
+    def _add(self, value):
+        self._tree.add(value)
+        self._recent.append(value)
+        if len(self._recent) > self.max_items:
+            self._rebuild()
+
+    def _rebuild(self):
+        """BK-дерево не умеет удалять узлы, поэтому старые хэши выбрасываются перестройкой."""
+        while len(self._recent) > self.max_items // 2:
+            self._recent.popleft()
+        self._tree = BKTree()
+        for value in self._recent:
+            self._tree.add(value)
+        logger.info(f"Индекс перцептивных хэшей перестроен, хэшей: {len(self._tree)}")
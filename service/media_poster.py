@@ -3,32 +3,49 @@ import logging
 
 logger = logging.getLogger(__name__)  #
 
+from service.send_scheduler import TelegramSendScheduler
 from utils.media_utils import filter_accessible_media
+from utils.metrics import MEDIA_QUEUE_DEPTH
 
 
-async def post_media_from_queue(bot, channel_id, interval, media_queue):
+async def post_media_from_queue(bot, channel_id, interval, media_queue, min_interval=10, nsfw_pool=None,
+                                nsfw_threshold=0.30, verdict_cache=None, validator=None, requeue_delay=300):
+    """
+    Забирает медиагруппы из очереди и отправляет их в канал.
+    Темп отправки задаёт TelegramSendScheduler: interval — стартовый интервал,
+    дальше он подстраивается под flood control Telegram, но не опускается ниже min_interval.
+    Если передан nsfw_pool, медиа проходят проверку NudeNet перед отправкой,
+    verdict_cache переиспользует прошлые вердикты для уже виденного содержимого.
+    validator (MediaValidator) заранее отбрасывает медиа, из-за которых Telegram отклонил бы весь альбом.
+    Обработанная группа подтверждается через media_queue.ack(); если задачу прервут посреди
+    отправки, DurableMediaQueue вернёт группу в очередь после рестарта. Группа, которую не удалось
+    отправить из-за сетевых ошибок, не подтверждается, а через requeue_delay секунд возвращается в очередь.
+    """
+    scheduler = TelegramSendScheduler(bot, initial_interval=interval, min_interval=min_interval)
     while True:
+        media_group = None
         try:
             media_group = await media_queue.get()
+            MEDIA_QUEUE_DEPTH.set(media_queue.qsize())
             logger.info(f"Отправка медиагруппы: {media_group}")
 
             # Фильтрация доступных ссылок
-            filtered_media_group = await filter_accessible_media(media_group)
+            filtered_media_group = await filter_accessible_media(media_group, nsfw_pool, nsfw_threshold,
+                                                                 verdict_cache, validator)
             if not filtered_media_group:
                 logger.warning("Нет доступных медиа для отправки. Пропускаем группу.")
-                continue
-
-            # Отправка медиагруппы
-            await bot.send_media_group(chat_id=channel_id, media=filtered_media_group)
-            logger.info("Медиагруппа успешно отправлена.")#
-#
-        except asyncio.TimeoutError:
-            logger.warning("Отправка медиагруппы прервана по таймауту. Это не критическая ошибка.")
-        except Exception as e:
-            if "Timed out" in str(e):
-                logger.warning("Пропущена ошибка таймаута отправки медиагруппы. Продолжаем работу.")
             else:
-                logger.error(f"Ошибка при отправке медиагруппы: {e}")
-        finally:
-            await asyncio.sleep(interval)
-#
\ No newline at end of file
+                # Отправка медиагруппы
+                sent = await scheduler.send_media_group(channel_id, filtered_media_group)
+                if sent:
+                    logger.info("Медиагруппа успешно отправлена.")
+                elif sent is None:
+                    logger.warning(f"Медиагруппа вернётся в очередь через {requeue_delay} с.")
+                    media_queue.requeue(media_group, requeue_delay)
+                    continue
+        except Exception as e:
+            logger.error(f"Ошибка при отправке медиагруппы: {e}")
+        if media_group is None:
+            await asyncio.sleep(1)  # Очередь не выдала группу — не крутимся вхолостую
+            continue
+        media_queue.ack(media_group)
@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+
+from utils.metrics import MEDIA_GROUPS_EXPIRED, MEDIA_GROUPS_REQUEUED, MEDIA_QUEUE_DEPTH
+
+
+class MediaPriorityQueue(asyncio.Queue):
+    """
+    Ограниченная очередь медиагрупп с приоритетом и сроком годности.
+
+    - maxsize: сборщики ждут в put(), пока отправитель не освободит место, без опроса qsize();
+    - у каждой группы есть score (например, время последней активности треда): get() отдаёт
+      лучшую группу, при равном score — в порядке постановки, так что группы одного треда
+      не перемешиваются;
+    - у каждого источника своя подочередь, get() обходит источники по кругу и берёт лучшую
+      группу очередного источника, поэтому активная доска не вытесняет остальные;
+    - группы старше max_age секунд выбрасываются при выдаче и при нехватке места.
+
+    Источники кладут группы через for_source(name): представление с put(group, score).
+    Выданную, но не отправленную группу requeue() возвращает в её подочередь с задержкой.
+    """
+
+    def __init__(self, maxsize=0, max_age=None):
+        self.max_age = max_age
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._sources = OrderedDict()
+        self._size = 0
+        self._seq = itertools.count()
+        self._taken = {}  # id(выданной группы) -> (источник, score, время постановки)
+
+    # asyncio.Queue считает размер по self._queue, которого здесь нет
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def _put(self, item):
+        source, score, media_group = item
+        self._push(source, score, media_group, time.monotonic())
+
+    def _push(self, source, score, media_group, enqueued_at):
+        pending = self._sources.setdefault(source, [])
+        heapq.heappush(pending, (-score, next(self._seq), enqueued_at, media_group))
+        self._size += 1
+        MEDIA_QUEUE_DEPTH.set(self._size)
+
+    def _get(self):
+        # Первый непустой источник отдаёт лучшую группу и уходит в конец круга
+        for source, pending in self._sources.items():
+            if pending:
+                self._sources.move_to_end(source)
+                self._size -= 1
+                MEDIA_QUEUE_DEPTH.set(self._size)
+                neg_score, _, enqueued_at, media_group = heapq.heappop(pending)
+                self._taken[id(media_group)] = (source, -neg_score, enqueued_at)
+                return media_group
+        raise asyncio.QueueEmpty
+
+    async def put(self, item):
+        if self.full():
+            self._drop_expired()
+        await super().put(item)
+
+    def put_nowait(self, item):
+        if self.full():
+            self._drop_expired()
+        super().put_nowait(item)
+
+    async def get(self):
+        # asyncio.Queue.get() после пробуждения зовёт get_nowait(), а _drop_expired() мог уже
+        # опустошить очередь: ждём следующей группы сами, чтобы не получить QueueEmpty
+        while True:
+            self._drop_expired()
+            if not self.empty():
+                return super().get_nowait()
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if not self.empty() and not getter.cancelled():
+                    self._wakeup_next(self._getters)
+                raise
+
+    def get_nowait(self):
+        self._drop_expired()
+        return super().get_nowait()
+
+    def _drop_expired(self):
+        """Выбрасывает устаревшие группы и будит сборщиков, ждущих освободившегося места."""
+        if not self.max_age or not self._size:
+            return
+        deadline = time.monotonic() - self.max_age
+        dropped = 0
+        for pending in self._sources.values():
+            fresh = [entry for entry in pending if entry[2] >= deadline]
+            if len(fresh) != len(pending):
+                dropped += len(pending) - len(fresh)
+                for entry in pending:
+                    if entry[2] < deadline:
+                        self.ack(entry[3])
+                heapq.heapify(fresh)
+                pending[:] = fresh
+        if not dropped:
+            return
+        self._size -= dropped
+        MEDIA_QUEUE_DEPTH.set(self._size)
+        MEDIA_GROUPS_EXPIRED.inc(dropped)
+        for _ in range(dropped):
+            self._wakeup_next(self._putters)
+
+    def ack(self, media_group):
+        """
+        Отмечает группу обработанной: отправленной, отброшенной или устаревшей.
+        DurableMediaQueue вдобавок удаляет группу из журнала.
+        """
+        self._taken.pop(id(media_group), None)
+
+    def requeue(self, media_group, delay):
+        """
+        Через delay секунд возвращает выданную get() группу в её подочередь с прежними
+        score и возрастом, так что max_age продолжает действовать. Группа не подтверждается
+        и до возврата остаётся в журнале DurableMediaQueue; место в очереди она не ждёт.
+        """
+        source, score, enqueued_at = self._taken.pop(id(media_group))
+        asyncio.get_running_loop().call_later(delay, self._push_back, source, score, media_group, enqueued_at)
+        MEDIA_GROUPS_REQUEUED.inc()
+
+    def _push_back(self, source, score, media_group, enqueued_at):
+        if self.max_age and enqueued_at < time.monotonic() - self.max_age:
+            self.ack(media_group)  # Устарела, пока ждала повтора
+            MEDIA_GROUPS_EXPIRED.inc()
+            return
+        self._push(source, score, media_group, enqueued_at)
+        self._wakeup_next(self._getters)
+
+    def source_qsize(self, source):
+        """Сколько групп источника ждут отправки."""
+        return len(self._sources.get(source, ()))
+
+    def for_source(self, source):
+        return _SourceQueueView(self, source)
+
+
+class _SourceQueueView:
+    """Вход в MediaPriorityQueue от имени одного источника."""
+
+    def __init__(self, queue, source):
+        self.queue = queue
+        self.source = source
+
+    async def put(self, media_group, score=0):
+        await self.queue.put((self.source, score, media_group))
+
+    def put_nowait(self, media_group, score=0):
+        self.queue.put_nowait((self.source, score, media_group))
+
+    def qsize(self):
+        return self.queue.source_qsize(self.source)
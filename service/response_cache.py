@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from utils.metrics import CHAT_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+class ChatResponseCache:
+    """
+    Кэш ответов OpenAI с объединением одинаковых запросов в полёте.
+
+    Ключ — хэш нормализованных (модель, сообщения, temperature): у сообщений обрезаются
+    и схлопываются пробелы, поэтому запросы, отличающиеся только форматированием, совпадают.
+    В памяти держится не больше max_items ответов (LRU), ответ живёт ttl секунд.
+    Пока запрос по ключу выполняется, одинаковые запросы не идут в OpenAI, а ждут его
+    результата; ошибка достаётся всем ожидающим и не кэшируется.
+    """
+
+    def __init__(self, max_items=1000, ttl=600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()  # ключ -> (истекает в, ответ)
+        self._in_flight = {}  # ключ -> задача запроса
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(model, messages, temperature) -> str:
+        normalized = [
+            {"role": message["role"], "content": " ".join(str(message["content"]).split())}
+            for message in messages
+        ]
+        raw = json.dumps([model, normalized, round(float(temperature), 3)], ensure_ascii=False, separators=(",", ":"))
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses + self.coalesced
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    def stats(self) -> str:
+        return (f"попаданий {self.hits}, объединено {self.coalesced}, промахов {self.misses}, "
+                f"hit rate {self.hit_rate:.1%}")
+
+    async def get_or_generate(self, key, generate):
+        """
+        Возвращает ответ из кэша или вызывает generate() — корутинную функцию без аргументов.
+        Отмена одного из ожидающих не отменяет общий запрос.
+        """
+        entry = self._items.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                CHAT_CACHE_LOOKUPS.labels(result="hit").inc()
+                return entry[1]
+            del self._items[key]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            CHAT_CACHE_LOOKUPS.labels(result="coalesced").inc()
+        else:
+            self.misses += 1
+            CHAT_CACHE_LOOKUPS.labels(result="miss").inc()
+            task = self._in_flight[key] = asyncio.ensure_future(generate())
+            task.add_done_callback(lambda done: self._store(key, done))
+        return await asyncio.shield(task)
+
+    def _store(self, key, task):
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._items[key] = (time.monotonic() + self.ttl, task.result())
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import random
+import time
+
+from telegram import InputMediaVideo
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+from utils.metrics import GROUPS_SENT, TELEGRAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter.retry_after бывает int или timedelta в зависимости от версии PTB."""
+    retry_after = error.retry_after
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TelegramSendScheduler:
+    """
+    Планировщик отправки медиагрупп с учётом flood control Telegram.
+
+    Для каждого чата хранится свой интервал между отправками. Успешная отправка
+    понемногу ускоряет темп (до min_interval), RetryAfter замедляет его и выдерживает
+    паузу, указанную Telegram. Сетевые ошибки повторяются с экспоненциальной
+    задержкой; ожидание по RetryAfter не считается неудачной попыткой. Исчерпав max_attempts,
+    планировщик не выбрасывает группу, а сообщает, что её нужно отправить позже.
+    Таймаут (TimedOut) не повторяется: Telegram мог уже опубликовать группу, и повтор
+    выложил бы её второй раз, поэтому такая группа считается отправленной.
+    """
+
+    def __init__(self, bot, initial_interval=30.0, min_interval=10.0, max_interval=600.0,
+                 max_attempts=5, base_backoff=5.0, speedup=0.95, slowdown=1.5):
+        self.bot = bot
+        self.initial_interval = initial_interval
+        self.min_interval = min(min_interval, initial_interval)
+        self.max_interval = max_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.speedup = speedup
+        self.slowdown = slowdown
+        self._intervals = {}
+        self._next_allowed = {}
+
+    def interval(self, chat_id) -> float:
+        return self._intervals.get(chat_id, self.initial_interval)
+
+    async def _wait_turn(self, chat_id):
+        delay = self._next_allowed.get(chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _on_success(self, chat_id):
+        interval = max(self.min_interval, self.interval(chat_id) * self.speedup)
+        self._intervals[chat_id] = interval
+        self._next_allowed[chat_id] = time.monotonic() + interval
+
+    def _on_flood(self, chat_id, retry_after):
+        interval = min(self.max_interval, max(self.interval(chat_id) * self.slowdown, retry_after))
+        self._intervals[chat_id] = interval
+        self._next_allowed[chat_id] = time.monotonic() + retry_after
+        logger.warning(f"Flood control в чате {chat_id}: ждём {retry_after:.0f} с, новый интервал {interval:.1f} с.")
+
+    def _backoff(self, attempt) -> float:
+        return self.base_backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+
+    async def _send(self, chat_id, media):
+        # Альбом в Bot API — от 2 до 10 элементов, одиночное медиа отправляется отдельным методом
+        if len(media) == 1:
+            item = media[0]
+            send = self.bot.send_video if isinstance(item, InputMediaVideo) else self.bot.send_photo
+            await send(chat_id, item.media, caption=item.caption, parse_mode=item.parse_mode)
+        else:
+            await self.bot.send_media_group(chat_id=chat_id, media=media)
+
+    async def send_media_group(self, chat_id, media):
+        """
+        Отправляет медиагруппу, соблюдая темп чата. Возвращает True при успехе (или таймауте), False,
+        если группа отклонена Telegram, и None, если исчерпаны попытки: группа цела,
+        её стоит вернуть в очередь.
+        """
+        attempt = 0
+        while attempt < self.max_attempts:
+            await self._wait_turn(chat_id)
+            try:
+                await self._send(chat_id, media)
+                self._on_success(chat_id)
+                GROUPS_SENT.inc()
+                return True
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.labels(error="RetryAfter").inc()
+                self._on_flood(chat_id, retry_after_seconds(e))
+                continue
+            except (BadRequest, Forbidden) as e:
+                # Повтор не поможет: группа или права некорректны
+                TELEGRAM_ERRORS.labels(error=type(e).__name__).inc()
+                logger.error(f"Telegram отклонил медиагруппу: {e}")
+                self._next_allowed[chat_id] = time.monotonic() + self.interval(chat_id)
+                return False
+            except (TimedOut, asyncio.TimeoutError) as e:
+                # Таймаут ответа не значит, что альбом не опубликован: повтор мог бы его задублировать
+                TELEGRAM_ERRORS.labels(error=type(e).__name__).inc()
+                logger.warning(f"Таймаут отправки медиагруппы ({type(e).__name__}), "
+                               f"считаем её отправленной, чтобы не задублировать.")
+                self._next_allowed[chat_id] = time.monotonic() + self.interval(chat_id)
+                return True
+            except (NetworkError, TelegramError) as e:
+                TELEGRAM_ERRORS.labels(error=type(e).__name__).inc()
+                backoff = self._backoff(attempt)
+                attempt += 1
+                logger.warning(f"Ошибка отправки медиагруппы ({type(e).__name__}: {e}), "
+                               f"попытка {attempt} из {self.max_attempts}, повтор через {backoff:.1f} с.")
+                self._next_allowed[chat_id] = time.monotonic() + backoff
+        logger.error(f"Медиагруппа не отправлена после {self.max_attempts} попыток.")
+        return None
@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BoardSource:
+    """
+    Пара (источник, доска) с собственным интервалом опроса.
+
+    poll(board, media_queue) — корутина одного обхода доски, возвращает число новых медиа.
+    По результатам обходов считается скользящее среднее скорости появления новых медиа,
+    и интервал подбирается так, чтобы за обход приходило около target_media новых медиа.
+    """
+
+    def __init__(self, name, board, poll, interval):
+        self.name = name
+        self.board = board
+        self.poll = poll
+        self.interval = interval
+        self.rate = None  # Новых медиа в секунду, скользящее среднее
+        self.last_polled = None
+        self.polls = 0
+        self.media_found = 0
+
+    @property
+    def key(self):
+        return f"{self.name}/{self.board}"
+
+    def record(self, found, now, min_interval, max_interval, target_media, smoothing):
+        """Обновляет оценку скорости по итогам обхода и пересчитывает интервал."""
+        elapsed = now - self.last_polled if self.last_polled is not None else self.interval
+        sample = found / max(elapsed, 1e-6)
+        self.rate = sample if self.rate is None else smoothing * sample + (1 - smoothing) * self.rate
+        self.last_polled = now
+        self.polls += 1
+        self.media_found += found
+
+        if self.rate > 0:
+            interval = target_media / self.rate
+        else:
+            interval = self.interval * 2  # Доска молчит — опрашиваем всё реже
+        self.interval = min(max(interval, min_interval), max_interval)
+
+
+class SourceRegistry:
+    """
+    Единый планировщик сбора медиа с любого числа пар (источник, доска).
+
+    Доски опрашиваются в порядке наступления срока, не больше max_concurrent обходов
+    одновременно. Интервал каждой доски подстраивается под скорость появления на ней
+    нового контента: активные доски опрашиваются чаще, тихие — реже, в пределах
+    [min_interval, max_interval]. Каждая доска пишет в свою подочередь общей очереди
+    (MediaPriorityQueue.for_source), поэтому отправка чередует источники.
+    """
+
+    def __init__(self, media_queue, min_interval=20, max_interval=600, initial_interval=40, target_media=20,
+                 smoothing=0.3, max_concurrent=2):
+        self.media_queue = media_queue
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.target_media = target_media
+        self.smoothing = smoothing
+        self.max_concurrent = max_concurrent
+        self.sources = []
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = set()
+        self._wakeup = None
+
+    def register(self, name, board, poll):
+        """Добавляет доску в расписание; первый обход — сразу после запуска."""
+        source = BoardSource(name, board, poll, self.initial_interval)
+        self.sources.append(source)
+        heapq.heappush(self._heap, (0, next(self._seq), source))
+        logger.info(f"Источник {source.key} зарегистрирован.")
+        return source
+
+    async def run(self):
+        """Основной цикл планировщика: запускает обходы, срок которых наступил."""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                now = loop.time()
+                while self._heap and self._heap[0][0] <= now and len(self._running) < self.max_concurrent:
+                    _, _, source = heapq.heappop(self._heap)
+                    task = asyncio.create_task(self._poll(source))
+                    self._running.add(task)
+
+                timeout = None
+                if self._heap and len(self._running) < self.max_concurrent:
+                    timeout = max(self._heap[0][0] - now, 0)
+                # Будит завершившийся обход или наступление ближайшего срока
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self._running):
+                task.cancel()
+
+    async def _poll(self, source):
+        loop = asyncio.get_running_loop()
+        queue = self.media_queue.for_source(source.key)
+        found = 0
+        try:
+            found = await source.poll(source.board, queue) or 0
+        except Exception as e:
+            logger.error(f"Ошибка при обходе {source.key}: {e}")
+        finally:
+            source.record(found, loop.time(), self.min_interval, self.max_interval, self.target_media,
+                          self.smoothing)
+            heapq.heappush(self._heap, (loop.time() + source.interval, next(self._seq), source))
+            # Слот освобождается до пробуждения планировщика, а не в done-callback, который придёт позже
+            self._running.discard(asyncio.current_task())
+            self._wakeup.set()
+        logger.info(f"Обход {source.key}: новых медиа {found}, скорость {source.rate * 60:.1f} в минуту, "
+                    f"следующий через {source.interval:.0f} с.")
+
+    def stats(self):
+        """Текущие интервалы и скорости по доскам."""
+        return {
+            source.key: {
+                "interval": source.interval,
+                "media_per_min": (source.rate or 0) * 60,
+                "polls": source.polls,
+                "media_found": source.media_found,
+            }
+            for source in self.sources
+        }
@@ -1,50 +1,41 @@
 import logging
-import asyncio  # Для использования asyncio.sleep
 
 from service.thread_service import batch_threads
 
 logger = logging.getLogger(__name__)
 
 
-async def job_collect_media(dvach, posted_media, media_queue, batch_size=5, delay=10):
-    """Сбор медиа с 2ch пакетами по batch_size тредов с паузой delay между пакетами."""
-    logger.info("Начинаем сбор медиа с Двача...")
+async def job_collect_media(dvach, posted_media, media_queue, max_in_flight=4, hash_index=None, board="b",
+                            ranker=None):
+    """
+    Сбор медиа с доски 2ch: треды обрабатываются конкурентно (не больше max_in_flight),
+    темп запросов задаёт rate limiter сервиса. Если очередь заполнена, сбор ждёт свободного места.
+    С ranker (ThreadRanker) обходятся только top_k лучших тредов, начиная с лучшего.
+    Возвращает количество новых медиа, поставленных в очередь.
+    """
+    logger.info("Начинаем сбор медиа с Двача, доска /%s/...", board)
 
     try:
-        threads = await dvach.fetch_threads(board="b")
+        threads = await dvach.fetch_threads(board=board)
         logger.info("Получено %d тредов.", len(threads))
     except Exception as e:
         logger.error(f"Не удалось получить треды: {e}")
-        return
+        return 0
 
-    threads_processed = 0
-    media_found = 0
+    # Забываем водяные знаки утонувших тредов
+    dvach.watermarks[board].prune(t.get("num") for t in threads)
 
-    # Разделяем список тредов на пакеты
-    for batch in range(0, len(threads), batch_size):
-        # Проверяем размер очереди
-        while media_queue.qsize() > 21:
-            logger.info("Очередь переполнена (%d элементов). Ожидание освобождения...", media_queue.qsize())
-            await asyncio.sleep(60)  # Ждём 5 секунд перед повторной проверкой
+    if ranker is not None:
+        threads = ranker.rank(threads)
+        logger.info("Отобрано лучших тредов: %d.", len(threads))
 
-        # Обрабатываем текущий пакет
-        current_batch = threads[batch:batch + batch_size]
-        media_found, threads_processed = await batch_threads(
-            batch_size, delay, dvach, media_found, media_queue,
-            posted_media, current_batch, threads_processed
-        )
-
-        logger.info("Обработан пакет из %d тредов. Общая обработка: %d тредов, найдено медиа: %d",
-                    len(current_batch), threads_processed, media_found)
+    media_found, threads_processed = await batch_threads(
+        max_in_flight, dvach, media_queue, posted_media, threads, hash_index=hash_index, board=board, ranker=ranker
+    )
 
     logger.info("Сбор медиа завершен. Обработано тредов: %d, найдено медиа: %d, очередь размером: %d",
                 threads_processed, media_found, media_queue.qsize())
-
-    # Очистка posted_media для уменьшения потребления памяти
-    if len(posted_media) > 20000:#
-        logger.info("Очистка коллекции отправленных медиа.")
-        posted_media.clear()
+    return media_found
 
 
 #
-
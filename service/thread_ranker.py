@@ -0,0 +1,91 @@
+import heapq
+import math
+import time
+
+
+class ThreadRanker:
+    """
+    Ранжирует треды каталога, чтобы загрузка и отправка шли в первую очередь на лучшие.
+
+    Оценка треда складывается из:
+    - скорости постинга (постов в час): между обходами — по приросту posts_count,
+      сглаженному скользящим средним, для нового треда — по возрасту;
+    - числа новых медиа, которые тред дал в прошлых обходах (record_media);
+    - свежести: 1 для только что бампнутого треда, вдвое меньше каждые freshness_half_life секунд;
+    - интереса читателей: просмотров в час по полю views каталога.
+
+    rank() за один проход по каталогу обновляет состояние тредов и держит min-кучу из top_k
+    лучших (O(n log k)), утонувшие треды забываются.
+    """
+
+    def __init__(self, top_k=50, velocity_weight=1.0, media_weight=1.0, freshness_weight=3.0,
+                 engagement_weight=0.3, freshness_half_life=1800, smoothing=0.5, media_prior=2.0):
+        self.top_k = top_k
+        self.velocity_weight = velocity_weight
+        self.media_weight = media_weight
+        self.freshness_weight = freshness_weight
+        self.engagement_weight = engagement_weight
+        self.freshness_half_life = freshness_half_life
+        self.smoothing = smoothing
+        self.media_prior = media_prior  # Пока тред не загружался, считаем его средним
+        self._state = {}
+
+    def rank(self, threads, now=None):
+        """
+        Возвращает до top_k лучших тредов по убыванию оценки (top_k=0 — все треды).
+        Оценка сохраняется в поле rank_score треда и служит приоритетом его медиагрупп.
+        """
+        now = now or time.time()
+        state = {}
+        heap = []
+        for position, thread in enumerate(threads):
+            num = thread.get("num")
+            if not num:
+                continue
+            entry = state[num] = self._observe(num, thread, now)
+            score = thread["rank_score"] = self._score(thread, entry, now)
+            # При равной оценке выше тот, кто раньше в каталоге
+            item = (score, -position, thread)
+            if not self.top_k or len(heap) < self.top_k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+        self._state = state
+        return [thread for _, _, thread in sorted(heap, key=lambda item: item[:2], reverse=True)]
+
+    def record_media(self, thread_num, count):
+        """Учитывает, сколько новых медиа тред дал в последнем обходе."""
+        entry = self._state.get(thread_num)
+        if entry is None:
+            return
+        if entry["media"] is None:
+            entry["media"] = float(count)
+        else:
+            entry["media"] = self.smoothing * count + (1 - self.smoothing) * entry["media"]
+
+    def _observe(self, num, thread, now):
+        posts_count = thread.get("posts_count") or 0
+        previous = self._state.get(num)
+        if previous is None:
+            age = max(now - (thread.get("timestamp") or now), 60)
+            velocity = posts_count / age * 3600
+            media = None
+        else:
+            elapsed = now - previous["seen_at"]
+            velocity = previous["velocity"]
+            if elapsed > 0:
+                sample = max(posts_count - previous["posts_count"], 0) / elapsed * 3600
+                velocity = self.smoothing * sample + (1 - self.smoothing) * velocity
+            media = previous["media"]
+        return {"posts_count": posts_count, "seen_at": now, "velocity": velocity, "media": media}
+
+    def _score(self, thread, entry, now):
+        media = self.media_prior if entry["media"] is None else entry["media"]
+        idle = max(now - (thread.get("lasthit") or now), 0)
+        freshness = 0.5 ** (idle / self.freshness_half_life)
+        age_hours = max(now - (thread.get("timestamp") or now), 60) / 3600
+        views_per_hour = (thread.get("views") or 0) / age_hours
+        return (self.velocity_weight * math.log1p(entry["velocity"])
+                + self.media_weight * math.log1p(media)
+                + self.freshness_weight * freshness
+                + self.engagement_weight * math.log1p(views_per_hour))
@@ -2,7 +2,7 @@ import asyncio
 import logging
 
 from utils.harkach_markup_converter import HarkachMarkupConverter
-from utils.thread_utils import filter_new_media, fetch_thread_data_safe, group_split
+from utils.thread_utils import filter_new_media, fetch_thread_updates_safe, group_split
 
 __STEP = 10
 
@@ -11,60 +11,89 @@ logger = logging.getLogger(__name__)
 converter = HarkachMarkupConverter()
 
 
-async def batch_threads(batch_size, delay, dvach, media_found, media_queue, posted_media, threads, threads_processed):
+async def batch_threads(max_in_flight, dvach, media_queue, posted_media, threads, hash_index=None, board="b",
+                        ranker=None):
     """
-    Обрабатывает пакеты тредов и вызывает обработку каждого треда.
+    Обрабатывает треды конкурентно: не больше max_in_flight одновременно.
+    Темп запросов ограничивает rate limiter внутри dvach, а не фиксированные паузы;
+    при заполненной очереди воркеры ждут в media_queue.put().
+    hash_index (MediaHashIndex) отсеивает визуальные дубликаты перед постановкой в очередь.
+    ranker (ThreadRanker) узнаёт, сколько новых медиа дал каждый загруженный тред.
+    Возвращает (найдено медиа, обработано тредов).
     """
     filter_keywords = {"fap", "dark", "afp"}  # Набор слов для фильтрации caption
+    pending = iter(threads)
+    media_found = 0
+    threads_processed = 0
 
-    for i in range(0, len(threads), batch_size):
-        batch = threads[i:i + batch_size]
-
-        for thread in batch:
-
-
+    async def worker():
+        nonlocal media_found, threads_processed
+        for thread in pending:
             # Проверяем caption на наличие запрещённых слов
             caption = thread.get("comment", "").lower()
             if any(keyword in caption for keyword in filter_keywords):
-                logger.info(f"Тред {thread} отфильтрован из-за содержания: '{caption}'.")
+                logger.info(f"Тред {thread.get('num')} отфильтрован из-за содержания: '{caption}'.")
                 continue
 
             # Обрабатываем тред, если он прошёл фильтрацию
-            await process_thread(thread, dvach, media_queue, posted_media, media_found, threads_processed)
-
-        # Пауза перед следующим пакетом тредов
-        logger.info("Пакет тредов обработан. Ждём %d секунд перед следующим пакетом.", delay)
-        await asyncio.sleep(delay)
+            changed = not dvach.watermarks[board].is_unchanged(thread)
+            try:
+                queued = await process_thread(thread, dvach, media_queue, posted_media, hash_index, board)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке треда {thread.get('num')}: {e}")
+                continue
+            if ranker is not None and changed:
+                ranker.record_media(thread.get("num"), queued)
+            if queued:
+                media_found += queued
+                threads_processed += 1
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, max_in_flight))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
 
     return media_found, threads_processed
 
 
-async def process_thread(thread, dvach, media_queue, posted_media, media_found, threads_processed):
+async def process_thread(thread, dvach, media_queue, posted_media, hash_index=None, board="b"):
     """
     Обрабатывает один тред: загружает данные, фильтрует медиа, формирует группы и добавляет их в очередь.
+    Возвращает количество медиа, поставленных в очередь.
     """
     thread_num = thread.get("num") or thread.get("thread_num")
     if not thread_num:
         logger.debug(f"Пропускаем тред без номера: {thread}")
-        return
+        return 0
 
-    # Безопасное получение данных треда
-    t_data = await fetch_thread_data_safe(dvach, thread_num)
+    # Безопасное получение новых постов треда (после водяного знака)
+    t_data = await fetch_thread_updates_safe(dvach, thread, board)
     if not t_data:
-        return
+        return 0
 
     # Фильтрация новых медиа
     new_media = filter_new_media(t_data["media"], posted_media)
     if not new_media:
         logger.debug("Нет новых медиа в треде %s.", thread_num)
-        return
+        return 0
 
     # Добавляем новые медиа в список отправленных
     posted_media.update(new_media)
 
+    # Отбрасываем перезаливы уже известных картинок под новыми путями
+    if hash_index is not None:
+        session = await dvach.get_session()
+        new_media = await hash_index.filter_duplicates(session, new_media, t_data.get("thumbnails"),
+                                                       dvach.rate_limiter)
+        if not new_media:
+            logger.debug("Все новые медиа треда %s оказались визуальными дубликатами.", thread_num)
+            return 0
+
     # Преобразуем разметку для caption
     raw_caption = t_data["caption"][:1024]
-    thread_link = f"https://2ch.su/b/res/{thread_num}.html"  # Формирование ссылки на тред
+    thread_link = f"{dvach.BASE_URL}/{board}/res/{thread_num}.html"  # Формирование ссылки на тред
     caption_html = converter.convert_to_tg_html(raw_caption)
 
     # Добавляем ссылку на тред в конец caption
@@ -75,11 +104,12 @@ async def process_thread(thread, dvach, media_queue, posted_media, media_found,
     for j in range(0, len(new_media), __STEP):
         await group_split(caption_html, j, media_groups, new_media)
 
+    # Лучшие треды отправляются раньше: приоритет — оценка ThreadRanker, без неё — время последнего поста
+    score = thread.get("rank_score", thread.get("lasthit") or 0)
     for g in media_groups:
-        await media_queue.put(g)
-        media_found += len(g)
+        await media_queue.put(g, score)
 
-    threads_processed += 1
     logger.info("Тред %s обработан. Новых медиа: %d, групп: %d.", thread_num, len(new_media), len(media_groups))
+    return len(new_media)
 
 #
@@ -0,0 +1,51 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadWatermarkStore:
+    """
+    Хранит для каждого треда «водяной знак»: номер последнего увиденного поста,
+    posts_count и lasthit из threads.json. По нему определяется, изменился ли тред
+    с прошлого цикла и с какого поста нужно догружать новые.
+    """
+
+    def __init__(self):
+        self._marks = {}
+
+    def __len__(self):
+        return len(self._marks)
+
+    def get(self, thread_num):
+        """Возвращает водяной знак треда или None, если тред ещё не встречался."""
+        return self._marks.get(str(thread_num))
+
+    def is_unchanged(self, thread: dict) -> bool:
+        """
+        Проверяет по данным из threads.json, что в треде не появилось новых постов.
+        """
+        mark = self.get(thread.get("num"))
+        if mark is None:
+            return False
+        return (mark["posts_count"] == thread.get("posts_count")
+                and mark["lasthit"] == thread.get("lasthit"))
+
+    def update(self, thread_num, last_num, posts_count, lasthit):
+        """Сдвигает водяной знак треда после успешной загрузки постов."""
+        mark = self._marks.get(str(thread_num))
+        if mark is not None and last_num is not None and mark["last_num"] is not None:
+            last_num = max(last_num, mark["last_num"])
+        self._marks[str(thread_num)] = {
+            "last_num": last_num,
+            "posts_count": posts_count,
+            "lasthit": lasthit
+        }
+
+    def prune(self, alive_thread_nums):
+        """Удаляет водяные знаки тредов, которых больше нет на доске."""
+        alive = {str(num) for num in alive_thread_nums}
+        stale = [num for num in self._marks if num not in alive]
+        for num in stale:
+            del self._marks[num]
+        if stale:
+            logger.info(f"Удалено водяных знаков утонувших тредов: {len(stale)}")
@@ -3,55 +3,148 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-class HarkachMarkupConverter:
-    def __init__(self):
-        pass
+# Единственные теги, требующие состояния: открывающие и закрывающие span
+_SPAN_TAG_RE = re.compile(r'<span[^<>]*>|</span>')
+_CLASS_RE = re.compile(r'class="[^"]*"')
+# Метка на месте выброшенных span: прежняя цепочка удаляла их после target/rel
+_MARK = "\x00"
 
-    def replace_underline_span(self, input_str: str) -> str:
-        # <span class="u">...</span> -> <u>...</u>
-        regex = re.compile(r'<span[^>]*class="u"[^>]*>(.*?)</span>', flags=re.DOTALL)
-        return regex.sub(r'<u>\1</u>', input_str)
 
-    def replace_unkfunc_span(self, input_str: str) -> str:
-        # <span class="unkfunc">...</span> -> <i>...</i>
-        regex = re.compile(r'<span[^>]*class="unkfunc"[^>]*>(.*?)</span>', flags=re.DOTALL)
-        return regex.sub(r'<i>\1</i>', input_str)
+def _strip_target_rel(text: str) -> str:
+    r"""
+    Эквивалент re.sub(r'\s*(target="_blank"|rel="[^"]*")', '', text) на str.find:
+    regex с ведущим \s* проверяется в каждой позиции и на длинных постах дорог.
+    """
+    parts = []
+    pos = search_from = 0
+    while True:
+        rel = text.find('rel="', search_from)
+        target = text.find('target="_blank"', search_from)
+        if rel < 0 and target < 0:
+            break
+        if target >= 0 and (rel < 0 or target < rel):
+            start, end = target, target + len('target="_blank"')
+        else:
+            close = text.find('"', rel + len('rel="'))
+            if close < 0:
+                # rel без закрывающей кавычки не совпадает; target дальше ещё может быть
+                if target < 0:
+                    break
+                search_from = rel + 1
+                continue
+            start, end = rel, close + 1
+        parts.append(text[pos:start].rstrip())
+        pos = search_from = end
+    if not parts:
+        return text
+    parts.append(text[pos:])
+    return "".join(parts)
 
-    def replace_spoiler_span(self, input_str: str) -> str:
-        # <span class="spoiler">...</span> -> <span class="tg-spoiler">...</span>
-        regex = re.compile(r'<span[^>]*class="spoiler"[^>]*>(.*?)</span>', flags=re.DOTALL)
-        return regex.sub(r'<span class="tg-spoiler">\1</span>', input_str)
 
-    def convert_to_tg_html(self, input_str: str) -> str:
-        result = self.replace_underline_span(input_str)
-        logger.debug(f"After replace_underline_span: {result}")
+def _free_mark(text: str) -> str:
+    """Символ для метки, которого нет в тексте."""
+    if _MARK not in text:
+        return _MARK
+    return next(chr(code) for code in range(0xE000, 0x110000) if chr(code) not in text)
+
+
+def _clean(chunk: str, mark=None) -> str:
+    """
+    Не зависящие от span замены: em/strong, ссылки, кавычки, переносы строк,
+    удаление target/rel и class. Каждая выполняется, только если в тексте есть что менять.
+    mark отмечает места выброшенных span: до удаления target/rel они разделяют текст,
+    как это делали сами теги в прежней цепочке, и снимаются перед удалением class.
+    """
+    if "<" in chunk:
+        chunk = (chunk
+                 .replace("<em>", "<i>").replace("</em>", "</i>")
+                 .replace("<strong>", "<b>").replace("</strong>", "</b>")
+                 .replace('<a href="/', '<a href="https://2ch.hk/'))
+    if "&quot;" in chunk:
+        chunk = chunk.replace("&quot;", '"')
+    if "<br>" in chunk:
+        chunk = chunk.replace("<br>", "\n")
+    if '="' in chunk:
+        chunk = _strip_target_rel(chunk)
+    if mark is not None:
+        chunk = chunk.replace(mark, "")
+    if '="' in chunk:
+        chunk = _CLASS_RE.sub('', chunk)
+    return chunk
+
 
-        result = self.replace_unkfunc_span(result)
-        logger.debug(f"After replace_unkfunc_span: {result}")
+class HarkachMarkupConverter:
+    """
+    Переводит разметку постов 2ch/4chan в HTML для Telegram.
+
+    Span-теги разбираются за один проход конечным автоматом, остальные замены выполняются
+    одним набором строковых операций над уже собранным результатом.
 
-        result = self.replace_spoiler_span(result)
-        logger.debug(f"After replace_spoiler_span: {result}")
+    Результат совпадает с прежней цепочкой regex-замен, включая её правила сопоставления span:
+    <span class="u"> и <span class="unkfunc"> закрываются ближайшим свободным </span> (u раньше
+    unkfunc), spoiler — ближайшим, не занятым ими; прочие span удаляются вместе с содержимым до
+    ближайшего </span>, который не стал </u> или </i>. Оставшиеся </span> выбрасываются.
+    Выброшенные span до удаления target/rel заменяются меткой, чтобы пробелы перед ними
+    обрабатывались так же, как в прежней цепочке.
+    """
+
+    def __init__(self):
+        pass
+
+    def convert_to_tg_html(self, input_str: str) -> str:
+        out = []
+        u_open = i_open = spoiler_open = None  # (индекс в out, исходный тег) незакрытого span
+        cut_from = None  # начало удаляемого вместе с содержимым span
+        mark = None
+        pos = 0
 
-        # Заменяем <em> -> <i>, <strong> -> <b>
-        result = (result
-                  .replace("<em>", "<i>").replace("</em>", "</i>")
-                  .replace("<strong>", "<b>").replace("</strong>", "</b>"))
+        for match in _SPAN_TAG_RE.finditer(input_str):
+            start = match.start()
+            if start > pos:
+                out.append(input_str[pos:start])
+            pos = match.end()
+            tag = match.group()
 
-        # Ссылки, кавычки, переносы строк
-        result = (result
-                  .replace('<a href="/', '<a href="https://2ch.hk/')
-                  .replace('&quot;', '"')
-                  .replace("<br>", "\n"))
+            if tag == "</span>":
+                if u_open is not None:
+                    out.append("</u>")
+                    u_open = None
+                elif i_open is not None:
+                    out.append("</i>")
+                    i_open = None
+                else:
+                    spoiler_open = None
+                    if cut_from is not None:
+                        del out[cut_from:]
+                        cut_from = None
+                    if mark is None:
+                        mark = _free_mark(input_str)
+                    out.append(mark)
+                continue
 
-        # Удаляем атрибуты target и rel из ссылок
-        result = re.sub(r'\s*(target="_blank"|rel="[^"]*")', '', result)
+            if u_open is None and 'class="u"' in tag:
+                u_open = (len(out), tag)
+                out.append("<u>")
+            elif i_open is None and 'class="unkfunc"' in tag:
+                i_open = (len(out), tag)
+                out.append("<i>")
+            elif spoiler_open is None and 'class="spoiler"' in tag:
+                spoiler_open = (len(out), tag)
+                out.append("<span >")
+            else:
+                if cut_from is None and not tag.startswith('<span class="tg-spoiler"'):
+                    cut_from = len(out)
+                out.append(tag)
 
-        # Удаляем некорректные span (любые кроме tg-spoiler)
-        result = re.sub(r'<span(?! class="tg-spoiler")[^>]*>.*?</span>', '', result, flags=re.DOTALL)
-        result = re.sub(r'</span>', '', result)
+        if pos < len(input_str):
+            out.append(input_str[pos:])
 
-        # Удаляем class="spoiler" если остался где-то
-        result = re.sub(r'class="[^"]*"', '', result)
+        # span без закрывающего тега остаётся как есть, только без class
+        for pending in (u_open, i_open, spoiler_open):
+            if pending is not None:
+                out[pending[0]] = pending[1]
 
-        logger.debug(f"Final result: {result}")
+        result = _clean("".join(out), mark)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Final result: {result}")
         return result
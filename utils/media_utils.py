@@ -1,11 +1,10 @@
+import asyncio
+import hashlib
 import logging
-import aiohttp
-import tempfile
-from PIL import Image, UnidentifiedImageError
-from nudenet import NudeDetector
-from asyncio import Semaphore
 from telegram import InputMediaPhoto, InputMediaVideo
 
+from utils.metrics import NSFW_REJECTS
+
 logger = logging.getLogger(__name__)
 
 def create_input_media(url: str, caption: str = None):
@@ -22,73 +21,93 @@ def create_input_media(url: str, caption: str = None):
 
 
 
-# Инициализация NudeDetector
-detector = NudeDetector()
-semaphore = Semaphore(5)  # Ограничение одновременных задач
-
-async def is_not_pornographic_media(url, threshold=0.30):
+async def is_not_pornographic_media(url, nsfw_pool, threshold=0.30, verdict_cache=None):
     """
-    Асинхронно проверяет, является ли медиа по URL порнографическим (поддержка изображений и видео).
+    Асинхронно проверяет, что изображение по URL не порнографическое.
+    Медиа скачивается в память, инференс выполняется пачками в пуле процессов NsfwWorkerPool.
+    С verdict_cache известный URL не скачивается, а известное содержимое не проверяется повторно.
+    Видео детектором изображений не проверяются и пропускаются.
     """
-    async with semaphore:
-        try:
-            logger.debug(f"Загрузка медиа: {url}")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        logger.error(f"Ошибка скачивания медиа: {url}, статус: {response.status}")
-                        return False
-
-                    # Сохранение медиа во временный файл
-                    suffix = ".mp4" if url.endswith((".webm", ".mp4")) else ".jpeg"
-                    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
-                        temp_file.write(await response.read())
-                        temp_file.flush()
-
-                        # Если это изображение, проверяем через Pillow
-                        if suffix == ".jpeg":
-                            try:
-                                with Image.open(temp_file.name) as img:
-                                    img.verify()  # Проверка корректности изображения
-                            except (UnidentifiedImageError, IOError):
-                                logger.error(f"Файл повреждён или не является изображением: {url}")
-                                return False
-
-                        # Анализ с помощью NudeNet
-                        results = detector.detect(temp_file.name)
-
-
-                        for result in results:
-                            class_ = result["class"]
-                            score_ = result["score"]
-                            if score_ >= threshold:
-                                logger.warning(f"Обнаружен порнографический контент: {url, class_, score_}")
-                                return False  # Контент запрещён
-            return True  # Контент допустим
-        except Exception as e:
-            logger.error(f"Ошибка обработки URL {url}: {e}")
+    if url.endswith((".webm", ".mp4")):
+        return True
+    try:
+        if verdict_cache is not None:
+            results = verdict_cache.get_by_url(url)
+            if results is not None:
+                return _verdict(url, results, threshold)
+
+        logger.debug(f"Загрузка медиа: {url}")
+        image_bytes = await nsfw_pool.download(url)
+        if image_bytes is None:
             return False
 
+        content_hash = hashlib.sha256(image_bytes).hexdigest()
+        if verdict_cache is not None:
+            results = verdict_cache.get_by_hash(content_hash, url)
+            if results is not None:
+                return _verdict(url, results, threshold)
+
+        results = await nsfw_pool.detect(image_bytes)
+        if results is None:
+            logger.error(f"Файл повреждён или не является изображением: {url}")
+            return False
+
+        if verdict_cache is not None:
+            verdict_cache.put(url, content_hash, results)
+        return _verdict(url, results, threshold)
+    except Exception as e:
+        logger.error(f"Ошибка обработки URL {url}: {e}")
+        return False
+
+
+def _verdict(url, results, threshold):
+    for result in results:
+        class_ = result["class"]
+        score_ = result["score"]
+        if score_ >= threshold:
+            logger.warning(f"Обнаружен порнографический контент: {url, class_, score_}")
+            NSFW_REJECTS.inc()
+            return False  # Контент запрещён
+    return True  # Контент допустим
 
-async def filter_accessible_media(media_group):
+
+async def filter_accessible_media(media_group, nsfw_pool=None, threshold=0.30, verdict_cache=None, validator=None):
     """
     Асинхронно фильтрует медиа на доступность и проверку контента.
+    Если передан validator (MediaValidator), сначала отбрасываются битые ссылки, неподдерживаемые
+    типы и файлы больше лимитов Telegram. Если передан nsfw_pool, все медиа группы проверяются
+    конкурентно. Подпись группы остаётся на первом уцелевшем элементе.
     """
+    if validator is not None:
+        media_group = await validator.validate_group(media_group)
+    if nsfw_pool is None:
+        verdicts = [True] * len(media_group)
+    else:
+        verdicts = await asyncio.gather(
+            *(is_not_pornographic_media(media.media, nsfw_pool, threshold, verdict_cache) for media in media_group)
+        )
+        if verdict_cache is not None:
+            logger.info(f"Кэш NSFW-вердиктов: {verdict_cache.stats()}")
+
     accessible_media = []
-    for media in media_group:
-        try:
-            # Проверяем контент медиа
-            # is_not_porn = true
-                # await is_not_pornographic_media(media.media)
-
-            # if is_not_porn:
-                accessible_media.append(media)
-        except Exception as e:
-            logger.error(f"Ошибка обработки медиа {media.media}: {e}")
+    for media, is_not_porn in zip(media_group, verdicts):
+        if is_not_porn:
+            accessible_media.append(media)
+    accessible_media = keep_caption_on_first(media_group, accessible_media)
     logger.info(f"Допущенные медиа: {[m.media for m in accessible_media]}")
     return accessible_media
 
 
+def keep_caption_on_first(original_group, filtered_group):
+    """Переносит подпись группы на первый элемент, если элемент с подписью был отброшен."""
+    caption = next((m.caption for m in original_group if m.caption), None)
+    if not filtered_group or caption is None or filtered_group[0].caption == caption:
+        return filtered_group
+    result = [type(filtered_group[0])(media=filtered_group[0].media, caption=caption, parse_mode='HTML')]
+    result.extend(filtered_group[1:])
+    return result
+
+
 async def check_chat_access(bot, channel_id):
     try:
         logger.info(f"Проверка доступа к чату: {channel_id}")
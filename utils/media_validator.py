@@ -0,0 +1,124 @@
+import asyncio
+import logging
+
+import aiohttp
+from telegram import InputMediaPhoto, InputMediaVideo
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Bot API на отправку файлов по URL
+PHOTO_MAX_BYTES = 5 * 1024 * 1024
+VIDEO_MAX_BYTES = 20 * 1024 * 1024
+PHOTO_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+VIDEO_TYPES = {"video/mp4"}
+
+
+class MediaValidator:
+    """
+    Проверяет медиа перед отправкой: ссылка жива, Content-Type поддерживается Telegram,
+    размер укладывается в лимиты для фото и видео. Все элементы группы проверяются
+    конкурентно через один пул соединений, сначала HEAD, а если сервер его не поддерживает —
+    GET с Range: bytes=0-0.
+
+    headers_for(url) отдаёт заголовки источника медиа (User-Agent, Referer), rate_limiter —
+    общий HostRateLimiter сборщиков: каждый запрос проверки берёт токен своего хоста.
+    Медиа отбрасывается только при однозначном ответе: 4xx (кроме 429), неподходящий тип
+    или размер. При сетевой ошибке, 429 и 5xx элемент остаётся в группе как есть.
+    """
+
+    def __init__(self, max_concurrency=10, request_timeout=15, rate_limiter=None, headers_for=None):
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.rate_limiter = rate_limiter
+        self.headers_for = headers_for
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    async def get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def validate_group(self, media_group):
+        """
+        Возвращает группу без непригодных медиа. Элемент с неверно угаданным типом
+        (например, .jpg, который отдаётся как video/mp4) пересоздаётся с правильным типом.
+        Подпись группы переносится на первый уцелевший элемент.
+        """
+        if not media_group:
+            return []
+        caption = next((m.caption for m in media_group if m.caption), None)
+        probes = await asyncio.gather(*(self._probe(m.media) for m in media_group))
+
+        valid_urls = []
+        for media, probe in zip(media_group, probes):
+            url = media.media
+            if probe is None:
+                valid_urls.append((url, type(media)))  # Проверить не удалось — решит Telegram
+                continue
+            status, content_type, size = probe
+            if status == 429 or status >= 500:
+                logger.warning(f"Медиа не проверено ({status}), оставляем: {url}")
+                valid_urls.append((url, type(media)))
+                continue
+            if status >= 400:
+                logger.warning(f"Медиа недоступно ({status}): {url}")
+                continue
+            if content_type in PHOTO_TYPES:
+                limit = PHOTO_MAX_BYTES
+            elif content_type in VIDEO_TYPES:
+                limit = VIDEO_MAX_BYTES
+            else:
+                logger.warning(f"Неподдерживаемый тип медиа {content_type}: {url}")
+                continue
+            if size is not None and size > limit:
+                logger.warning(f"Медиа превышает лимит Telegram ({size} > {limit} байт): {url}")
+                continue
+            valid_urls.append((url, InputMediaVideo if content_type in VIDEO_TYPES else InputMediaPhoto))
+
+        validated = []
+        for idx, (url, media_cls) in enumerate(valid_urls):
+            validated.append(media_cls(media=url, caption=caption if idx == 0 else None, parse_mode='HTML'))
+        return validated
+
+    async def _probe(self, url):
+        """Возвращает (статус, Content-Type, размер) или None при сетевой ошибке."""
+        session = await self.get_session()
+        headers = self.headers_for(url) if self.headers_for is not None else {}
+        async with self._semaphore:
+            try:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire(url)
+                async with session.head(url, headers=headers, allow_redirects=True) as response:
+                    if response.status not in (405, 501):
+                        return response.status, _content_type(response), response.content_length
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire(url)
+                async with session.get(url, headers={**headers, "Range": "bytes=0-0"},
+                                       allow_redirects=True) as response:
+                    return response.status, _content_type(response), _total_size(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Не удалось проверить медиа {url}: {e!r}")
+                return None
+
+
+def _content_type(response):
+    return response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+
+def _total_size(response):
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return response.content_length if response.status == 200 else None
+
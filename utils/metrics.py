@@ -0,0 +1,52 @@
+"""
+Метрики конвейера в формате Prometheus.
+
+run.py запускает API и бота в разных процессах, поэтому метрики пишутся в multiprocess-режиме
+prometheus_client: каждый процесс пишет свои значения в файлы PROMETHEUS_MULTIPROC_DIR, а
+/metrics в API собирает их через MultiProcessCollector. Переменная должна быть задана до
+первого импорта prometheus_client (это делает run.py); без неё метрики живут в памяти процесса.
+
+Отправленные за минуту группы считаются в PromQL: rate(autochan_media_groups_sent_total[5m]) * 60.
+Доля попаданий кэша /chat: 1 - rate(autochan_chat_cache_lookups_total{result="miss"}[5m])
+/ rate(autochan_chat_cache_lookups_total[5m]).
+"""
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest
+from prometheus_client import multiprocess
+
+MEDIA_QUEUE_DEPTH = Gauge(
+    "autochan_media_queue_depth", "Медиагрупп в очереди на отправку",
+    multiprocess_mode="livesum"
+)
+FETCH_LATENCY = Histogram(
+    "autochan_fetch_latency_seconds", "Длительность HTTP-запросов к источникам",
+    ["source"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DEDUP_LOOKUPS = Counter(
+    "autochan_dedup_lookups_total", "Проверки дедупликации: hit — медиа отброшено или вердикт взят из кэша",
+    ["store", "result"]
+)
+CHAT_CACHE_LOOKUPS = Counter(
+    "autochan_chat_cache_lookups_total", "Обращения к кэшу ответов OpenAI: hit, coalesced (ждал такой же запрос), miss",
+    ["result"]
+)
+MEDIA_GROUPS_EXPIRED = Counter("autochan_media_groups_expired_total", "Медиагруппы, устаревшие в очереди")
+MEDIA_GROUPS_REQUEUED = Counter(
+    "autochan_media_groups_requeued_total", "Медиагруппы, возвращённые в очередь после исчерпания попыток отправки"
+)
+NSFW_REJECTS = Counter("autochan_nsfw_rejects_total", "Медиа, отклонённые NSFW-проверкой")
+GROUPS_SENT = Counter("autochan_media_groups_sent_total", "Медиагрупп отправлено в канал")
+TELEGRAM_ERRORS = Counter("autochan_telegram_errors_total", "Ошибки Bot API при отправке", ["error"])
+
+
+def render_metrics():
+    """Возвращает (тело, Content-Type) для ответа /metrics."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
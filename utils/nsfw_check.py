@@ -1,6 +1,3 @@
-from nudenet import NudeDetector
-
-
 def contains_pornographic_content(image_path="C:\\Users\\Alevtina\\PycharmProjects\\auto_chan_python\\utils\\test.png", threshold=0.45):
     """
     Проверяет, содержит ли изображение порнографический контент.
@@ -9,6 +6,8 @@ def contains_pornographic_content(image_path="C:\\Users\\Alevtina\\PycharmProjec
     :param threshold: Уровень уверенности, начиная с которого объект считается порнографическим.
     :return: True, если обнаружен порнографический контент, иначе False.
     """
+    from nudenet import NudeDetector  # Модель грузится только при вызове, не при импорте
+
     # Создание экземпляра классификатора
     detector = NudeDetector()
 
@@ -32,8 +31,9 @@ def contains_pornographic_content(image_path="C:\\Users\\Alevtina\\PycharmProjec
     return False  # Ничего не найдено
 
 
-# Пример использования
-image_path = "test.jpeg"
-is_porn = contains_pornographic_content(image_path)
+if __name__ == "__main__":
+    # Пример использования
+    image_path = "test.jpeg"
+    is_porn = contains_pornographic_content(image_path)
 
-print(f"Порнографическое содержимое: {'Да' if is_porn else 'Нет'}")
+    print(f"Порнографическое содержимое: {'Да' if is_porn else 'Нет'}")
@@ -0,0 +1,179 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Детектор живёт в каждом процессе-воркере отдельно и создаётся один раз при старте воркера
+_detector = None
+
+
+def _init_worker():
+    global _detector
+    from nudenet import NudeDetector
+    _detector = NudeDetector()
+
+
+def _warm_up():
+    """Выполняется в процессе-воркере: к этому моменту initializer уже загрузил модель."""
+    return _detector is not None
+
+
+def _decode_image(image_bytes):
+    """Декодирует изображение из памяти в BGR-массив, как ожидает NudeNet."""
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("RGB", (640, 640))  # NudeNet всё равно сжимает вход до 320-640px
+        rgb = np.asarray(img.convert("RGB"))
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+def _detect_batch(images):
+    """
+    Выполняется в процессе-воркере. Возвращает по списку детекций на каждое изображение,
+    None — если изображение не удалось декодировать.
+    """
+    decoded = []
+    for image_bytes in images:
+        try:
+            decoded.append(_decode_image(image_bytes))
+        except Exception:
+            decoded.append(None)
+
+    valid = [image for image in decoded if image is not None]
+    if hasattr(_detector, "detect_batch"):
+        detections = iter(_detector.detect_batch(valid, batch_size=len(valid)) if valid else [])
+    else:
+        detections = iter([_detector.detect(image) for image in valid])
+    return [next(detections) if image is not None else None for image in decoded]
+
+
+class NsfwWorkerPool:
+    """
+    Пул процессов для проверки изображений NudeNet.
+
+    Запросы из event loop копятся в очереди и уходят в воркеры пачками до batch_size
+    (или по истечении max_wait секунд), поэтому инференс не блокирует цикл отправки.
+    Изображения декодируются в памяти, временные файлы не создаются.
+    Загрузки идут с заголовками источника (headers_for(url)) и берут токен общего
+    HostRateLimiter, как и остальные запросы к хосту.
+    """
+
+    def __init__(self, workers=2, batch_size=8, max_wait=0.05, download_timeout=30, rate_limiter=None,
+                 headers_for=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.download_timeout = download_timeout
+        self.rate_limiter = rate_limiter
+        self.headers_for = headers_for
+        self._executor = None
+        self._queue = None
+        self._batcher = None
+        self._batches = set()  # Пачки в воркерах: ссылки держим, чтобы задачи не собрал GC
+        self._session = None
+
+    async def start(self):
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker
+        )
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batcher())
+        logger.info(f"Пул NSFW-воркеров запущен: процессов {self.workers}, пачка до {self.batch_size}.")
+
+    async def warm_up(self):
+        """
+        Поднимает процессы-воркеры и загружает в них модель заранее, в фоне после старта бота,
+        чтобы первая проверка не ждала загрузки onnxruntime и NudeNet.
+        """
+        await self.start()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.workers)))
+        except Exception as e:
+            logger.error(f"Не удалось прогреть пул NSFW-воркеров: {e}")
+            return
+        logger.info(f"Пул NSFW-воркеров прогрет за {loop.time() - started:.1f} с.")
+
+    async def close(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            self._batcher = None
+        for task in list(self._batches):
+            task.cancel()
+        await asyncio.gather(*self._batches, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def get_session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.download_timeout))
+        return self._session
+
+    async def detect(self, image_bytes: bytes):
+        """Возвращает список детекций NudeNet для изображения или None, если его не удалось декодировать."""
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image_bytes, future))
+        return await future
+
+    async def download(self, url: str):
+        """Скачивает медиа в память. Возвращает байты или None."""
+        session = await self.get_session()
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(url)
+        headers = self.headers_for(url) if self.headers_for is not None else None
+        async with session.get(url, headers=headers) as response:
+            if response.status != 200:
+                logger.error(f"Ошибка скачивания медиа: {url}, статус: {response.status}")
+                return None
+            return await response.read()
+
+    async def _run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._process_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _process_batch(self, batch):
+        images = [image for image, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, _detect_batch, images)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from utils.metrics import DEDUP_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+class NsfwVerdictCache:
+    """
+    Кэш результатов NudeNet по хэшу содержимого, URL — вторичный ключ.
+
+    Хранятся сами детекции (классы и скоры), а не вердикт, поэтому он пересчитывается
+    для любого нового порога без повторного инференса.
+    В памяти держится не больше max_items записей (LRU). Если задан path, записи
+    дублируются в SQLite и переживают перезапуск; на диске хранится не больше max_disk_items.
+    """
+
+    def __init__(self, max_items=20000, path=None, max_disk_items=500000):
+        self.max_items = max_items
+        self.max_disk_items = max_disk_items
+        self._by_hash = OrderedDict()
+        self._by_url = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._writes = 0
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS nsfw_verdicts ("
+                "content_hash TEXT PRIMARY KEY, detections TEXT NOT NULL, ts REAL NOT NULL)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS nsfw_urls (url TEXT PRIMARY KEY, content_hash TEXT NOT NULL)")
+            self._db.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"попаданий {self.hits}, промахов {self.misses}, hit rate {self.hit_rate:.1%}"
+
+    def get_by_url(self, url: str):
+        """Возвращает детекции для URL или None. Попадание позволяет не скачивать медиа."""
+        content_hash = self._by_url.get(url)
+        if content_hash is None and self._db is not None:
+            row = self._db.execute("SELECT content_hash FROM nsfw_urls WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                content_hash = row[0]
+        if content_hash is None:
+            return None
+        detections = self._lookup_hash(content_hash)
+        if detections is not None:
+            self._remember(self._by_url, url, content_hash)
+            self.hits += 1
+            DEDUP_LOOKUPS.labels(store="nsfw_verdict", result="hit").inc()
+        return detections
+
+    def get_by_hash(self, content_hash: str, url: str = None):
+        """
+        Возвращает детекции по хэшу содержимого. Считает промах, если вердикта нет:
+        вызывается после скачивания, когда URL уже не нашёлся.
+        """
+        detections = self._lookup_hash(content_hash)
+        if detections is None:
+            self.misses += 1
+            DEDUP_LOOKUPS.labels(store="nsfw_verdict", result="miss").inc()
+            return None
+        self.hits += 1
+        DEDUP_LOOKUPS.labels(store="nsfw_verdict", result="hit").inc()
+        if url is not None:
+            self._link_url(url, content_hash)
+        return detections
+
+    def put(self, url: str, content_hash: str, detections):
+        compact = [{"class": d["class"], "score": float(d["score"])} for d in detections]
+        self._remember(self._by_hash, content_hash, compact)
+        self._link_url(url, content_hash)
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO nsfw_verdicts (content_hash, detections, ts) VALUES (?, ?, ?)",
+                    (content_hash, json.dumps(compact), time.time())
+                )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._trim_disk()
+
+    def _lookup_hash(self, content_hash):
+        detections = self._by_hash.get(content_hash)
+        if detections is None and self._db is not None:
+            row = self._db.execute(
+                "SELECT detections FROM nsfw_verdicts WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if row is not None:
+                detections = json.loads(row[0])
+        if detections is not None:
+            self._remember(self._by_hash, content_hash, detections)
+        return detections
+
+    def _link_url(self, url, content_hash):
+        self._remember(self._by_url, url, content_hash)
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO nsfw_urls (url, content_hash) VALUES (?, ?)", (url, content_hash)
+                )
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_items:
+            cache.popitem(last=False)
+
+    def _trim_disk(self):
+        with self._db:
+            self._db.execute(
+                "DELETE FROM nsfw_verdicts WHERE content_hash NOT IN "
+                "(SELECT content_hash FROM nsfw_verdicts ORDER BY ts DESC LIMIT ?)", (self.max_disk_items,)
+            )
+            self._db.execute(
+                "DELETE FROM nsfw_urls WHERE content_hash NOT IN (SELECT content_hash FROM nsfw_verdicts)"
+            )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
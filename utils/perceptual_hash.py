@@ -0,0 +1,73 @@
+import io
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """
+    Считает difference hash изображения: картинка сжимается до (hash_size+1) x hash_size
+    в оттенках серого, каждый бит — сравнение соседних пикселей по горизонтали.
+    Хэш устойчив к масштабированию и перекодированию, поэтому его можно считать по превью.
+    """
+    from PIL import Image  # Pillow нужен только при включённой проверке по pHash
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (hash_size * 4, hash_size * 4))  # Быстрое декодирование JPEG в уменьшенном размере
+        pixels = list(img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    """Расстояние Хэмминга между двумя хэшами."""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    BK-дерево по метрике Хэмминга: поиск всех хэшей в радиусе threshold
+    без полного перебора.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int):
+        if self._root is None:
+            self._root = (value, {})
+            self._size = 1
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                self._size += 1
+                return
+            node = child
+
+    def find_within(self, value: int, threshold: int):
+        """Возвращает первый хэш на расстоянии не больше threshold или None."""
+        if self._root is None:
+            return None
+        stack = [self._root]
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= threshold:
+                return node_value
+            for child_distance in range(max(1, distance - threshold), distance + threshold + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    stack.append(child)
+        return None
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket: rate токенов в секунду, не больше capacity в запасе.
+    acquire() ждёт появления токена, не блокируя event loop.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("rate должен быть больше нуля")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        # Lock выстраивает ожидающих в очередь FIFO, чтобы никто не голодал
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """Держит отдельный token bucket на каждый хост."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.rate, self.capacity)
+        return self._buckets[host]
+
+    async def acquire(self, url: str):
+        await self.bucket(url).acquire()
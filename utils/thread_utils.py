@@ -12,12 +12,24 @@ async def fetch_thread_data_safe(dvach, thread_num):
     Безопасно получает данные треда, обрабатывая возможные исключения.
     """
     try:
-        return dvach.fetch_thread_data(thread_num, board="b")
+        return await dvach.fetch_thread_data(thread_num, board="b")
     except Exception as e:
         logger.error(f"Не удалось получить данные треда {thread_num}: {e}")
         return None
 
 
+async def fetch_thread_updates_safe(dvach, thread, board="b"):
+    """
+    Безопасно получает новые медиа треда с учётом водяного знака.
+    Возвращает None, если тред не изменился или загрузка не удалась.
+    """
+    try:
+        return await dvach.fetch_thread_updates(thread, board=board)
+    except Exception as e:
+        logger.error(f"Не удалось получить обновления треда {thread.get('num')}: {e}")
+        return None
+
+
 def filter_new_media(media, posted_media):
     """
     Фильтрует медиа, которые уже были отправлены.